@@ -0,0 +1,235 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import collage_renderer
+import comparison
+import tiled_ocr
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
+
+def find_images(directory):
+    """
+    List the author images in a directory.
+
+    :param directory: Directory containing the scans.
+    :return: A sorted list of image file paths.
+    """
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def read_manifest(manifest_path):
+    """
+    Read a CSV manifest with one pair of author images per line.
+
+    Relative paths are resolved against the directory of the manifest.
+
+    :param manifest_path: Path to the manifest file.
+    :return: A list of (image_path_1, image_path_2) tuples.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    pairs = []
+    with open(manifest_path, newline="") as f:
+        for row in csv.reader(f):
+            row = [cell.strip() for cell in row if cell.strip()]
+            if not row or row[0].startswith("#"):
+                continue
+            if len(row) != 2:
+                raise ValueError(f"Expected two image paths per manifest line, got: {row}")
+            pairs.append(tuple(os.path.join(base_dir, path) for path in row))
+    return pairs
+
+
+def build_pairs(images, reference=None):
+    """
+    Decide which images are compared with each other.
+
+    :param images: Image paths found in the input directory.
+    :param reference: Optional image every other image is compared against.
+    :return: A list of (image_path_1, image_path_2) tuples.
+    """
+    if reference:
+        return [(reference, path) for path in images
+                if os.path.abspath(path) != os.path.abspath(reference)]
+    return list(itertools.combinations(images, 2))
+
+
+def bounded_map(executor, fn, items, max_in_flight):
+    """
+    Submit work to an executor while keeping at most max_in_flight tasks queued.
+
+    :param executor: A concurrent.futures executor.
+    :param fn: Function called with each item's arguments.
+    :param items: An iterable of argument tuples.
+    :param max_in_flight: Maximum number of submitted but unfinished tasks.
+    :return: A generator of (item, future) tuples in completion order. The futures are done, calling
+        result() returns the value or raises the task's exception.
+    """
+    items = iter(items)
+    pending = {}
+    while True:
+        for item in itertools.islice(items, max_in_flight - len(pending)):
+            pending[executor.submit(fn, *item)] = item
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield pending.pop(future), future
+
+
+def _extract(engine, mode, image_path):
+    return comparison.load_engine(engine, mode).extract_text_and_boxes(image_path)
+
+
+def _collage(engine, mode, ocr_data1, ocr_data2, image_path_1, image_path_2, output_path, streamed, fmt, quality):
+    comparison.load_engine(engine, mode).create_juxtaposed_collage(
+        ocr_data1, ocr_data2, image_path_1, image_path_2, output_path, streamed, fmt, quality)
+    return output_path
+
+
+def _pair_name(image_path_1, image_path_2):
+    name_1 = os.path.splitext(os.path.basename(image_path_1))[0]
+    name_2 = os.path.splitext(os.path.basename(image_path_2))[0]
+    return f"{name_1}__{name_2}"
+
+
+def run(pairs, engine, mode, output_dir, workers=None, max_in_flight=None, streamed=False, fmt="png",
+        quality=collage_renderer.DEFAULT_QUALITY):
+    """
+    Extract every distinct image once and write a collage plus box data for each pair.
+
+    :param pairs: A list of (image_path_1, image_path_2) tuples.
+    :param engine: "pytesseract" or "easyocr".
+    :param mode: "letters" or "words".
+    :param output_dir: Directory the results are written to.
+    :param workers: Number of worker processes, defaults to the CPU count.
+    :param max_in_flight: Maximum number of queued tasks, defaults to twice the worker count.
+    :param streamed: Encode collages row by row to bound the memory of each worker.
+    :param fmt: Collage format, "png", "webp", "jpeg" or "tiles".
+    :param quality: Quality of the lossy collage formats, 1-100.
+    :return: A dictionary with the number of pages and pairs processed, the elapsed time and the failures
+        as a list of (path, error message) tuples. A page that cannot be read fails every pair it is part of.
+    """
+    comparison.load_engine(engine, mode)  # Fail early on unknown engine/mode combinations
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 2
+    os.makedirs(output_dir, exist_ok=True)
+
+    images = sorted({path for pair in pairs for path in pair})
+    ocr_data = {}
+    failures = []
+    start = time.perf_counter()
+
+    # Every process tiles large pages on its share of the CPUs, not on all of them
+    with ProcessPoolExecutor(max_workers=workers, initializer=tiled_ocr.set_workers,
+                             initargs=(tiled_ocr.worker_share(workers),)) as executor:
+        tasks = ((engine, mode, path) for path in images)
+        for done, ((_, _, path), future) in enumerate(bounded_map(executor, _extract, tasks, max_in_flight), 1):
+            try:
+                ocr_data[path] = future.result()
+            except Exception as e:
+                failures.append((path, f"{type(e).__name__}: {e}"))
+                print(f"[{done}/{len(images)}] failed {path}: {type(e).__name__}: {e}", file=sys.stderr)
+                continue
+            print(f"[{done}/{len(images)}] extracted {path}", file=sys.stderr)
+
+        def collage_tasks():
+            for image_path_1, image_path_2 in pairs:
+                pair_dir = os.path.join(output_dir, _pair_name(image_path_1, image_path_2))
+                if image_path_1 not in ocr_data or image_path_2 not in ocr_data:
+                    failures.append((pair_dir, "an image of the pair could not be read"))
+                    continue
+                os.makedirs(pair_dir, exist_ok=True)
+                with open(os.path.join(pair_dir, "boxes.json"), "w") as f:
+                    json.dump({
+                        "engine": engine,
+                        "mode": mode,
+                        "author1": {"path": image_path_1, "boxes": ocr_data[image_path_1].to_dicts()},
+                        "author2": {"path": image_path_2, "boxes": ocr_data[image_path_2].to_dicts()},
+                    }, f)
+                output_path = os.path.join(pair_dir, "tiles" if fmt == "tiles" else f"collage.{fmt}")
+                yield (engine, mode, ocr_data[image_path_1], ocr_data[image_path_2],
+                       image_path_1, image_path_2, output_path, streamed, fmt, quality)
+
+        for done, (task, future) in enumerate(bounded_map(executor, _collage, collage_tasks(), max_in_flight), 1):
+            output_path = task[6]
+            try:
+                future.result()
+            except Exception as e:
+                failures.append((output_path, f"{type(e).__name__}: {e}"))
+                print(f"[{done}/{len(pairs)}] failed {output_path}: {type(e).__name__}: {e}", file=sys.stderr)
+                continue
+            print(f"[{done}/{len(pairs)}] wrote {output_path}", file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    return {"pages": len(images), "pairs": len(pairs), "seconds": elapsed, "failures": failures}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare handwriting samples in bulk without the Streamlit UI.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input-dir", help="Directory of author images")
+    source.add_argument("--manifest", help="CSV file with one pair of image paths per line")
+    parser.add_argument("--reference", help="Compare every image in --input-dir against this image")
+    parser.add_argument("--engine", choices=["pytesseract", "easyocr"], default="pytesseract")
+    parser.add_argument("--mode", choices=["letters", "words"], default="letters")
+    parser.add_argument("--output-dir", default="collages")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--max-in-flight", type=int, default=None,
+                        help="Maximum queued tasks (default: twice the worker count)")
+    parser.add_argument("--streamed", action="store_true",
+                        help="Encode collages one letter row at a time to bound memory (PNG only)")
+    parser.add_argument("--format", choices=["png", "webp", "jpeg", "tiles"], default="png",
+                        help="Collage format; tiles writes a deep-zoom tile pyramid")
+    parser.add_argument("--quality", type=int, default=collage_renderer.DEFAULT_QUALITY,
+                        help="Quality of WebP and JPEG collages, 1-100")
+    parser.add_argument("--sheet", action="store_true",
+                        help="Write one sheet with a column per image (the reference first) "
+                             "instead of pairwise collages")
+    args = parser.parse_args(argv)
+
+    if args.manifest:
+        pairs = read_manifest(args.manifest)
+    else:
+        pairs = build_pairs(find_images(args.input_dir), args.reference)
+    if not pairs:
+        parser.error("No image pairs to compare")
+    if args.streamed and args.format not in ("png", "tiles"):
+        parser.error("--streamed only supports PNG collages")
+
+    if args.sheet:
+        # Every distinct image once, in the order of the pairs, so the reference comes first
+        images = list(dict.fromkeys(path for pair in pairs for path in pair))
+        os.makedirs(args.output_dir, exist_ok=True)
+        output_path = os.path.join(args.output_dir, "sheet" if args.format == "tiles" else f"sheet.{args.format}")
+        start = time.perf_counter()
+        comparison.compare_authors(args.engine, args.mode, images, output_path, "sheet", max_workers=args.workers,
+                                   streamed=args.streamed, fmt=args.format, quality=args.quality)
+        elapsed = time.perf_counter() - start
+        print(f"Compared {len(images)} pages on {output_path} in {elapsed:.1f}s ({len(images) / elapsed:.2f} pages/s)")
+        return
+
+    stats = run(pairs, args.engine, args.mode, args.output_dir, args.workers, args.max_in_flight,
+                args.streamed, args.format, args.quality)
+    print(f"Processed {stats['pages']} pages and {stats['pairs']} pairs in {stats['seconds']:.1f}s "
+          f"({stats['pages'] / stats['seconds']:.2f} pages/s)")
+    if stats["failures"]:
+        print(f"{len(stats['failures'])} failed:")
+        for path, error in stats["failures"]:
+            print(f"  {path}: {error}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
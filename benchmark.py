@@ -0,0 +1,407 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+import collage_renderer
+import comparison
+import instrumentation
+import ocr_cache
+import reader_pool
+from glyph_table import GlyphTable
+from page import Page
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Timings only compare on the machine that measured them, so the baseline is local and not committed
+BASELINE_PATH = os.path.join(BASE_DIR, "benchmarks", "baseline.json")
+# Differences below these are noise on an otherwise idle machine, whatever the threshold
+MIN_LATENCY_DELTA_S = 0.010
+MIN_PEAK_DELTA_MB = 5
+
+REAL_IMAGES = [os.path.join(BASE_DIR, "images", "Author0.png"), os.path.join(BASE_DIR, "images", "Author2.png")]
+
+# Synthetic pages: font size in pixels and fraction of the page filled with text
+SYNTHETIC_SIZES = [48, 96, 144]
+SYNTHETIC_DENSITIES = {"sparse": 0.25, "dense": 1.0}
+PAGE_SIZE = (2480, 1754)  # A5 landscape at 300 dpi
+VOCABULARY = (
+    "the quick brown fox jumps over lazy dog handwriting sample letter word compare author "
+    "pack my box with five dozen liquor jugs sphinx of black quartz judge vow"
+).split()
+
+
+def render_synthetic_page(font_size, density, seed=0):
+    """
+    Render a page of random words with the bundled arial.ttf.
+
+    :param font_size: Font size in pixels.
+    :param density: Fraction of the page height that is filled with lines of text.
+    :param seed: Seed for the word choice, so pages are identical across runs.
+    :return: A tuple (Page, letters, words) where letters and words are GlyphTables with
+        the exact boxes of the rendered text.
+    """
+    rng = random.Random(seed)
+    font = ImageFont.truetype(collage_renderer.FONT_PATH, font_size)
+    image = Image.new("RGB", PAGE_SIZE, "white")
+    draw = ImageDraw.Draw(image)
+
+    margin = font_size
+    line_height = int(font_size * 1.6)
+    bottom = margin + int((PAGE_SIZE[1] - 2 * margin) * density)
+    letters, words = [], []
+    y = margin
+    while y + line_height <= bottom:
+        x = margin
+        while True:
+            word = rng.choice(VOCABULARY)
+            word_width = draw.textlength(word, font=font)
+            if x + word_width > PAGE_SIZE[0] - margin:
+                break
+            left, top, right, bottom_edge = draw.textbbox((x, y), word, font=font)
+            draw.text((x, y), word, fill="black", font=font)
+            words.append((word, left, top, right - left, bottom_edge - top))
+            char_x = x
+            for char in word:
+                c_left, c_top, c_right, c_bottom = draw.textbbox((char_x, y), char, font=font)
+                letters.append((char, c_left, c_top, c_right - c_left, c_bottom - c_top))
+                char_x += draw.textlength(char, font=font)
+            x += word_width + draw.textlength(" ", font=font)
+        y += line_height
+
+    def table(rows, text_field):
+        columns = list(zip(*rows)) if rows else [[]] * 5
+        return GlyphTable.from_columns(list(columns[0]), *columns[1:], [100.0] * len(rows), text_field=text_field)
+
+    bgr = np.ascontiguousarray(np.asarray(image)[:, :, ::-1])
+    return Page(bgr, f"synthetic-{font_size}px"), table(letters, "letter"), table(words, "word")
+
+
+def build_cases(include_real=True, include_synthetic=True):
+    """
+    Collect the benchmark pages.
+
+    :return: A list of dictionaries with a case name, a Page and, for synthetic pages,
+        ground-truth GlyphTables per mode.
+    """
+    cases = []
+    if include_real:
+        for path in REAL_IMAGES:
+            cases.append({"name": os.path.splitext(os.path.basename(path))[0], "page": Page.from_path(path),
+                          "truth": None})
+    if include_synthetic:
+        for font_size in SYNTHETIC_SIZES:
+            for density_name, density in SYNTHETIC_DENSITIES.items():
+                page, letters, words = render_synthetic_page(font_size, density)
+                cases.append({"name": f"synthetic-{font_size}px-{density_name}", "page": page,
+                              "truth": {"letters": letters, "words": words}})
+    return cases
+
+
+def _proc_status_mb(field):
+    """A memory field of /proc/self/status, e.g. "VmRSS", in MB. Raises OSError off Linux."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) / 1024
+    raise OSError(f"No {field} in /proc/self/status")
+
+
+def _load_engine(engine, mode, models):
+    """Import an OCR module and, if models is set, load its models like a warm service worker."""
+    comparison.load_engine(engine, mode)
+    if models and engine == "easyocr":
+        reader_pool.warm(["en"], gpu=mode == "letters")
+
+
+def _peak_rss_child(fn, args, engine, mode, models, connection):
+    # Pillow's and OpenCV's buffers are outside the Python heap, so only the resident set
+    # sees them. The peak is reset once the engine is loaded; ru_maxrss, used where /proc is
+    # missing, cannot be reset and only shows growth beyond the peak of loading it.
+    try:
+        ocr_cache.ENABLED = False  # Like run()
+        _load_engine(engine, mode, models)
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            before, peak = _proc_status_mb("VmRSS"), lambda: _proc_status_mb("VmHWM")
+        except OSError:
+            before, peak = instrumentation.max_rss_mb(), instrumentation.max_rss_mb
+        fn(*args)
+        connection.send(None if before is None else peak() - before)
+    except BaseException as e:
+        connection.send(e)
+    finally:
+        connection.close()
+
+
+def measure_peak_rss(fn, args, engine, mode, models=False):
+    """
+    Run fn once in a fresh interpreter and measure how far its resident set grew.
+
+    A forked process would reuse the resident heap its parent freed after the timed runs,
+    so the run gets a spawned process of its own.
+
+    :param fn: A picklable function, e.g. a module's create_juxtaposed_collage.
+    :param args: Picklable arguments of fn.
+    :param engine: Engine whose module is loaded before the measurement.
+    :param mode: "letters" or "words".
+    :param models: Also load the engine's models before the measurement, for OCR runs.
+    :return: The peak growth in MB, or None where neither /proc nor ru_maxrss is available.
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_peak_rss_child, args=(fn, args, engine, mode, models, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None and process.exitcode:
+        raise RuntimeError(f"Benchmark process died with exit code {process.exitcode}")
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def measure(fn, args, engine, mode, repeat, models=False):
+    """
+    Run fn repeatedly and record its latency and peak memory.
+
+    Latencies are taken in this process. One extra run in a fresh process measures the peak
+    growth of its resident set, which includes the image buffers of Pillow and OpenCV.
+
+    :param fn: A picklable function, e.g. a module's extract_text_and_boxes.
+    :param args: Picklable arguments of fn.
+    :param engine: Engine name of the module fn belongs to.
+    :param mode: "letters" or "words".
+    :param repeat: Number of timed runs.
+    :param models: Load the engine's models before measuring memory, see measure_peak_rss().
+    :return: A tuple (result of the last run, statistics dictionary).
+    """
+    latencies = []
+    result = None
+    for _ in range(repeat):
+        collage_renderer.clear_glyph_cache()  # Every run starts cold
+        start = time.perf_counter()
+        result = fn(*args)
+        latencies.append(time.perf_counter() - start)
+
+    return result, {
+        "latency_s": statistics.median(latencies),
+        "latency_min_s": min(latencies),
+        "latency_max_s": max(latencies),
+        "peak_mb": measure_peak_rss(fn, args, engine, mode, models),
+    }
+
+
+# Imports one OCR module in a fresh interpreter and reports the time it took and the peak
+# resident set of the interpreter
+_IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import comparison
+comparison.load_engine(sys.argv[1], sys.argv[2])
+elapsed = time.perf_counter() - start
+try:
+    # The peak of the new process itself; ru_maxrss would include the peak of the process
+    # that started it
+    with open("/proc/self/status") as f:
+        peak_mb = next(int(line.split()[1]) / 1024 for line in f if line.startswith("VmHWM:"))
+except (OSError, StopIteration):
+    import instrumentation
+    peak_mb = instrumentation.max_rss_mb()
+print(json.dumps({"seconds": elapsed, "peak_mb": peak_mb}))
+"""
+
+
+def measure_startup(engine, mode, repeat):
+    """
+    Measure the cold import of an OCR module, i.e. what selecting it costs the first time.
+
+    Every run uses a new interpreter, so nothing is resident from earlier runs.
+
+    :param engine: Engine name, e.g. "pytesseract".
+    :param mode: "letters" or "words".
+    :param repeat: Number of timed runs.
+    :return: A statistics dictionary like measure().
+    """
+    def child():
+        output = subprocess.run([sys.executable, "-c", _IMPORT_SCRIPT, engine, mode],
+                                cwd=BASE_DIR, capture_output=True, text=True, check=True).stdout
+        return json.loads(output)
+
+    runs = [child() for _ in range(repeat)]
+    latencies = [run["seconds"] for run in runs]
+    peaks = [run["peak_mb"] for run in runs if run["peak_mb"] is not None]
+    return {
+        "latency_s": statistics.median(latencies),
+        "latency_min_s": min(latencies),
+        "latency_max_s": max(latencies),
+        "peak_mb": statistics.median(peaks) if peaks else None,
+    }
+
+
+def run(cases, engines, modes, repeat=5):
+    """
+    Benchmark the import, extraction and collage rendering of every module on every case.
+
+    :param cases: Cases from build_cases().
+    :param engines: Engine names to run, e.g. ["pytesseract", "easyocr"].
+    :param modes: Modes to run, e.g. ["letters", "words"].
+    :param repeat: Runs per measurement; the median latency is reported.
+    :return: A dictionary mapping "case/engine/mode/stage" to statistics.
+    """
+    ocr_cache.ENABLED = False  # Measure the OCR itself, not the disk cache
+    results = {}
+    skipped = {}
+    with tempfile.TemporaryDirectory() as output_dir:
+        for engine in engines:
+            for mode in modes:
+                try:
+                    module = comparison.load_engine(engine, mode)
+                except ImportError as e:  # Engine's Python package not installed
+                    print(f"Skipping {engine}/{mode}: {type(e).__name__}: {e}", file=sys.stderr)
+                    continue
+                results[f"startup/{engine}/{mode}/import"] = measure_startup(engine, mode, repeat)
+                for case in cases:
+                    prefix = f"{case['name']}/{engine}/{mode}"
+                    page = case["page"]
+                    pixels = page.width * page.height
+
+                    ocr_data = None
+                    if (engine, mode) not in skipped:
+                        try:
+                            ocr_data, stats = measure(module.extract_text_and_boxes, (page,), engine, mode, repeat,
+                                                      models=True)
+                            stats["pages_per_s"] = 1 / stats["latency_s"]
+                            stats["megapixels_per_s"] = pixels / 1e6 / stats["latency_s"]
+                            results[f"{prefix}/extract"] = stats
+                        except Exception as e:  # Engine not installed or not configured
+                            skipped[(engine, mode)] = f"{type(e).__name__}: {e}"
+                            print(f"Skipping {engine}/{mode} extraction: {skipped[(engine, mode)]}", file=sys.stderr)
+
+                    # Synthetic pages can be rendered from their ground truth without any OCR engine
+                    if ocr_data is None and case["truth"] is not None:
+                        ocr_data = case["truth"][mode]
+                    if ocr_data is None or not len(ocr_data):
+                        continue
+
+                    output_path = os.path.join(output_dir, "collage.png")
+                    for streamed in (False, True):
+                        stage = "collage_streamed" if streamed else "collage"
+                        try:
+                            _, stats = measure(module.create_juxtaposed_collage,
+                                               (ocr_data, ocr_data, page, page, output_path, streamed),
+                                               engine, mode, repeat)
+                        except Exception as e:
+                            print(f"{prefix}/{stage} failed: {type(e).__name__}: {e}", file=sys.stderr)
+                            continue
+                        stats["glyphs_per_s"] = 2 * len(ocr_data) / stats["latency_s"]
+                        results[f"{prefix}/{stage}"] = stats
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Find measurements that got slower or use more memory than the stored baseline.
+
+    Latency compares the fastest of the runs, which is the least disturbed by other load on the
+    machine. A change only counts when it also exceeds the spread the baseline's own runs showed
+    and a small absolute margin.
+
+    :param results: Results from run().
+    :param baseline: Previously stored results, measured on the same machine.
+    :param threshold: Allowed relative slowdown or memory growth, e.g. 0.2 for 20%.
+    :return: A list of (key, metric, baseline value, current value) tuples, metric being
+        "latency_min_s" or "peak_mb".
+    """
+    regressions = []
+    for key, stats in results.items():
+        if key not in baseline:
+            continue
+        before_stats = baseline[key]
+        before, after = before_stats.get("latency_min_s"), stats.get("latency_min_s")
+        if before is not None and after is not None:
+            noise = max(before_stats.get("latency_max_s", before) - before, MIN_LATENCY_DELTA_S)
+            if after > before * (1 + threshold) + noise:
+                regressions.append((key, "latency_min_s", before, after))
+        before, after = before_stats.get("peak_mb"), stats.get("peak_mb")
+        if before is not None and after is not None and after > before * (1 + threshold) + MIN_PEAK_DELTA_MB:
+            regressions.append((key, "peak_mb", before, after))
+    return regressions
+
+
+def _format_peak(peak_mb):
+    return f"{peak_mb:>9.1f}" if peak_mb is not None else f"{'n/a':>9}"
+
+
+def print_results(results):
+    print(f"{'benchmark':<60} {'latency':>10} {'peak MB':>9}  throughput")
+    for key, stats in sorted(results.items()):
+        throughput = ", ".join(
+            f"{stats[name]:.2f} {name[:-len('_per_s')]}/s"
+            for name in ("pages_per_s", "megapixels_per_s", "glyphs_per_s") if name in stats
+        )
+        print(f"{key:<60} {stats['latency_s'] * 1000:>8.1f}ms {_format_peak(stats['peak_mb'])}  {throughput}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark OCR extraction and collage rendering.")
+    parser.add_argument("--engines", nargs="+", default=["pytesseract", "easyocr"],
+                        choices=["pytesseract", "easyocr"])
+    parser.add_argument("--modes", nargs="+", default=["letters", "words"], choices=["letters", "words"])
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Runs per measurement (the median is reported, the fastest is compared)")
+    parser.add_argument("--no-real", action="store_true", help="Skip the bundled author images")
+    parser.add_argument("--no-synthetic", action="store_true", help="Skip the synthetic pages")
+    parser.add_argument("--baseline", default=BASELINE_PATH,
+                        help="Baseline measured on this machine to compare against")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Store the results as this machine's baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative slowdown or memory growth that counts as a regression (default: 0.2)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args(argv)
+
+    cases = build_cases(not args.no_real, not args.no_synthetic)
+    results = run(cases, args.engines, args.modes, args.repeat)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        for key, metric, before, after in regressions:
+            if metric == "latency_min_s":
+                print(f"REGRESSION {key}: {before * 1000:.1f}ms -> {after * 1000:.1f}ms", file=sys.stderr)
+            else:
+                print(f"REGRESSION {key}: peak {before:.1f}MB -> {after:.1f}MB", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,755 @@
+import hashlib
+import heapq
+import io
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+import instrumentation
+import tile_pyramid
+from page import Page
+
+
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "arial.ttf")
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+MIDDLE_COLUMN_WIDTH = 100
+MARGIN = 50
+FIXED_HEIGHT = 300  # Fixed height for all letter/word images
+PADDING = 30  # Padding between images
+FONT_SIZE = 24 * 8
+
+HALF_ROW_CACHE_MAX_BYTES = int(os.environ.get("OCR_HALF_ROW_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+CROP_MARGIN = 10  # Extra pixels kept to the right of and below each OCR box
+MAX_RESIZE_CHANNELS = 510  # cv2.resize handles at most 512 channels per call
+ENCODE_ROWS = 64  # Rows a streamed PNG encodes at a time
+
+# Encoded collage formats: PNG is lossless and takes a zlib compression level (0-9),
+# WebP and JPEG are lossy and take a quality (1-100)
+COLLAGE_FORMATS = {"png": "PNG", "webp": "WEBP", "jpeg": "JPEG", "jpg": "JPEG"}
+DEFAULT_QUALITY = 90
+DEFAULT_COMPRESS_LEVEL = 6
+WEBP_MAX_SIZE = 16383  # Largest width or height a WebP image can have
+PREVIEW_WIDTH = 1200  # Width of the downscaled collage shown in the browser
+
+# Layout of the N-author sheet: a column for the letters, a title row with the author names
+# and one column per author that is at most MAX_SHEET_COLUMN_WIDTH wide
+SHEET_LABEL_WIDTH = 300
+SHEET_HEADER_HEIGHT = 120
+SHEET_TITLE_FONT_SIZE = 64
+MAX_SHEET_COLUMN_WIDTH = 4000
+
+# Each author's half of a juxtaposed collage is at most MAX_HALF_WIDTH wide, rows with more
+# glyphs wrap onto further lines. Two halves stay within the width a WebP image can have.
+MAX_HALF_WIDTH = 7500
+LINE_HEIGHT = FIXED_HEIGHT + PADDING
+
+# Glyphs shown per letter and author, the best-ranked ones by select_glyphs(); 0 (the default) shows all
+TOP_K = int(os.environ.get("OCR_COLLAGE_TOP_K", "0"))
+
+
+class _ByteLRU:
+    """A thread-safe least recently used cache bounded by the total size of its values."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size in bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._entries or nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+_half_row_cache = _ByteLRU(HALF_ROW_CACHE_MAX_BYTES)  # (image key, width, boxes) -> half row
+
+
+def placeholder():
+    """Grey image shown when an author has no sample for a letter."""
+    return np.full((FIXED_HEIGHT, 10, 3), 128, dtype=np.uint8)  # Assuming minimal width if no image
+
+
+def crop_glyph(img, x, y, width, height):
+    """
+    Cut a glyph out of a decoded image, including a small margin.
+
+    Crops that lie inside the image are views into the array; parts of a box that fall
+    outside the image are filled with black, like PIL's Image.crop.
+
+    :param img: A BGR image as a NumPy array.
+    :param x: Left edge of the OCR box.
+    :param y: Top edge of the OCR box.
+    :param width: Width of the OCR box.
+    :param height: Height of the OCR box.
+    :return: A NumPy array of shape (height + CROP_MARGIN, width + CROP_MARGIN, 3).
+    """
+    x, y = int(x), int(y)
+    crop_width, crop_height = max(int(width) + CROP_MARGIN, 1), max(int(height) + CROP_MARGIN, 1)
+    img_height, img_width = img.shape[:2]
+    if x >= 0 and y >= 0 and x + crop_width <= img_width and y + crop_height <= img_height:
+        return img[y:y + crop_height, x:x + crop_width]
+
+    crop = np.zeros((crop_height, crop_width, img.shape[2]), dtype=img.dtype)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + crop_width, img_width), min(y + crop_height, img_height)
+    if x1 > x0 and y1 > y0:
+        crop[y0 - y:y1 - y, x0 - x:x1 - x] = img[y0:y1, x0:x1]
+    return crop
+
+
+def _resize_batch(crops, size):
+    """Resize equally sized crops with as few cv2.resize calls as possible."""
+    crop_height = crops[0].shape[0]
+    interpolation = cv2.INTER_AREA if crop_height > FIXED_HEIGHT else cv2.INTER_LANCZOS4
+    channels = crops[0].shape[2]
+    per_call = max(MAX_RESIZE_CHANNELS // channels, 1)
+
+    resized = []
+    for start in range(0, len(crops), per_call):
+        batch = crops[start:start + per_call]
+        # Stack the crops along the channel axis so one call resamples all of them
+        stacked = np.concatenate(batch, axis=2) if len(batch) > 1 else batch[0]
+        try:
+            result = cv2.resize(stacked, size, interpolation=interpolation)
+        except cv2.error:
+            # OpenCV builds that reject many-channel arrays resize the crops one by one
+            result = np.concatenate([cv2.resize(crop, size, interpolation=interpolation) for crop in batch], axis=2)
+        if result.ndim == 2:
+            result = result[:, :, np.newaxis]
+        for i in range(len(batch)):
+            # BGR -> RGB while splitting the stack back into glyphs
+            resized.append(np.ascontiguousarray(result[:, :, i * channels:(i + 1) * channels][:, :, ::-1]))
+    return resized
+
+
+def clear_glyph_cache():
+    """Drop every cached half row and the resized glyphs it holds."""
+    _half_row_cache.clear()
+
+
+def resized_widths(crop_widths, crop_heights):
+    """
+    Width of crops once resized to FIXED_HEIGHT with their aspect ratio kept.
+
+    :param crop_widths: Width of each crop, a number or an array.
+    :param crop_heights: Height of each crop.
+    :return: The widths as int64, at least 1.
+    """
+    widths = np.floor(FIXED_HEIGHT * np.asarray(crop_widths, dtype=np.float64)
+                      / np.asarray(crop_heights, dtype=np.float64))
+    return np.maximum(widths, 1).astype(np.int64)
+
+
+def normalise_glyphs(img, boxes):
+    """
+    Crop glyphs from a decoded image and resize them to FIXED_HEIGHT in bulk.
+
+    Crops of the same size are resampled together, with as few cv2.resize calls as possible.
+
+    :param img: A BGR image as a NumPy array.
+    :param boxes: A list or (n, 4) array of (x, y, width, height) boxes.
+    :return: A list of RGB NumPy arrays of height FIXED_HEIGHT, in the order of boxes.
+    """
+    if not len(boxes):
+        return []
+    glyphs = [None] * len(boxes)
+    pending = {}  # (crop height, crop width) -> glyphs to be resized
+    with instrumentation.span("crop", glyphs=len(boxes)):
+        for i, box in enumerate(boxes):
+            crop = crop_glyph(img, *box)
+            pending.setdefault(crop.shape[:2], []).append((i, crop))
+
+    with instrumentation.span("resize", glyphs=len(boxes)):
+        for (crop_height, crop_width), items in pending.items():
+            # Resize image to have a consistent height, maintaining aspect ratio
+            resized_width = int(resized_widths(crop_width, crop_height))
+            resized = _resize_batch([crop for _, crop in items], (resized_width, FIXED_HEIGHT))
+            for (i, _), glyph in zip(items, resized):
+                glyphs[i] = glyph
+    return glyphs
+
+
+def rank_glyphs(conf, boxes, lengths=None):
+    """
+    Score candidate glyphs of one letter, higher is better.
+
+    A glyph scores its confidence relative to the most confident candidate, minus how far
+    its box height and width per character are from the median box of the letter, on a log
+    scale. Boxes cut too small or merged with neighbours by the segmentation thus rank low,
+    while long and short words rank alike.
+
+    :param conf: Confidence of every candidate.
+    :param boxes: An (n, 4) array of x, y, width, height.
+    :param lengths: Number of characters of every candidate, defaults to 1 each.
+    :return: A float array of scores.
+    """
+    conf = np.asarray(conf, dtype=np.float64)
+    sizes = np.maximum(np.asarray(boxes, dtype=np.float64)[:, 2:4], 1)
+    if lengths is not None:
+        sizes[:, 0] /= np.maximum(np.asarray(lengths, dtype=np.float64), 1)
+    deviation = np.abs(np.log(sizes / np.median(sizes, axis=0))).sum(axis=1)
+    return conf / max(conf.max(), 1e-9) - deviation
+
+
+def select_glyphs(table, letters=LETTERS, top_k=None):
+    """
+    Group the boxes of a table by letter, keeping only the best top_k glyphs of each letter.
+
+    Glyphs the engine gave a negative confidence (tesseract's -1 for non-text) are dropped.
+    The best candidates are taken from a heap, so a dense page costs O(n log k) per letter,
+    and only the selected glyphs are ever cropped and resized.
+
+    :param table: A GlyphTable of letters or words.
+    :param letters: Letters to keep.
+    :param top_k: Glyphs kept per letter, defaults to TOP_K; 0 keeps all of them.
+    :return: A dictionary with letters as keys and (n, 4) box arrays as values, in reading order.
+    """
+    top_k = TOP_K if top_k is None else top_k
+    boxes = table.boxes()
+    conf = table.records["conf"]
+    lengths = table.records["text_end"] - table.records["text_start"]
+    groups = {}
+    with instrumentation.span("select"):
+        for letter, indices in table.group_indices_by_initial(letters).items():
+            indices = indices[conf[indices] >= 0]
+            if not len(indices):
+                continue
+            if top_k and len(indices) > top_k:
+                scores = rank_glyphs(conf[indices], boxes[indices], lengths[indices])
+                best = heapq.nlargest(top_k, range(len(indices)), key=scores.__getitem__)
+                indices = indices[np.sort(best)]  # Back into reading order
+            groups[letter] = boxes[indices]
+    return groups
+
+
+def glyph_widths(boxes):
+    """
+    Width every glyph will have in a collage, computed from its OCR box without touching pixels.
+
+    :param boxes: An (n, 4) array of x, y, width, height, or None for a letter without glyphs.
+    :return: An int64 array of widths; the placeholder's width for a letter without glyphs.
+    """
+    if boxes is None or not len(boxes):
+        return np.array([placeholder().shape[1]], dtype=np.int64)
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    # Same crop size as crop_glyph()
+    return resized_widths(np.maximum(boxes[:, 2] + CROP_MARGIN, 1), np.maximum(boxes[:, 3] + CROP_MARGIN, 1))
+
+
+def pack_lines(widths, line_width):
+    """
+    Break a row of glyphs into lines no wider than line_width, keeping their order.
+
+    :param widths: Width of every glyph.
+    :param line_width: Available width; a glyph wider than that gets a line of its own.
+    :return: A list of (first, end) index ranges, one per line.
+    """
+    lines, first, used = [], 0, 0
+    for i, width in enumerate(widths):
+        if i > first and used + PADDING + width > line_width:
+            lines.append((first, i))
+            first, used = i, 0
+        used += int(width) + (PADDING if i > first else 0)
+    lines.append((first, len(widths)))
+    return lines
+
+
+def half_width(groups, max_width):
+    """
+    Width of an author's half rows: their longest row, wrapped at max_width but never
+    narrower than their widest glyph.
+
+    :param groups: A dictionary with letters as keys and (n, 4) box arrays as values.
+    :param max_width: Width rows wrap at.
+    :return: The width in pixels.
+    """
+    widths = [glyph_widths(groups.get(letter)) for letter in LETTERS]
+    longest = max(int(row.sum()) + PADDING * (len(row) - 1) for row in widths)
+    widest = max(int(row.max()) for row in widths)
+    return max(min(longest, max_width), widest)
+
+
+def line_counts(groups, width):
+    """
+    Number of lines every letter row of an author takes at a given half width.
+
+    :return: A dictionary with every letter of LETTERS as key.
+    """
+    return {letter: len(pack_lines(glyph_widths(groups.get(letter)), width)) for letter in LETTERS}
+
+
+class CollageLayout:
+    """
+    Exact geometry of a juxtaposed collage, planned from the OCR boxes before any glyph is
+    cropped, so the canvas is allocated once at its final size.
+
+    Author 1's half is on the left, the letters in the middle column and author 2's half on
+    the right. Each author's rows wrap at a width of their own, so their half rows do not
+    depend on whom they are compared with; both halves of the canvas are as wide as the wider
+    of the two. Each letter row is as tall as the most lines either author needs for it.
+    """
+
+    def __init__(self, left_width, right_width, middle_width, row_lines):
+        self.left_width = left_width  # Width author 1's rows wrap at
+        self.right_width = right_width  # Width author 2's rows wrap at
+        self.half_width = max(left_width, right_width)
+        self.middle_width = middle_width
+        self.row_lines = row_lines  # Letter -> number of glyph lines of its row
+        self.left = MARGIN  # First column of author 1's half
+        self.right = MARGIN + self.half_width + middle_width  # First column of author 2's half
+        self.width = 2 * MARGIN + 2 * self.half_width + middle_width
+        self.height = sum(row_lines.values()) * LINE_HEIGHT
+
+
+def _middle_column_width(font):
+    widest = max(font.getbbox(letter.upper())[2] for letter in LETTERS)
+    return max(MIDDLE_COLUMN_WIDTH, widest + 2 * PADDING)
+
+
+def plan_collage(groups1, groups2, max_half_width=MAX_HALF_WIDTH):
+    """
+    Plan a juxtaposed collage from both authors' grouped boxes.
+
+    :param groups1: Author 1's boxes, a dictionary with letters as keys and (n, 4) box arrays as values.
+    :param groups2: Author 2's boxes.
+    :param max_half_width: Width each author's rows wrap at.
+    :return: A CollageLayout.
+    """
+    with instrumentation.span("plan"):
+        width1, width2 = half_width(groups1, max_half_width), half_width(groups2, max_half_width)
+        lines1, lines2 = line_counts(groups1, width1), line_counts(groups2, width2)
+        font = ImageFont.truetype(FONT_PATH, FONT_SIZE)
+        return CollageLayout(width1, width2, _middle_column_width(font),
+                             {letter: max(lines1[letter], lines2[letter]) for letter in LETTERS})
+
+
+def render_half_row(glyphs, width):
+    """
+    Lay out one author's glyphs for one letter row, wrapped into lines of the half width.
+
+    The layout does not depend on the side of the collage: lines are aligned when they are
+    pasted, see _paste_half().
+
+    :param glyphs: RGB arrays of height FIXED_HEIGHT, in reading order.
+    :param width: Width the row wraps at, see half_width().
+    :return: A tuple (placements, line_widths) with a (line, offset, glyph) tuple for every
+        glyph, offset being its first column within its line, and the width of every line.
+    """
+    widths = np.array([glyph.shape[1] for glyph in glyphs], dtype=np.int64)
+    placements, line_widths = [], []
+    for line, (first, end) in enumerate(pack_lines(widths, width)):
+        offsets = np.cumsum(widths[first:end] + PADDING) - (widths[first:end] + PADDING)
+        placements.extend((line, int(offset), glyph) for offset, glyph in zip(offsets, glyphs[first:end]))
+        line_widths.append(int(widths[first:end].sum()) + PADDING * (end - first - 1))
+    return placements, line_widths
+
+
+def _boxes_digest(boxes):
+    return hashlib.sha1(np.ascontiguousarray(boxes, dtype="<i4").tobytes()).hexdigest() if boxes is not None else None
+
+
+class HalfRows:
+    """
+    One author's half of every letter row, rendered lazily.
+
+    A half row is only cropped, resized and laid out when its letter row is composed, so a
+    streamed collage holds the pixels of one row at a time. Half rows are cached by page
+    content, boxes and width, whatever the side they are shown on, so comparing the same
+    author against a series of others crops and resizes their glyphs once.
+    """
+
+    def __init__(self, page, groups, width, cache=True):
+        self.page = page
+        self.groups = groups
+        self.width = width
+        self.cache = cache
+
+    def __getitem__(self, letter):
+        boxes = self.groups.get(letter)
+        key = (self.page.key, self.width, _boxes_digest(boxes))
+        half = _half_row_cache.get(key)
+        if half is None:
+            # Crop and resize the glyphs of the row in one bulk pass
+            glyphs = normalise_glyphs(self.page.bgr, boxes) if boxes is not None else []
+            half = render_half_row(glyphs or [placeholder()], self.width)
+            if self.cache:
+                _half_row_cache.put(key, half, sum(glyph.nbytes for _, _, glyph in half[0]))
+        return half
+
+
+def render_halves(page, groups, width, cache=True):
+    """
+    One author's half of every letter row, rendered when the row is composed.
+
+    :param page: The Page the boxes were detected on.
+    :param groups: A dictionary with letters as keys and (n, 4) box arrays as values.
+    :param width: Width the rows wrap at, e.g. CollageLayout.left_width or right_width.
+    :param cache: Keep the rendered half rows for later collages. Streamed collages only
+        reuse cached rows, so their memory stays bounded by one row.
+    :return: A HalfRows that maps every letter of LETTERS to a half row from render_half_row().
+    """
+    return HalfRows(page, groups, width, cache)
+
+
+def _paste_half(rows, column, half, align_width=None):
+    """
+    Paste a half row from render_half_row() into the rows of a strip, glyph by glyph.
+
+    :param rows: The RGB array of the strip.
+    :param column: First column of the half.
+    :param half: The half row.
+    :param align_width: If given, every line is right-justified against column + align_width,
+        otherwise lines start at column.
+    """
+    placements, line_widths = half
+    for line, offset, glyph in placements:
+        left = column + offset + (align_width - line_widths[line] if align_width is not None else 0)
+        top = line * LINE_HEIGHT
+        rows[top:top + FIXED_HEIGHT, left:left + glyph.shape[1]] = glyph
+
+
+def compose_row(letter, half1, half2, layout, font):
+    """
+    Compose one letter row of the juxtaposed collage from the two authors' half rows.
+
+    :param letter: The letter of this row.
+    :param half1: Author 1's half row from render_half_row().
+    :param half2: Author 2's half row from render_half_row().
+    :param layout: The CollageLayout of the collage.
+    :param font: Font used for the letter in the middle column.
+    :return: A PIL image strip of layout.row_lines[letter] * LINE_HEIGHT rows.
+    """
+    rows = np.full((layout.row_lines[letter] * LINE_HEIGHT, layout.width, 3), 255, dtype=np.uint8)
+    _paste_half(rows, layout.left, half1)
+    # Author 2's lines are right-justified against the right edge of the canvas half
+    _paste_half(rows, layout.right, half2, layout.half_width)
+
+    # The middle column holds no glyphs, so the letter is drawn last without copying the row
+    strip = Image.fromarray(rows)
+    del rows
+    ImageDraw.Draw(strip).text((layout.left + layout.half_width + layout.middle_width // 2, 0), letter.upper(),
+                               fill="black", font=font, anchor="ma")
+    return strip
+
+
+def render_rows(halves1, halves2, layout):
+    """
+    Lazily compose the collage one letter row at a time.
+
+    :param halves1: Author 1's half rows from render_halves(), shown on the left.
+    :param halves2: Author 2's half rows from render_halves(), shown on the right.
+    :param layout: The CollageLayout of the collage.
+    :return: A generator of PIL image strips, one per letter, together exactly layout.height tall.
+    """
+    font = ImageFont.truetype(FONT_PATH, FONT_SIZE)
+    for letter in LETTERS:
+        half1, half2 = halves1[letter], halves2[letter]
+        with instrumentation.span("paste"):
+            strip = compose_row(letter, half1, half2, layout, font)
+        yield strip
+
+
+def render_sheet(pages, groups, names=None):
+    """
+    Lay out any number of authors side by side, one column per author and one row per letter.
+
+    Each author's glyphs are laid out once, as cached half rows, whatever the number of
+    authors they are compared with. Columns are as wide as their author's longest row up to
+    MAX_SHEET_COLUMN_WIDTH, longer rows wrap onto further lines.
+
+    :param pages: The Pages of the authors, in column order.
+    :param groups: For every page, a dictionary with letters as keys and (n, 4) box arrays as values.
+    :param names: Optional column titles, defaults to the page sources.
+    :return: A tuple (strips, width, height) with a generator of PIL image strips (a title
+        strip followed by one strip per letter) and the exact size of the sheet.
+    """
+    names = names or [os.path.basename(str(page.source)) if page.source else f"Author {i + 1}"
+                      for i, page in enumerate(pages)]
+
+    # Plan every column and row from the boxes before cropping anything
+    with instrumentation.span("plan"):
+        half_widths = [half_width(page_groups, MAX_SHEET_COLUMN_WIDTH - 2 * MARGIN) for page_groups in groups]
+        lines = [line_counts(page_groups, width) for page_groups, width in zip(groups, half_widths)]
+        row_lines = {letter: max(author[letter] for author in lines) for letter in LETTERS}
+    column_widths = [width + 2 * MARGIN for width in half_widths]
+    column_offsets = SHEET_LABEL_WIDTH + np.cumsum([0] + column_widths[:-1])
+    width = SHEET_LABEL_WIDTH + sum(column_widths)
+    height = SHEET_HEADER_HEIGHT + sum(row_lines.values()) * LINE_HEIGHT
+
+    halves = [render_halves(page, page_groups, half)
+              for page, page_groups, half in zip(pages, groups, half_widths)]
+
+    def strips():
+        font = ImageFont.truetype(FONT_PATH, FONT_SIZE)
+        title_font = ImageFont.truetype(FONT_PATH, SHEET_TITLE_FONT_SIZE)
+
+        header = Image.new("RGB", (width, SHEET_HEADER_HEIGHT), "white")
+        draw = ImageDraw.Draw(header)
+        for name, offset in zip(names, column_offsets):
+            draw.text((int(offset) + MARGIN, SHEET_HEADER_HEIGHT // 2), name, fill="black", font=title_font,
+                      anchor="lm")
+        yield header
+
+        for letter in LETTERS:
+            # Each author's half row is only rendered once its letter row is composed
+            letter_halves = [author[letter] for author in halves]
+            with instrumentation.span("paste"):
+                strip_height = row_lines[letter] * LINE_HEIGHT
+                rows = np.full((strip_height, width, 3), 255, dtype=np.uint8)
+                for half, offset in zip(letter_halves, column_offsets):
+                    _paste_half(rows, int(offset) + MARGIN, half)
+
+                # Labels and column lines lie outside the glyphs, they are drawn last
+                strip = Image.fromarray(rows)
+                del rows
+                draw = ImageDraw.Draw(strip)
+                draw.text((MARGIN, 0), letter.upper(), fill="black", font=font)
+                for offset in column_offsets:
+                    draw.line([(int(offset), 0), (int(offset), strip_height)], fill="lightgray", width=2)
+            yield strip
+
+    return strips(), width, height
+
+
+def _png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(
+        ">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+
+
+def write_png_stream(output, width, height, strips, compress_level=6):
+    """
+    Encode RGB strips into a PNG file without holding the whole image in memory.
+
+    Strips are written top to bottom; rows beyond height are dropped and missing rows
+    are filled with white.
+
+    :param output: A file path or a writable binary file object.
+    :param width: Width of the image; every strip must have this width.
+    :param height: Height of the image.
+    :param strips: An iterable of PIL RGB images.
+    :param compress_level: zlib compression level from 0 to 9.
+    """
+    if isinstance(output, (str, os.PathLike)):
+        with open(output, "wb") as f:
+            write_png_stream(f, width, height, strips, compress_level)
+        return
+
+    output.write(b"\x89PNG\r\n\x1a\n")
+    output.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+    compressor = zlib.compressobj(compress_level)
+
+    def write_rows(rows):
+        with instrumentation.span("encode"):
+            # Every scanline is prefixed with filter type 0 (None)
+            scanlines = np.empty((rows.shape[0], width * 3 + 1), dtype=np.uint8)
+            scanlines[:, 0] = 0
+            scanlines[:, 1:] = rows.reshape(rows.shape[0], -1)
+            data = compressor.compress(scanlines.tobytes())
+            if data:
+                output.write(_png_chunk(b"IDAT", data))
+
+    rows_written = 0
+    for strip in strips:
+        if rows_written >= height:
+            break
+        strip = strip if strip.mode == "RGB" else strip.convert("RGB")
+        strip_rows = min(strip.height, height - rows_written)
+        # Bands of ENCODE_ROWS rows, so a tall strip is never copied whole
+        for top in range(0, strip_rows, ENCODE_ROWS):
+            write_rows(np.asarray(strip.crop((0, top, width, min(top + ENCODE_ROWS, strip_rows)))))
+        rows_written += strip_rows
+
+    while rows_written < height:
+        rows = np.full((min(FIXED_HEIGHT, height - rows_written), width, 3), 255, dtype=np.uint8)
+        write_rows(rows)
+        rows_written += rows.shape[0]
+
+    with instrumentation.span("encode"):
+        output.write(_png_chunk(b"IDAT", compressor.flush()))
+        output.write(_png_chunk(b"IEND", b""))
+
+
+def _save_options(fmt, quality, compress_level, size):
+    """
+    Pillow save() arguments for a collage format.
+
+    :param fmt: "png", "webp" or "jpeg".
+    :param quality: Quality of the lossy formats, 1-100.
+    :param compress_level: zlib compression level of PNG, 0-9.
+    :param size: (width, height) of the image.
+    :return: A dictionary of keyword arguments for Image.save().
+    """
+    try:
+        pil_format = COLLAGE_FORMATS[fmt.lower()]
+    except KeyError:
+        raise ValueError(f"Unsupported collage format: {fmt}") from None
+    if pil_format == "PNG":
+        return {"format": pil_format, "compress_level": compress_level}
+    if pil_format == "WEBP" and max(size) > WEBP_MAX_SIZE:
+        raise ValueError(f"A {size[0]}x{size[1]} collage is too large for WebP (at most {WEBP_MAX_SIZE}px per side)")
+    return {"format": pil_format, "quality": quality}
+
+
+def save_collage(strips, collage_width, collage_height, output_path, streamed=False, fmt="png",
+                 quality=DEFAULT_QUALITY, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """
+    Assemble row strips into the final collage and save it.
+
+    :param strips: An iterable of PIL image strips, top to bottom.
+    :param collage_width: Width of the collage.
+    :param collage_height: Height of the collage.
+    :param output_path: File path or writable binary file object the collage is saved to,
+        or the directory of a tile pyramid.
+    :param streamed: If True, strips are encoded to PNG as they are produced so that peak
+        memory is proportional to a single row instead of the whole collage. PNG only.
+    :param fmt: "png", "webp", "jpeg" or "tiles" for a deep-zoom tile pyramid, which is
+        always written row by row.
+    :param quality: Quality of the lossy formats and of the pyramid tiles, 1-100.
+    :param compress_level: zlib compression level of PNG, 0-9.
+    """
+    if fmt == "tiles":
+        tile_pyramid.write_pyramid(output_path, strips, collage_width, collage_height, quality=quality)
+        return
+
+    options = _save_options(fmt, quality, compress_level, (collage_width, collage_height))
+    if streamed:
+        if options["format"] != "PNG":
+            raise ValueError("Streamed encoding is only supported for PNG collages")
+        write_png_stream(output_path, collage_width, collage_height, strips, compress_level)
+        return
+
+    collage = Image.new("RGB", (collage_width, collage_height), "white")
+    y_offset = 0
+    for strip in strips:
+        if y_offset >= collage_height:
+            break
+        with instrumentation.span("paste"):
+            collage.paste(strip, (0, y_offset))
+        y_offset += strip.height
+
+    with instrumentation.span("encode"):
+        collage.save(output_path, **options)
+
+
+def _preview_rows(strips, collage_width, preview):
+    """
+    Pass strips through unchanged while pasting a downscaled copy of each into preview.
+
+    :param strips: An iterable of PIL image strips, top to bottom.
+    :param collage_width: Width of the full collage.
+    :param preview: The PIL image the downscaled strips are pasted into.
+    :return: A generator of the original strips.
+    """
+    scale = preview.width / collage_width
+    y_offset = 0
+    for strip in strips:
+        top, bottom = round(y_offset * scale), round((y_offset + strip.height) * scale)
+        if bottom > top and top < preview.height:
+            with instrumentation.span("preview"):
+                preview.paste(strip.resize((preview.width, bottom - top), Image.Resampling.BOX), (0, top))
+        y_offset += strip.height
+        yield strip
+
+
+def encode_collage(strips, collage_width, collage_height, streamed=False, fmt="png",
+                   quality=DEFAULT_QUALITY, compress_level=DEFAULT_COMPRESS_LEVEL, preview_width=PREVIEW_WIDTH):
+    """
+    Assemble row strips into the final collage and encode it in memory.
+
+    A downscaled preview is built from the same strips while they are encoded, so the
+    full-size collage never has to be decoded again for display.
+
+    :param strips: An iterable of PIL image strips, top to bottom.
+    :param collage_width: Width of the collage.
+    :param collage_height: Height of the collage.
+    :param streamed: If True, encode PNG row by row, see save_collage().
+    :param fmt: "png", "webp" or "jpeg".
+    :param quality: Quality of the lossy formats, 1-100.
+    :param compress_level: zlib compression level of PNG, 0-9.
+    :param preview_width: Width of the preview; the collage is never upscaled.
+    :return: A tuple (encoded collage, encoded preview) of bytes in the requested format.
+    """
+    if fmt == "tiles":
+        raise ValueError("Tile pyramids are written to a directory and cannot be encoded in memory")
+
+    scale = min(preview_width / collage_width, 1)
+    preview = Image.new("RGB", (max(round(collage_width * scale), 1), max(round(collage_height * scale), 1)),
+                        "white")
+
+    output = io.BytesIO()
+    save_collage(_preview_rows(strips, collage_width, preview), collage_width, collage_height, output,
+                 streamed, fmt, quality, compress_level)
+
+    preview_output = io.BytesIO()
+    with instrumentation.span("encode", preview=True):
+        preview.save(preview_output, **_save_options(fmt, quality, compress_level, preview.size))
+    return output.getvalue(), preview_output.getvalue()
+
+
+def juxtapose(ocr_data1, ocr_data2, author1, author2, output_path, streamed=False, fmt="png",
+              quality=DEFAULT_QUALITY, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """
+    Render the collage of two authors, the body of every module's create_juxtaposed_collage().
+
+    :param ocr_data1: GlyphTable of letters or words for author 1.
+    :param ocr_data2: GlyphTable for author 2.
+    :param author1: Page, encoded image bytes or file path for author 1's image.
+    :param author2: Page, encoded image bytes or file path for author 2's image.
+    :param output_path: File path or directory the collage is saved to, or None to encode it in memory.
+    :param streamed: If True, encode PNG row by row, see save_collage().
+    :param fmt: "png", "webp", "jpeg" or "tiles".
+    :param quality: Quality of the lossy formats and of the pyramid tiles, 1-100.
+    :param compress_level: zlib compression level of PNG, 0-9.
+    :return: None if the collage was saved to output_path, otherwise the tuple from encode_collage().
+    """
+    # Reuse the pages decoded for OCR, or decode the original images
+    with instrumentation.span("decode"):
+        page1 = Page.load(author1)
+        page2 = Page.load(author2)
+
+    # Group the alphabetic glyphs by initial letter and keep the best-ranked ones of each, only
+    # those are ever cropped and resized
+    with instrumentation.span("group"):
+        groups1 = select_glyphs(ocr_data1)
+        groups2 = select_glyphs(ocr_data2)
+
+    # Size every glyph and wrap every row from the boxes alone, so the canvas is allocated
+    # at its exact size before any pixel work
+    layout = plan_collage(groups1, groups2)
+
+    # Lay out each author's half of every row on its own, so an author compared again
+    # reuses their cached half rows and only the other side is cropped and resized
+    halves1 = render_halves(page1, groups1, layout.left_width, cache=not streamed)
+    halves2 = render_halves(page2, groups2, layout.right_width, cache=not streamed)
+
+    # Compose the collage one letter row at a time
+    strips = render_rows(halves1, halves2, layout)
+    if output_path is None:
+        return encode_collage(strips, layout.width, layout.height, streamed, fmt, quality, compress_level)
+    save_collage(strips, layout.width, layout.height, output_path, streamed, fmt, quality, compress_level)
@@ -0,0 +1,177 @@
+import contextvars
+import importlib
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import collage_renderer
+import instrumentation
+from page import Page
+
+
+# OCR module implementing each (engine, mode) combination
+ENGINE_MODULES = {
+    ("pytesseract", "letters"): "pytesseract_letter",
+    ("pytesseract", "words"): "pytesseract_word",
+    ("easyocr", "letters"): "easyocr_letter",
+    ("easyocr", "words"): "easyocr_word",
+}
+
+
+def load_engine(engine, mode):
+    """
+    Import the OCR module for an engine and comparison mode.
+
+    :param engine: "pytesseract" or "easyocr".
+    :param mode: "letters" or "words".
+    :return: The module providing extract_text_and_boxes and create_juxtaposed_collage.
+    """
+    try:
+        module_name = ENGINE_MODULES[(engine.lower(), mode.lower())]
+    except KeyError:
+        raise ValueError(f"Unknown OCR engine/mode combination: {engine}/{mode}") from None
+    return importlib.import_module(module_name)
+
+
+def extract_all(extract_text_and_boxes, images, max_workers=None):
+    """
+    Run OCR on several author images concurrently.
+
+    Threads are enough here: pytesseract spends its time in the tesseract child process
+    and EasyOCR releases the GIL inside torch, so the OCR runs overlap.
+
+    :param extract_text_and_boxes: The extract_text_and_boxes function of one of the OCR modules.
+    :param images: Pages, encoded image bytes or file paths of the author images.
+    :param max_workers: Maximum number of concurrent OCR runs, defaults to one per image.
+    :return: A list with the OCR data of each image, in the order of images.
+    """
+    images = list(images)
+    if len(images) <= 1:
+        return [extract_text_and_boxes(image) for image in images]
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(images)) as executor:
+        # Run every task in a copy of the caller's context so its spans reach the caller's trace
+        futures = [executor.submit(contextvars.copy_context().run, extract_text_and_boxes, image)
+                   for image in images]
+        return [future.result() for future in futures]
+
+
+def extract_authors(extract_text_and_boxes, images, max_workers=None):
+    """
+    Decode and OCR any number of author images, reading every distinct page only once.
+
+    :param extract_text_and_boxes: The extract_text_and_boxes function of one of the OCR modules.
+    :param images: Pages, encoded image bytes or file paths of the author images.
+    :param max_workers: Maximum number of concurrent OCR runs, defaults to one per distinct page.
+    :return: A tuple (pages, ocr_data) of lists in the order of images.
+    """
+    pages = [Page.load(image) for image in images]
+    distinct = list({page.key: page for page in pages}.values())
+    results = dict(zip([page.key for page in distinct], extract_all(extract_text_and_boxes, distinct, max_workers)))
+    return pages, [results[page.key] for page in pages]
+
+
+def comparison_pairs(count, reference=None):
+    """
+    Pairs of authors to compare.
+
+    :param count: Number of authors.
+    :param reference: Index of the questioned document compared against every other author,
+        or None to compare every author with every other one.
+    :return: A list of (index 1, index 2) tuples.
+    """
+    if reference is None:
+        return list(itertools.combinations(range(count), 2))
+    return [(reference, i) for i in range(count) if i != reference]
+
+
+def create_sheet(ocr_data, pages, output_path=None, names=None, streamed=False, fmt="png",
+                 quality=collage_renderer.DEFAULT_QUALITY, compress_level=collage_renderer.DEFAULT_COMPRESS_LEVEL):
+    """
+    Create one sheet comparing any number of authors, one column per author.
+
+    :param ocr_data: A GlyphTable per author.
+    :param pages: The Page of each author.
+    :param output_path: File path (or tile directory) the sheet is saved to, or None to return it
+        encoded in memory.
+    :param names: Optional column titles.
+    :param streamed: Encode the sheet row by row (PNG only).
+    :param fmt: Output format, "png", "webp", "jpeg" or "tiles".
+    :param quality: Quality of the lossy formats and of the pyramid tiles, 1-100.
+    :param compress_level: zlib compression level of PNG, 0-9.
+    :return: None if the sheet was saved to output_path, otherwise a tuple with the encoded
+        sheet and a downscaled preview.
+    """
+    with instrumentation.span("group"):
+        groups = [collage_renderer.select_glyphs(table) for table in ocr_data]
+    strips, width, height = collage_renderer.render_sheet(pages, groups, names)
+    if output_path is None:
+        return collage_renderer.encode_collage(strips, width, height, streamed, fmt, quality, compress_level)
+    collage_renderer.save_collage(strips, width, height, output_path, streamed, fmt, quality, compress_level)
+
+
+def create_pairwise_collages(create_juxtaposed_collage, ocr_data, pages, pairs, output_paths, max_workers=None,
+                             **options):
+    """
+    Create the juxtaposed collages of several pairs of authors in parallel.
+
+    The OCR data and decoded pages are shared by all pairs, and each author's half rows are
+    cached, so an author taking part in many pairs is laid out once per side.
+
+    :param create_juxtaposed_collage: The create_juxtaposed_collage function of one of the OCR modules.
+    :param ocr_data: A GlyphTable per author.
+    :param pages: The Page of each author.
+    :param pairs: A list of (index 1, index 2) tuples, e.g. from comparison_pairs().
+    :param output_paths: The output path of each pair, None entries return the encoded collage.
+    :param max_workers: Maximum number of collages rendered at once, defaults to the CPU count.
+    :param options: Encoding options passed on, e.g. fmt or quality.
+    :return: A list with the result of create_juxtaposed_collage for each pair.
+    """
+    def render(pair, output_path):
+        first, second = pair
+        return create_juxtaposed_collage(ocr_data[first], ocr_data[second], pages[first], pages[second],
+                                         output_path, **options)
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, render, pair, output_path)
+                   for pair, output_path in zip(pairs, output_paths)]
+        return [future.result() for future in futures]
+
+
+def compare_authors(engine, mode, images, output, layout="sheet", reference=None, names=None, max_workers=None,
+                    **options):
+    """
+    Compare any number of authors, extracting each of them once.
+
+    :param engine: "pytesseract" or "easyocr".
+    :param mode: "letters" or "words".
+    :param images: Pages, encoded image bytes or file paths of the author images.
+    :param output: For the "sheet" layout the output path of the sheet (None returns it encoded),
+        for the "pairs" layout the directory the pairwise collages are written to.
+    :param layout: "sheet" for one N-column sheet, "pairs" for one collage per pair.
+    :param reference: Index of the questioned document for the "pairs" layout, None compares
+        every author with every other one.
+    :param names: Optional author names used for the sheet titles and pairwise file names.
+    :param max_workers: Maximum number of concurrent OCR runs and collages.
+    :param options: Encoding options, e.g. fmt, quality or streamed.
+    :return: The result of create_sheet() for "sheet", or a list of ((index 1, index 2), path)
+        tuples for "pairs".
+    """
+    module = load_engine(engine, mode)
+    pages, ocr_data = extract_authors(module.extract_text_and_boxes, images, max_workers)
+
+    if layout == "sheet":
+        return create_sheet(ocr_data, pages, output, names, **options)
+    if layout != "pairs":
+        raise ValueError(f"Unknown layout: {layout}")
+
+    names = names or [os.path.splitext(os.path.basename(str(page.source)))[0] if page.source else f"author{i + 1}"
+                      for i, page in enumerate(pages)]
+    pairs = comparison_pairs(len(pages), reference)
+    fmt = options.get("fmt", "png")
+    os.makedirs(output, exist_ok=True)
+    output_paths = [os.path.join(output, f"{names[first]}__{names[second]}" + ("" if fmt == "tiles" else f".{fmt}"))
+                    for first, second in pairs]
+    create_pairwise_collages(module.create_juxtaposed_collage, ocr_data, pages, pairs, output_paths,
+                             max_workers, **options)
+    return list(zip(pairs, output_paths))
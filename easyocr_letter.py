@@ -1,63 +1,109 @@
-import cv2
-import easyocr
-
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+from PIL import Image
+
+import collage_renderer
+import glyph_table
+import instrumentation
+import ocr_cache
+import preprocessing
+import reader_pool
+import segmentation
+import tiled_ocr
+from glyph_table import GlyphTable
+from page import Page
+
+
+def split_into_words(ocr_result):
+    """
+    Collect the recognised text elements and their bounding boxes, with each element having
+    the confidence level the engine reported for it.
 
+    Parameters:
+    - ocr_result (list): The OCR result from easyocr.Reader.readtext.
 
-def split_into_characters(ocr_result):
+    Returns:
+    - GlyphTable: A columnar table with one row per text element.
+    """
+    detections = [detection for detection in ocr_result if detection[1].strip()]  # Ensure there is text
+    # Each detection is (four corner points, text, confidence)
+    boxes = np.array([detection[0] for detection in detections], dtype=np.float64).reshape(-1, 4, 2)
+
+    return GlyphTable.from_columns(
+        [detection[1] for detection in detections],
+        boxes[:, 0, 0],
+        boxes[:, 0, 1],
+        boxes[:, 2, 0] - boxes[:, 0, 0],
+        boxes[:, 2, 1] - boxes[:, 0, 1],
+        [detection[2] for detection in detections],  # Confidence of the whole text element
+        text_field="word",
+    )
+
+
+def split_into_characters(ocr_result, gray=None):
     """
     Split OCR results into individual characters, with each character having
     the confidence level of the original text element it belongs to.
 
     Parameters:
     - ocr_result (list): The OCR result from easyocr.Reader.readtext.
+    - gray (numpy.ndarray, optional): The grayscale page. When given, character boundaries are
+      placed at the columns with the least ink instead of splitting words into equal widths.
 
     Returns:
-    - List[dict]: A list of dictionaries, each representing a character.
+    - GlyphTable: A columnar table with one row per character.
     """
-    characters = []
-    for detection in ocr_result:
-        text = detection[1]
-        bbox = detection[0]
-        if text.strip():  # Ensure there is text
-            num_chars = len(text)
-            width_per_char = (bbox[2][0] - bbox[0][0]) // max(num_chars, 1)
+    words = split_into_words(ocr_result)
 
-            for j, char in enumerate(text):
-                char_data = {
-                    "letter": char,
-                    "x": bbox[0][0] + j * width_per_char,
-                    "y": bbox[0][1],
-                    "width": width_per_char,
-                    "height": bbox[2][1] - bbox[0][1],
-                    "conf": detection[2]  # Confidence of the whole text element
-                }
-                characters.append(char_data)
+    if gray is None:
+        return glyph_table.split_uniform(words)
+    return segmentation.segment_characters(words, gray)
 
-    return characters
 
-
-def extract_text_and_boxes(image_path):
+def extract_text_and_boxes(image):
     """
     Extract text and their bounding boxes from an image using OCR.
 
-    :param image_path: The path to the image file.
-    :return: A list of dictionaries, each containing a single letter and its bounding box details.
+    :param image: A Page, the encoded image bytes or the path to the image file.
+    :return: A GlyphTable with one row per letter and its bounding box details.
     """
-    # Read the image
-    img = cv2.imread(image_path)
+    # Decode the image once, a Page passed in by the caller is used as is
+    with instrumentation.span("decode"):
+        page = Page.load(image)
+
+    # Return the stored result if this exact image was already processed with the same settings
+    cache_key = ocr_cache.make_key(page, "easyocr", "letters",
+                                   {"lang": ["en"], "gpu": True, "segmentation": segmentation.METHOD,
+                                    "preprocessing": preprocessing.settings("easyocr"), "tiling": tiled_ocr.settings()})
+    with instrumentation.span("cache"):
+        cached = ocr_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Use the grayscale view of the page (optional but often helps in OCR)
+    with instrumentation.span("grayscale"):
+        gray = page.gray
 
-    # Convert the image to grayscale (optional but often helps in OCR)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # Rescale the page to the text size the engine reads best (optionally deskewed and binarised)
+    with instrumentation.span("preprocess"):
+        prepared = preprocessing.preprocess(gray, "easyocr")
 
-    # Initialize EasyOCR reader
-    reader = easyocr.Reader(['en'])
+    # Borrow a warm EasyOCR reader from the shared pool for every tile of the page (a single
+    # tile unless the page is large) and get the words and their bounding boxes
+    def read_tile(tile):
+        with reader_pool.reader(['en']) as reader:
+            return split_into_words(reader.readtext(tile))
 
-    # Use EasyOCR to get OCR data including bounding boxes
-    ocr_result = reader.readtext(gray)
+    with instrumentation.span("ocr", engine="easyocr"):
+        words_data = tiled_ocr.read_words(prepared.gray, read_tile)
 
-    # Extract letters and their bounding boxes
-    characters_data = split_into_characters(ocr_result)
+    # Extract letters and their bounding boxes, segmenting words on the grayscale page
+    with instrumentation.span("split"):
+        characters_data = segmentation.segment_characters(words_data, prepared.gray)
+
+    # Map the boxes back onto the original page so the collage crops at full resolution
+    characters_data = prepared.to_original(characters_data)
+
+    ocr_cache.put(cache_key, characters_data)
 
     return characters_data
 
@@ -135,97 +181,28 @@ def create_mock_collage(author1_images, author2_images):
     return collage
 
 
-def create_juxtaposed_collage(ocr_data1, ocr_data2, author1_path, author2_path):
+def create_juxtaposed_collage(ocr_data1, ocr_data2, author1, author2,
+                              output_path="juxtaposed_letter_collage_final.png", streamed=False, fmt="png",
+                              quality=collage_renderer.DEFAULT_QUALITY,
+                              compress_level=collage_renderer.DEFAULT_COMPRESS_LEVEL):
     """
     Create a collage juxtaposing the handwriting of two authors with original handwriting from images,
     including equal margins and a middle column with a computer-generated version of each letter.
 
-    :param ocr_data1: OCR data for author 1.
-    :param ocr_data2: OCR data for author 2.
-    :param author1_path: File path for author 1's image.
-    :param author2_path: File path for author 2's image.
-    """
-    # Load the original images
-    img1 = cv2.imread(author1_path)
-    img2 = cv2.imread(author2_path)
-
-    # Convert to PIL.Image format for easier manipulation
-    img1 = Image.fromarray(cv2.cvtColor(img1, cv2.COLOR_BGR2RGB))
-    img2 = Image.fromarray(cv2.cvtColor(img2, cv2.COLOR_BGR2RGB))
-
-    # Dimensions for the collage
-    middle_column_width = 100
-    margin = 50
-
-    # Calculate the max height from both sets of OCR data
-    max_height = max([item['height'] for item in ocr_data1 + ocr_data2]) * 26
-
-    collage_width = img1.width + middle_column_width + margin * 2 + 4000
-    collage_height = max_height - 1800
-    collage = Image.new("RGB", (collage_width, collage_height), "white")
-
-    # Prepare font for the middle column letters
-    font = ImageFont.truetype("arial.ttf", 24 * 8)
-    draw = ImageDraw.Draw(collage)
-
-    # Function to extract and crop letter images from OCR data
-    def crop_letter_images(ocr_data, img):
-        letters = {}
-        for item in ocr_data:
-            letter = item['letter'].lower()
-            if letter.isalpha():  # Filter only alphabet letters
-                x, y, width, height = item['x'], item['y'], item['width'], item['height']
-                cropped = img.crop((x, y, x + width + 10, y + height + 10))
-                letters.setdefault(letter, []).append(cropped)
-        return letters
-
-    letters1 = crop_letter_images(ocr_data1, img1)
-    letters2 = crop_letter_images(ocr_data2, img2)
-
-    y_offset = 0
-    fixed_height = 300  # Fixed height for all letter images
-    padding = 30  # Padding between images
-    for letter in "abcdefghijklmnopqrstuvwxyz":
-        # Assuming each letter's block height is max_height // 26
-        block_height = max_height // 26
-
-        # Center text in the middle of each block's height
-        letter_img_x = collage_width / 2  # Adjust X as needed
-        letter_img_y = y_offset  # Adjust Y for approximate vertical centering
-
-        x_offset_author2 = collage_width - margin
-
-        draw.text((letter_img_x, letter_img_y), letter.upper(), fill="black", font=font)
-
-        # Retrieve all images for this letter from both authors
-        author1_imgs = letters1.get(letter, [
-            Image.new("RGB", (10, fixed_height), "grey")])  # Assuming minimal width if no image
-        author2_imgs = letters2.get(letter, [Image.new("RGB", (10, fixed_height), "grey")])
-
-        # Starting x position for Author 1's letters
-        x_offset_author1 = margin
-
-        # Paste all of Author 1's images for this letter side by side
-        for img in author1_imgs:
-            # Resize image to have a consistent height, maintaining aspect ratio
-            aspect_ratio = img.width / img.height
-            resized_width = int(fixed_height * aspect_ratio)
-            resized_img = img.resize((resized_width, fixed_height), Image.Resampling.LANCZOS)
-
-            collage.paste(resized_img, (x_offset_author1, y_offset))
-            x_offset_author1 += resized_width + padding  # Add padding for the next image
-
-        # Paste all of Author 2's images for this letter, right-justified
-        for img in reversed(author2_imgs):  # Reverse to start placing from right to left
-            # Resize image to have a consistent height, maintaining aspect ratio
-            aspect_ratio = img.width / img.height
-            resized_width = int(fixed_height * aspect_ratio)
-            resized_img = img.resize((resized_width, fixed_height), Image.Resampling.LANCZOS)
-
-            x_offset_author2 -= (resized_width + padding)  # Move left for the next image, include padding
-            collage.paste(resized_img, (x_offset_author2, y_offset))
-
-        # Increment the y_offset for the next row/letter
-        y_offset += fixed_height + padding
-
-    collage.save("juxtaposed_letter_collage_final.png")
+    :param ocr_data1: GlyphTable with the OCR data for author 1.
+    :param ocr_data2: GlyphTable with the OCR data for author 2.
+    :param author1: Page, encoded image bytes or file path for author 1's image.
+    :param author2: Page, encoded image bytes or file path for author 2's image.
+    :param output_path: File path the collage is saved to, or None to return it encoded in memory.
+        For the "tiles" format this is the directory of the pyramid.
+    :param streamed: If True, encode the collage row by row so that peak memory stays
+        proportional to a single letter row rather than the whole canvas (PNG only).
+    :param fmt: Output format, "png", "webp", "jpeg" or "tiles" for a deep-zoom tile pyramid
+        that can be panned and zoomed with constant memory.
+    :param quality: Quality of the lossy formats and of the pyramid tiles, 1-100.
+    :param compress_level: zlib compression level of PNG, 0-9.
+    :return: None if the collage was saved to output_path, otherwise a tuple with the encoded
+        collage and a downscaled preview for display, both as bytes.
+    """
+    return collage_renderer.juxtapose(ocr_data1, ocr_data2, author1, author2, output_path, streamed, fmt, quality,
+                                      compress_level)
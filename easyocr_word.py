@@ -1,6 +1,14 @@
-import cv2
-import easyocr
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+from PIL import Image, ImageDraw
+
+import collage_renderer
+import instrumentation
+import ocr_cache
+import preprocessing
+import reader_pool
+import tiled_ocr
+from glyph_table import GlyphTable
+from page import Page
 
 
 def split_into_words(ocr_result):
@@ -12,44 +20,63 @@ def split_into_words(ocr_result):
     - ocr_result (list): The OCR result from easyocr reader.
 
     Returns:
-    - List[dict]: A list of dictionaries, each representing a word.
+    - GlyphTable: A columnar table with one row per word.
     """
-    words = []
-    for word_info in ocr_result:
-        word_data = {
-            "word": word_info[1],
-            "x": word_info[0][0][0],
-            "y": word_info[0][0][1],
-            "width": word_info[0][1][0] - word_info[0][0][0],
-            "height": word_info[0][2][1] - word_info[0][0][1],
-            "conf": word_info[2],
-        }
-        words.append(word_data)
-
-    return words
-
-
-def extract_text_and_boxes(image_path):
+    # Each detection is (four corner points, text, confidence)
+    boxes = np.array([detection[0] for detection in ocr_result], dtype=np.float64).reshape(-1, 4, 2)
+
+    return GlyphTable.from_columns(
+        [word_info[1] for word_info in ocr_result],
+        boxes[:, 0, 0],
+        boxes[:, 0, 1],
+        boxes[:, 1, 0] - boxes[:, 0, 0],
+        boxes[:, 2, 1] - boxes[:, 0, 1],
+        [word_info[2] for word_info in ocr_result],
+        text_field="word",
+    )
+
+
+def extract_text_and_boxes(image):
     """
     Extract text and their bounding boxes from an image using OCR.
 
-    :param image_path: The path to the image file.
-    :return: A list of dictionaries, each containing a single word and its bounding box details.
+    :param image: A Page, the encoded image bytes or the path to the image file.
+    :return: A GlyphTable with one row per word and its bounding box details.
     """
-    # Read the image
-    img = cv2.imread(image_path)
+    # Decode the image once, a Page passed in by the caller is used as is
+    with instrumentation.span("decode"):
+        page = Page.load(image)
+
+    # Return the stored result if this exact image was already processed with the same settings
+    cache_key = ocr_cache.make_key(page, "easyocr", "words",
+                                   {"lang": ["en"], "gpu": False, "preprocessing": preprocessing.settings("easyocr"),
+                                    "tiling": tiled_ocr.settings()})
+    with instrumentation.span("cache"):
+        cached = ocr_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Use the grayscale view of the page (optional but often helps in OCR)
+    with instrumentation.span("grayscale"):
+        gray = page.gray
+
+    # Rescale the page to the text size the engine reads best (optionally deskewed and binarised)
+    with instrumentation.span("preprocess"):
+        prepared = preprocessing.preprocess(gray, "easyocr")
 
-    # Convert the image to grayscale (optional but often helps in OCR)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # Borrow a warm EasyOCR reader from the shared pool for every tile of the page (a single
+    # tile unless the page is large) and get the words and their bounding boxes
+    def read_tile(tile):
+        with reader_pool.reader(['en'], gpu=False) as reader:  # Adjust languages and GPU usage as needed
+            return split_into_words(reader.readtext(tile))
 
-    # Initialize EasyOCR reader
-    reader = easyocr.Reader(['en'], gpu=False)  # Adjust languages and GPU usage as needed
+    with instrumentation.span("ocr", engine="easyocr"):
+        words_data = tiled_ocr.read_words(prepared.gray, read_tile)
 
-    # Use EasyOCR to get OCR data including bounding boxes
-    ocr_result = reader.readtext(gray)
+    # Map the boxes back onto the original page so the collage crops at full resolution
+    words_data = prepared.to_original(words_data)
 
-    # Extract words and their bounding boxes
-    words_data = split_into_words(ocr_result)
+    ocr_cache.put(cache_key, words_data)
 
     return words_data
 
@@ -111,97 +138,28 @@ def create_mock_image(word):
     return image
 
 
-def create_juxtaposed_collage(ocr_data1, ocr_data2, author1_path, author2_path):
+def create_juxtaposed_collage(ocr_data1, ocr_data2, author1, author2,
+                              output_path="juxtaposed_word_collage_final.png", streamed=False, fmt="png",
+                              quality=collage_renderer.DEFAULT_QUALITY,
+                              compress_level=collage_renderer.DEFAULT_COMPRESS_LEVEL):
     """
     Create a collage juxtaposing the handwriting of two authors with original handwriting from images,
     including equal margins and a middle column with a computer-generated version of each letter.
 
-    :param ocr_data1: OCR data for author 1.
-    :param ocr_data2: OCR data for author 2.
-    :param author1_path: File path for author 1's image.
-    :param author2_path: File path for author 2's image.
+    :param ocr_data1: GlyphTable with the OCR data for author 1.
+    :param ocr_data2: GlyphTable with the OCR data for author 2.
+    :param author1: Page, encoded image bytes or file path for author 1's image.
+    :param author2: Page, encoded image bytes or file path for author 2's image.
+    :param output_path: File path the collage is saved to, or None to return it encoded in memory.
+        For the "tiles" format this is the directory of the pyramid.
+    :param streamed: If True, encode the collage row by row so that peak memory stays
+        proportional to a single letter row rather than the whole canvas (PNG only).
+    :param fmt: Output format, "png", "webp", "jpeg" or "tiles" for a deep-zoom tile pyramid
+        that can be panned and zoomed with constant memory.
+    :param quality: Quality of the lossy formats and of the pyramid tiles, 1-100.
+    :param compress_level: zlib compression level of PNG, 0-9.
+    :return: None if the collage was saved to output_path, otherwise a tuple with the encoded
+        collage and a downscaled preview for display, both as bytes.
     """
-    # Load the original images
-    img1 = cv2.imread(author1_path)
-    img2 = cv2.imread(author2_path)
-
-    # Convert to PIL.Image format for easier manipulation
-    img1 = Image.fromarray(cv2.cvtColor(img1, cv2.COLOR_BGR2RGB))
-    img2 = Image.fromarray(cv2.cvtColor(img2, cv2.COLOR_BGR2RGB))
-
-    # Dimensions for the collage
-    middle_column_width = 100
-    margin = 50
-
-    # Calculate the max height from both sets of OCR data
-    max_height = max([item["height"] for item in ocr_data1 + ocr_data2]) * 26
-
-    collage_width = img1.width + middle_column_width + margin * 2 + 4000
-    collage_height = max_height - 1800
-    collage = Image.new("RGB", (collage_width, collage_height), "white")
-
-    # Prepare font for the middle column letters
-    font = ImageFont.truetype("arial.ttf", 24 * 8)
-    draw = ImageDraw.Draw(collage)
-
-    # Function to extract and crop letter images from OCR data
-    def crop_word_images(ocr_data, img):
-        words = {}
-        for item in ocr_data:
-            word = item["word"].lower()
-            if word.isalpha():  # Filter only words
-                x, y, width, height = item["x"], item["y"], item["width"], item["height"]
-                cropped = img.crop((x, y, x + width + 10, y + height + 10))
-                words.setdefault(word[0], []).append(cropped)
-        return words
-
-    words1 = crop_word_images(ocr_data1, img1)
-    words2 = crop_word_images(ocr_data2, img2)
-
-    y_offset = 0
-    fixed_height = 300  # Fixed height for all word images
-    padding = 30  # Padding between images
-    for letter in "abcdefghijklmnopqrstuvwxyz":
-        # Assuming each letter's block height is max_height // 26
-        block_height = max_height // 26
-
-        # Center text in the middle of each block's height
-        word_img_x = collage_width / 2  # Adjust X as needed
-        word_img_y = y_offset  # Adjust Y for approximate vertical centering
-
-        x_offset_author2 = collage_width - margin
-
-        draw.text((word_img_x, word_img_y), letter.upper(), fill="black", font=font)
-
-        # Retrieve all images for this letter from both authors
-        author1_imgs = words1.get(letter,
-                                  [Image.new("RGB", (10, fixed_height), "grey")])  # Assuming minimal width if no image
-        author2_imgs = words2.get(letter, [Image.new("RGB", (10, fixed_height), "grey")])
-
-        # Starting x position for Author 1's words
-        x_offset_author1 = margin
-
-        # Paste all of Author 1's images for this letter side by side
-        for img in author1_imgs:
-            # Resize image to have a consistent height, maintaining aspect ratio
-            aspect_ratio = img.width / img.height
-            resized_width = int(fixed_height * aspect_ratio)
-            resized_img = img.resize((resized_width, fixed_height), Image.Resampling.LANCZOS)
-
-            collage.paste(resized_img, (x_offset_author1, y_offset))
-            x_offset_author1 += resized_width + padding  # Add padding for the next image
-
-        # Paste all of Author 2's images for this letter, right-justified
-        for img in reversed(author2_imgs):  # Reverse to start placing from right to left
-            # Resize image to have a consistent height, maintaining aspect ratio
-            aspect_ratio = img.width / img.height
-            resized_width = int(fixed_height * aspect_ratio)
-            resized_img = img.resize((resized_width, fixed_height), Image.Resampling.LANCZOS)
-
-            x_offset_author2 -= (resized_width + padding)  # Move left for the next image, include padding
-            collage.paste(resized_img, (x_offset_author2, y_offset))
-
-        # Increment the y_offset for the next row/letter
-        y_offset += fixed_height + padding
-
-    collage.save("juxtaposed_word_collage_final.png")
+    return collage_renderer.juxtapose(ocr_data1, ocr_data2, author1, author2, output_path, streamed, fmt, quality,
+                                      compress_level)
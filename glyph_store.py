@@ -0,0 +1,436 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import comparison
+import instrumentation
+import preprocessing
+import similarity
+
+
+# Identifies the descriptor layout on disk; a store written with another one must be rebuilt
+METHOD = "glyph-store-v1"
+MANIFEST_NAME = "manifest.json"
+
+# One row per stored glyph. The bitmap and descriptor of row i are row i of the bitmap and
+# descriptor files.
+GLYPH_DTYPE = np.dtype([
+    ("author", "<i4"),
+    ("sample", "<i4"),
+    ("letter", "<u4"),
+    ("conf", "<f4"),
+    ("x", "<i4"),
+    ("y", "<i4"),
+    ("width", "<i4"),
+    ("height", "<i4"),
+])
+
+_FILES = {
+    "glyphs": ("glyphs.bin", GLYPH_DTYPE),
+    "bitmaps": ("bitmaps.u8", np.uint8),
+    "descriptors": ("descriptors.f32", np.float32),
+}
+
+# The glyphs of one writer and letter are a contiguous segment of the index
+SEGMENT_DTYPE = np.dtype([
+    ("letter", "<u4"),
+    ("author", "<i4"),
+    ("start", "<i8"),
+    ("end", "<i8"),
+])
+_INDEX_FILES = {
+    "rows": ("index_rows.i4", np.int32),
+    "descriptors": ("index_descriptors.f32", np.float32),
+    "norms": ("index_norms.f32", np.float32),
+    "segments": ("index_segments.bin", SEGMENT_DTYPE),
+    "means": ("index_means.f32", np.float32),
+}
+
+# Stored glyphs are compared in blocks of about this many, which bounds the size of the
+# distance matrices of a search regardless of the size of the store
+SEARCH_BLOCK_COLUMNS = 65536
+
+# Number of writers a search compares glyph by glyph after shortlisting them by their mean
+# glyphs
+SHORTLIST = 32
+
+
+def _descriptor_size():
+    bitmap = np.zeros((1, similarity.BITMAP_SIZE, similarity.BITMAP_SIZE), dtype=np.float32)
+    return similarity.describe(bitmap, np.ones((1, 4))).shape[1]
+
+
+def _select_letters(table, letters, max_per_letter):
+    """
+    Indices of the alphabetic glyphs of a table, grouped by letter, at most max_per_letter
+    of each in reading order.
+    """
+    initials = table.initials()
+    mask = table.alpha_mask() & np.isin(initials, np.array([ord(letter) for letter in letters], dtype=np.uint32))
+    indices = np.flatnonzero(mask)
+    order = indices[np.argsort(initials[indices], kind="stable")]
+    # Position of every glyph within its letter, to cap the glyphs per letter
+    sorted_initials = initials[order]
+    starts = np.flatnonzero(np.r_[True, sorted_initials[1:] != sorted_initials[:-1]]) if len(order) else order
+    position = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    return order[position < max_per_letter]
+
+
+class GlyphStore:
+    """
+    A corpus of normalised letter glyphs of many writers, kept in memory-mapped files.
+
+    Every glyph added to the store is cropped once into a similarity.BITMAP_SIZE bitmap and
+    described with similarity.describe(), and its author, letter, confidence and source box
+    are appended to flat files in the store directory. The nearest-writer index keeps the
+    descriptors sorted by letter and author, so a search reads only the letters of the
+    sample and compares them to every writer with a few matrix products.
+
+    A store has a single writer; any number of processes can search it at the same time.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._maps = None
+        self._index = None
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = self._read_manifest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_manifest(self):
+        try:
+            with open(self._path(MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return {
+                "method": METHOD,
+                "bitmap_size": similarity.BITMAP_SIZE,
+                "descriptor_size": _descriptor_size(),
+                "count": 0,
+                "authors": [],
+                "samples": [],
+                "index": None,
+            }
+        if manifest["method"] != METHOD or manifest["bitmap_size"] != similarity.BITMAP_SIZE:
+            raise ValueError(f"Glyph store {self.directory} was written by {manifest['method']}, rebuild it")
+        return manifest
+
+    def _write_manifest(self):
+        # Atomic, so searches never see a count ahead of the data files
+        tmp_path = self._path(f"{MANIFEST_NAME}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self._path(MANIFEST_NAME))
+
+    def __len__(self):
+        return self.manifest["count"]
+
+    @property
+    def authors(self):
+        return list(self.manifest["authors"])
+
+    def _shape(self, name, count):
+        if name == "bitmaps":
+            return count, self.manifest["bitmap_size"], self.manifest["bitmap_size"]
+        if name == "descriptors":
+            return count, self.manifest["descriptor_size"]
+        return (count,)
+
+    def _memmap(self, file_name, dtype, shape):
+        if not shape[0]:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self._path(file_name), dtype=dtype, mode="r", shape=shape)
+
+    def arrays(self):
+        """
+        Memory-map the stored glyphs.
+
+        :return: A dictionary with the "glyphs" records, the uint8 "bitmaps" (ink coverage
+            times 255) and the "descriptors" of the first len(self) glyphs.
+        """
+        if self._maps is None or len(self._maps["glyphs"]) != len(self):
+            self._maps = {
+                name: self._memmap(file_name, dtype, self._shape(name, len(self)))
+                for name, (file_name, dtype) in _FILES.items()
+            }
+        return self._maps
+
+    def add(self, page, table, author, source=None, letters=similarity.LETTERS,
+            max_per_letter=similarity.MAX_GLYPHS_PER_LETTER):
+        """
+        Add the letters of one handwriting sample to the store.
+
+        :param page: The Page the glyphs were read from.
+        :param table: A GlyphTable of characters, e.g. from split_into_characters().
+        :param author: Name of the writer.
+        :param source: Optional description of the sample, defaults to the page's source.
+        :param letters: Letters to store.
+        :param max_per_letter: Maximum number of glyphs stored per letter, in reading order.
+        :return: Number of glyphs added.
+        """
+        with instrumentation.span("store_add", author=author):
+            selected = table[_select_letters(table, letters, max_per_letter)]
+            boxes = selected.boxes()
+            bitmaps = similarity.normalise_bitmaps(preprocessing.ink_mask(page.gray), boxes)
+            descriptors = similarity.describe(bitmaps, boxes)
+
+            with self._lock:
+                if author not in self.manifest["authors"]:
+                    self.manifest["authors"].append(author)
+                self.manifest["samples"].append({
+                    "author": author,
+                    "source": str(source or page.source or ""),
+                    "page": page.key,
+                })
+
+                records = np.zeros(len(selected), dtype=GLYPH_DTYPE)
+                records["author"] = self.manifest["authors"].index(author)
+                records["sample"] = len(self.manifest["samples"]) - 1
+                records["letter"] = selected.initials()
+                records["conf"] = selected.records["conf"]
+                for field in ("x", "y", "width", "height"):
+                    records[field] = selected.records[field]
+                columns = {
+                    "glyphs": records,
+                    "bitmaps": np.round(bitmaps * 255).astype(np.uint8),
+                    "descriptors": descriptors.astype(np.float32),
+                }
+
+                # Rows beyond the count in the manifest are ignored, so a crash in between
+                # leaves a consistent store
+                for name, (file_name, dtype) in _FILES.items():
+                    path = self._path(file_name)
+                    with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                        f.truncate(np.dtype(dtype).itemsize * int(np.prod(self._shape(name, len(self)))))
+                        f.seek(0, os.SEEK_END)
+                        f.write(np.ascontiguousarray(columns[name]).tobytes())
+                self.manifest["count"] += len(records)
+                self._write_manifest()
+        return len(records)
+
+    def build_index(self):
+        """
+        Build the nearest-writer index over all stored glyphs.
+
+        The descriptors are copied in (letter, author) order together with their squared
+        norms, so the glyphs of one writer and letter form a contiguous segment. Each
+        segment is listed with its mean descriptor, which the search uses to shortlist
+        writers before comparing glyphs.
+        """
+        with instrumentation.span("store_index", glyphs=len(self)), self._lock:
+            arrays = self.arrays()
+            glyphs = arrays["glyphs"]
+            rows = np.lexsort((glyphs["author"], glyphs["letter"])).astype(np.int32)
+            letters, authors = np.asarray(glyphs["letter"])[rows], np.asarray(glyphs["author"])[rows]
+            changes = np.flatnonzero((letters[1:] != letters[:-1]) | (authors[1:] != authors[:-1])) + 1
+            segment_starts = np.r_[0, changes] if len(rows) else np.zeros(0, dtype=np.int64)
+            segments = np.zeros(len(segment_starts), dtype=SEGMENT_DTYPE)
+            segments["letter"] = letters[segment_starts]
+            segments["author"] = authors[segment_starts]
+            segments["start"] = segment_starts
+            segments["end"] = np.r_[segment_starts[1:], len(rows)]
+
+            files = {name: open(self._path(f"{file_name}.tmp"), "wb") for name, (file_name, _) in _INDEX_FILES.items()}
+            try:
+                files["rows"].write(rows.tobytes())
+                files["segments"].write(segments.tobytes())
+                # Gather the descriptors a block of whole segments at a time, so the store
+                # never has to fit into memory
+                for first, last in _segment_blocks(segments):
+                    low, high = segments["start"][first], segments["end"][last - 1]
+                    descriptors = np.asarray(arrays["descriptors"][rows[low:high]], dtype=np.float32)
+                    counts = (segments["end"][first:last] - segments["start"][first:last])[:, None]
+                    files["descriptors"].write(np.ascontiguousarray(descriptors).tobytes())
+                    files["norms"].write(np.square(descriptors).sum(axis=1).astype(np.float32).tobytes())
+                    means = np.add.reduceat(descriptors, segments["start"][first:last] - low, axis=0) / counts
+                    files["means"].write(means.astype(np.float32).tobytes())
+            finally:
+                for f in files.values():
+                    f.close()
+            for file_name, _ in _INDEX_FILES.values():
+                os.replace(self._path(f"{file_name}.tmp"), self._path(file_name))
+
+            letter_ranges = {}
+            for letter in np.unique(segments["letter"]):
+                letter_ranges[chr(letter)] = [int(np.searchsorted(segments["letter"], letter)),
+                                              int(np.searchsorted(segments["letter"], letter, side="right"))]
+            self.manifest["index"] = {"count": len(self), "segments": len(segments), "letters": letter_ranges}
+            self._write_manifest()
+            self._index = None
+
+    def _index_arrays(self):
+        info = self.manifest["index"]
+        if info is None or info["count"] != len(self):
+            self.build_index()
+            info = self.manifest["index"]
+        if self._index is None or len(self._index["rows"]) != info["count"]:
+            shapes = {
+                "rows": (info["count"],),
+                "descriptors": (info["count"], self.manifest["descriptor_size"]),
+                "norms": (info["count"],),
+                "segments": (info["segments"],),
+                "means": (info["segments"], self.manifest["descriptor_size"]),
+            }
+            self._index = {
+                name: self._memmap(file_name, dtype, shapes[name])
+                for name, (file_name, dtype) in _INDEX_FILES.items()
+            }
+        return self._index
+
+    def search(self, page, table, top_k=10, letters=similarity.LETTERS, exclude=None, shortlist=SHORTLIST):
+        """
+        Find the stored writers whose letters are closest to a new sample.
+
+        Writers are first ranked by the distance between the mean descriptors of the
+        sample's letters and theirs. The best shortlist writers are then scored like
+        similarity.compare(): per letter by the symmetric nearest-glyph distance between the
+        sample's and the writer's glyphs, weighted by the number of glyphs compared.
+
+        :param page: The Page of the sample.
+        :param table: A GlyphTable of the sample's characters.
+        :param top_k: Number of writers returned.
+        :param letters: Letters compared.
+        :param exclude: Optional author names to leave out, e.g. the sample's own writer.
+        :param shortlist: Number of writers compared glyph by glyph, None compares every writer.
+        :return: A list of {"author", "score", "letters"} dictionaries with the best score
+            first, where "letters" is the number of letters the sample and the writer share.
+        """
+        with instrumentation.span("store_search", glyphs=len(self)):
+            index = self._index_arrays()
+            letter_ranges = self.manifest["index"]["letters"]
+            query = {letter: descriptors for letter, descriptors in
+                     similarity.letter_descriptors(page, table, letters).items() if letter in letter_ranges}
+
+            num_authors = len(self.manifest["authors"])
+            allowed = np.ones(num_authors, dtype=bool)
+            for name in exclude or ():
+                if name in self.manifest["authors"]:
+                    allowed[self.manifest["authors"].index(name)] = False
+
+            if shortlist is not None and shortlist < allowed.sum():
+                with instrumentation.span("store_shortlist"):
+                    coarse = _Scores(num_authors)
+                    for letter, descriptors in query.items():
+                        segments = index["segments"][slice(*letter_ranges[letter])]
+                        means = index["means"][slice(*letter_ranges[letter])]
+                        distance = np.sqrt(np.square(means - descriptors.mean(axis=0)).sum(axis=1))
+                        coarse.add(segments["author"], distance, segments["end"] - segments["start"], len(descriptors))
+                    allowed &= np.isin(np.arange(num_authors), coarse.best(allowed, shortlist))
+
+            scores = _Scores(num_authors)
+            for letter, descriptors in query.items():
+                segments = index["segments"][slice(*letter_ranges[letter])]
+                segments = segments[allowed[segments["author"]]]
+                distance = _set_distances(index, segments, descriptors)
+                scores.add(segments["author"], distance, segments["end"] - segments["start"], len(descriptors))
+            return [
+                {"author": self.manifest["authors"][i], "score": float(scores.score(i)), "letters": int(scores.shared[i])}
+                for i in scores.best(allowed, top_k)
+            ]
+
+
+class _Scores:
+    """Per-writer similarity summed over letters, weighted like similarity.compare()."""
+
+    def __init__(self, num_authors):
+        self.weighted = np.zeros(num_authors, dtype=np.float64)
+        self.weights = np.zeros(num_authors, dtype=np.float64)
+        self.shared = np.zeros(num_authors, dtype=np.int64)
+
+    def add(self, authors, distance, counts, query_count):
+        weights = np.minimum(counts, query_count)
+        self.weighted[authors] += np.exp(-distance / similarity.DISTANCE_SCALE) * weights
+        self.weights[authors] += weights
+        self.shared[authors] += 1
+
+    def score(self, author):
+        return self.weighted[author] / self.weights[author]
+
+    def best(self, allowed, count):
+        candidates = np.flatnonzero(allowed & (self.weights > 0))
+        scores = self.weighted[candidates] / self.weights[candidates]
+        return candidates[np.argsort(-scores, kind="stable")[:count]]
+
+
+def _segment_blocks(segments, block_rows=SEARCH_BLOCK_COLUMNS):
+    """Split segments into consecutive (first, last) ranges of about block_rows glyphs each."""
+    ends = np.cumsum(segments["end"] - segments["start"])
+    first = 0
+    while first < len(segments):
+        done = ends[first - 1] if first else 0
+        last = max(int(np.searchsorted(ends, done + block_rows, side="right")), first + 1)
+        yield first, last
+        first = last
+
+
+def _set_distances(index, segments, query):
+    """
+    Set distance between the sample's glyphs of one letter and the glyphs of several writers.
+
+    :param index: The memory-mapped index arrays.
+    :param segments: The index segments of the writers' glyphs of that letter.
+    :param query: The sample's descriptors of that letter.
+    :return: An array with the similarity.set_distance() of every segment.
+    """
+    counts = segments["end"] - segments["start"]
+    query = query.astype(np.float32)
+    query_norms = np.square(query).sum(axis=1)[:, None]
+
+    # Closest glyph of each writer for every sample glyph, and the summed distance from
+    # every writer glyph to its closest sample glyph
+    query_to_writer = np.empty((len(query), len(segments)), dtype=np.float32)
+    writer_to_query = np.empty(len(segments), dtype=np.float64)
+    for first, last in _segment_blocks(segments):
+        block_counts = counts[first:last]
+        offsets = np.r_[0, np.cumsum(block_counts)[:-1]]
+        # Segments of shortlisted writers are scattered, gather their rows of the index
+        columns = np.repeat(segments["start"][first:last] - offsets, block_counts) + np.arange(block_counts.sum())
+        squared = query_norms + index["norms"][columns][None, :] - 2 * query @ index["descriptors"][columns].T
+        distances = np.sqrt(np.maximum(squared, 0))
+        query_to_writer[:, first:last] = np.minimum.reduceat(distances, offsets, axis=1)
+        writer_to_query[first:last] = np.add.reduceat(distances.min(axis=0), offsets)
+    return (query_to_writer.mean(axis=0) + writer_to_query / counts) / 2
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Store writers' letters and find the closest writers of a sample.")
+    parser.add_argument("--store", required=True, help="Directory of the glyph store")
+    parser.add_argument("--engine", choices=["pytesseract", "easyocr"], default="pytesseract")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="Add the letters of handwriting samples to the store")
+    add.add_argument("--author", required=True, help="Writer of the samples")
+    add.add_argument("images", nargs="+")
+    search = commands.add_parser("search", help="Rank the stored writers by similarity to a sample")
+    search.add_argument("--top", type=int, default=10, help="Number of writers listed")
+    search.add_argument("image")
+    args = parser.parse_args(argv)
+
+    store = GlyphStore(args.store)
+    module = comparison.load_engine(args.engine, "letters")
+    if args.command == "add":
+        pages, ocr_data = comparison.extract_authors(module.extract_text_and_boxes, args.images)
+        added = sum(store.add(page, table, args.author) for page, table in zip(pages, ocr_data))
+        store.build_index()
+        print(f"Added {added} glyphs of {args.author}, {len(store)} glyphs of {len(store.authors)} writers stored")
+        return 0
+
+    pages, ocr_data = comparison.extract_authors(module.extract_text_and_boxes, [args.image])
+    start = time.perf_counter()
+    matches = store.search(pages[0], ocr_data[0], args.top)
+    elapsed = time.perf_counter() - start
+    for rank, match in enumerate(matches, 1):
+        print(f"{rank:3d}. {match['author']}: {match['score']:.3f} over {match['letters']} letters")
+    print(f"Searched {len(store)} glyphs of {len(store.authors)} writers in {elapsed * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,303 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+
+
+# One row per glyph; the text of row i is text[text_start[i]:text_end[i]]
+RECORD_DTYPE = np.dtype([
+    ("x", "<i4"),
+    ("y", "<i4"),
+    ("width", "<i4"),
+    ("height", "<i4"),
+    ("conf", "<f4"),
+    ("text_start", "<i4"),
+    ("text_end", "<i4"),
+])
+BOX_FIELDS = ["x", "y", "width", "height"]
+# Identifies how fractional boxes are rounded in OCR cache keys; bump when it changes
+BOX_ROUNDING = "outward-v1"
+
+
+class GlyphTable:
+    """
+    Columnar storage for OCR glyph records (letters or words).
+
+    Boxes and confidences live in a NumPy structured array and the recognised text of all
+    glyphs is packed into a single string, so a dense page costs a handful of arrays instead
+    of tens of thousands of small dictionaries. Iterating a table still yields dictionaries
+    in the format the OCR modules used to return.
+    """
+
+    def __init__(self, records, text, text_field="letter"):
+        self.records = records
+        self.text = text
+        self.text_field = text_field
+
+    @classmethod
+    def from_columns(cls, texts, x, y, width, height, conf, text_field="letter"):
+        """
+        Build a table from per-glyph columns.
+
+        :param texts: A list of recognised strings.
+        :param x: Left edges of the boxes.
+        :param y: Top edges of the boxes.
+        :param width: Widths of the boxes.
+        :param height: Heights of the boxes.
+        :param conf: Confidence of each glyph.
+        :param text_field: Name of the text key in the dictionaries yielded by the table.
+        :return: A GlyphTable.
+        """
+        lengths = np.fromiter((len(text) for text in texts), dtype=np.int32, count=len(texts))
+        return cls.from_packed("".join(texts), lengths, x, y, width, height, conf, text_field)
+
+    @classmethod
+    def from_packed(cls, text, lengths, x, y, width, height, conf, text_field="letter"):
+        """
+        Build a table from text that is already packed into one string.
+
+        :param text: The text of all glyphs, concatenated.
+        :param lengths: Number of characters of each glyph in text.
+        :param x: Left edges of the boxes.
+        :param y: Top edges of the boxes.
+        :param width: Widths of the boxes.
+        :param height: Heights of the boxes.
+        :param conf: Confidence of each glyph.
+        :param text_field: Name of the text key in the dictionaries yielded by the table.
+        :return: A GlyphTable. Fractional boxes, e.g. from EasyOCR, are widened to the pixels
+            they touch.
+        """
+        lengths = np.asarray(lengths, dtype=np.int32)
+        records = np.zeros(len(lengths), dtype=RECORD_DTYPE)
+        if len(lengths):
+            x, y, width, height = (np.asarray(column, dtype=np.float64) for column in (x, y, width, height))
+            # Floor the origin and ceil the far edge, truncating both would cut off the last pixels
+            left, top = np.floor(x), np.floor(y)
+            columns = [left, top, np.ceil(x + width) - left, np.ceil(y + height) - top, conf]
+            for field, column in zip(BOX_FIELDS + ["conf"], columns):
+                records[field] = np.asarray(column, dtype=np.float64)
+        records["text_end"] = np.cumsum(lengths)
+        records["text_start"] = records["text_end"] - lengths
+        return cls(records, text, text_field)
+
+    @classmethod
+    def empty(cls, text_field="letter"):
+        return cls(np.zeros(0, dtype=RECORD_DTYPE), "", text_field)
+
+    @classmethod
+    def concat(cls, tables, text_field=None):
+        """
+        Concatenate several tables into one.
+
+        :param tables: A list of GlyphTables.
+        :param text_field: Text key of the result, defaults to that of the first table.
+        :return: A GlyphTable.
+        """
+        tables = list(tables)
+        if not tables:
+            return cls.empty(text_field or "letter")
+        records, texts = [], []
+        offset = 0
+        for table in tables:
+            if not len(table):
+                continue
+            # Re-base the text offsets onto the joined text buffer of the result
+            low, high = table.records["text_start"].min(), table.records["text_end"].max()
+            part = table.records.copy()
+            part["text_start"] += offset - low
+            part["text_end"] += offset - low
+            records.append(part)
+            texts.append(table.text[low:high])
+            offset += high - low
+        if not records:
+            return cls.empty(text_field or tables[0].text_field)
+        text = "".join(texts)
+        return cls(np.concatenate(records), text, text_field or tables[0].text_field)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        """Select rows by index array or boolean mask; the text buffer is shared."""
+        if isinstance(index, (int, np.integer)):
+            return self.row(int(index))
+        return GlyphTable(self.records[index], self.text, self.text_field)
+
+    def __iter__(self):
+        for i in range(len(self.records)):
+            yield self.row(i)
+
+    def __add__(self, other):
+        return GlyphTable.concat([self, other])
+
+    def row(self, i):
+        """
+        Return one glyph as a dictionary.
+
+        :param i: Row index.
+        :return: A dictionary with the text field, x, y, width, height and conf.
+        """
+        record = self.records[i]
+        return {
+            self.text_field: self.text[record["text_start"]:record["text_end"]],
+            "x": int(record["x"]),
+            "y": int(record["y"]),
+            "width": int(record["width"]),
+            "height": int(record["height"]),
+            "conf": float(record["conf"]),
+        }
+
+    def to_dicts(self):
+        """Return the table as a list of dictionaries, e.g. for JSON output."""
+        return list(self)
+
+    def texts(self):
+        """Return the recognised text of every glyph."""
+        return [self.text[start:end] for start, end in zip(self.records["text_start"], self.records["text_end"])]
+
+    def boxes(self):
+        """Return an (n, 4) array of x, y, width, height."""
+        return np.stack([self.records[field] for field in BOX_FIELDS], axis=1) if len(self) else \
+            np.zeros((0, 4), dtype=np.int32)
+
+    def max_height(self):
+        """Height of the tallest box, 0 for an empty table."""
+        return int(self.records["height"].max()) if len(self) else 0
+
+    def _code_points(self):
+        return np.frombuffer(self.text.encode("utf-32-le"), dtype="<u4")
+
+    def initials(self):
+        """
+        Lower-cased first character of every glyph as an array of code points.
+
+        :return: A uint32 array with 0 for glyphs without text.
+        """
+        code_points = self._code_points()
+        starts, ends = self.records["text_start"], self.records["text_end"]
+        initials = np.zeros(len(self), dtype=np.uint32)
+        has_text = ends > starts
+        initials[has_text] = code_points[starts[has_text]]
+
+        # str.lower() is only evaluated once per distinct character
+        unique, inverse = np.unique(initials, return_inverse=True)
+        lowered = np.array([ord(chr(c).lower()[0]) if c else 0 for c in unique], dtype=np.uint32)
+        return lowered[inverse]
+
+    def alpha_mask(self):
+        """
+        Boolean mask of glyphs whose whole text is alphabetic, like str.isalpha().
+
+        :return: A boolean array.
+        """
+        if not len(self):
+            return np.zeros(0, dtype=bool)
+        code_points = self._code_points()
+        unique, inverse = np.unique(code_points, return_inverse=True)
+        is_alpha = np.array([chr(c).isalpha() for c in unique], dtype=bool)[inverse]
+
+        # Count alphabetic characters per glyph with a prefix sum over the packed text
+        alpha_prefix = np.concatenate([[0], np.cumsum(is_alpha)])
+        starts, ends = self.records["text_start"], self.records["text_end"]
+        return (ends > starts) & (alpha_prefix[ends] - alpha_prefix[starts] == ends - starts)
+
+    def group_by_initial(self, letters=None):
+        """
+        Group the boxes of alphabetic glyphs by their lower-cased first letter.
+
+        :param letters: Optional collection of letters to keep, e.g. "abc...z".
+        :return: A dictionary with letters as keys and (n, 4) box arrays as values, in reading order.
+        """
+        boxes = self.boxes()
+        return {letter: boxes[indices] for letter, indices in self.group_indices_by_initial(letters).items()}
+
+    def group_indices_by_initial(self, letters=None):
+        """
+        Group the row indices of alphabetic glyphs by their lower-cased first letter.
+
+        :param letters: Optional collection of letters to keep, e.g. "abc...z".
+        :return: A dictionary with letters as keys and index arrays as values, in reading order.
+        """
+        mask = self.alpha_mask()
+        initials = self.initials()
+        if letters is not None:
+            mask &= np.isin(initials, np.array([ord(letter) for letter in letters], dtype=np.uint32))
+        indices = np.flatnonzero(mask)
+        if not len(indices):
+            return {}
+
+        # Stable sort keeps the original order of glyphs within each letter
+        order = indices[np.argsort(initials[indices], kind="stable")]
+        sorted_initials = initials[order]
+        boundaries = np.flatnonzero(np.diff(sorted_initials)) + 1
+        return {
+            chr(sorted_initials[group[0]]): order[group]
+            for group in np.split(np.arange(len(order)), boundaries)
+        }
+
+    def to_bytes(self):
+        """
+        Serialise the table into a compact compressed byte string.
+
+        :return: The compressed bytes.
+        """
+        records = self.records.copy()
+        if len(records):
+            # Store the text of the selected rows only, re-based to start at 0
+            base = records["text_start"].min()
+            text = self.text[base:records["text_end"].max()]
+            records["text_start"] -= base
+            records["text_end"] -= base
+        else:
+            text = ""
+        header = json.dumps({"text_field": self.text_field, "count": len(records)}).encode("utf-8")
+        payload = struct.pack("<I", len(header)) + header + records.tobytes() + text.encode("utf-8")
+        return zlib.compress(payload)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Inverse of to_bytes().
+
+        :param data: Bytes produced by to_bytes().
+        :return: A GlyphTable.
+        """
+        payload = zlib.decompress(data)
+        (header_length,) = struct.unpack_from("<I", payload)
+        header = json.loads(payload[4:4 + header_length].decode("utf-8"))
+        offset = 4 + header_length
+        records_length = header["count"] * RECORD_DTYPE.itemsize
+        records = np.frombuffer(payload[offset:offset + records_length], dtype=RECORD_DTYPE).copy()
+        text = payload[offset + records_length:].decode("utf-8")
+        return cls(records, text, header["text_field"])
+
+
+def split_uniform(words):
+    """
+    Split word boxes into equally wide character boxes.
+
+    Every character inherits the height and confidence of the word it belongs to.
+
+    :param words: A GlyphTable of words.
+    :return: A GlyphTable of characters, in reading order.
+    """
+    records = words.records
+    num_chars = records["text_end"] - records["text_start"]
+    width_per_char = records["width"] // np.maximum(num_chars, 1)
+
+    # Index of the parent word and position inside that word, for every character
+    word_index = np.repeat(np.arange(len(records)), num_chars)
+    char_index = np.arange(len(word_index)) - np.repeat(np.cumsum(num_chars) - num_chars, num_chars)
+    parents = records[word_index]
+
+    text = "".join(words.texts())
+    return GlyphTable.from_packed(
+        text,
+        np.ones(len(text), dtype=np.int32),
+        parents["x"] + char_index * width_per_char[word_index],
+        parents["y"],
+        width_per_char[word_index],
+        parents["height"],
+        parents["conf"],  # Confidence of the whole text element
+    )
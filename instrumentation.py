@@ -0,0 +1,143 @@
+import contextvars
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+_current_trace = contextvars.ContextVar("ocr_trace", default=None)
+_hooks = []
+
+
+def max_rss_mb():
+    """
+    Peak resident set size of the process so far.
+
+    :return: The peak in MB, or None where the resource module is unavailable.
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux and the BSDs report kilobytes
+    return max_rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+class Trace:
+    """
+    Timings of the pipeline stages of one comparison.
+
+    Spans may be recorded from several threads, e.g. the concurrent OCR passes of both authors.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.started = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.spans.append(record)
+
+    def totals(self):
+        """
+        Total time and number of calls per stage.
+
+        :return: A dictionary mapping stage names to {"seconds": ..., "calls": ...}, in the
+            order the stages were first seen.
+        """
+        totals = {}
+        with self._lock:
+            for record in self.spans:
+                total = totals.setdefault(record["name"], {"seconds": 0.0, "calls": 0})
+                total["seconds"] += record["duration_s"]
+                total["calls"] += 1
+        return totals
+
+    def to_dict(self):
+        with self._lock:
+            spans = list(self.spans)
+        return {"name": self.name, "started": self.started, "spans": spans, "totals": self.totals()}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a trace serialised with to_dict(), e.g. one recorded in another process."""
+        restored = cls(data["name"])
+        restored.started = data["started"]
+        restored.spans = list(data["spans"])
+        return restored
+
+    def to_json(self, **kwargs):
+        """Serialise the trace, including every span and the per-stage totals, as JSON."""
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+@contextmanager
+def trace(name=None):
+    """
+    Collect the spans recorded in this context, including those of worker threads started
+    with contextvars.copy_context().
+
+    :param name: Optional name of the traced operation.
+    :return: A context manager yielding the Trace.
+    """
+    current = Trace(name)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time one pipeline stage.
+
+    The span is added to the active trace, if any, and passed to every registered hook.
+    Without a trace or hooks this costs a single context variable lookup.
+
+    :param name: Stage name, e.g. "decode", "ocr" or "encode".
+    :param attributes: Extra JSON-serialisable details stored with the span.
+    """
+    current = _current_trace.get()
+    if current is None and not _hooks:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = {
+            "name": name,
+            "start_s": start,
+            "duration_s": time.perf_counter() - start,
+            "thread": threading.current_thread().name,
+            "max_rss_mb": max_rss_mb(),
+        }
+        record.update(attributes)
+        if current is not None:
+            current.add(record)
+        for hook in list(_hooks):
+            hook(record)
+
+
+def add_hook(hook):
+    """
+    Register a function that is called with every finished span, e.g. to feed a metrics system.
+
+    :param hook: A function taking the span record dictionary.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Unregister a hook added with add_hook()."""
+    _hooks.remove(hook)
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import zlib
+
+import glyph_table
+from glyph_table import GlyphTable
+
+
+# Where cached OCR results live and how much disk they may use before the least
+# recently used entries are evicted.
+CACHE_DIR = os.environ.get(
+    "OCR_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ocr_handwriting")
+)
+MAX_BYTES = int(os.environ.get("OCR_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+ENABLED = os.environ.get("OCR_CACHE_DISABLE", "") == ""
+
+_lock = threading.Lock()
+
+
+def make_key(page, engine, mode, params=None):
+    """
+    Build a content-addressed cache key for an OCR run.
+
+    :param page: The Page that is fed to the OCR engine.
+    :param engine: Name of the OCR engine, e.g. "pytesseract" or "easyocr".
+    :param mode: Comparison mode, "letters" or "words".
+    :param params: A JSON-serialisable dictionary of engine settings that affect the result.
+    :return: A hex digest identifying the OCR result.
+    """
+    digest = hashlib.sha256()
+    digest.update(page.key.encode())
+    digest.update(json.dumps([engine, mode, glyph_table.BOX_ROUNDING, params or {}], sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def _path(key):
+    return os.path.join(CACHE_DIR, key[:2], key + ".glyphs")
+
+
+def get(key):
+    """
+    Look up a cached OCR result.
+
+    :param key: A key produced by make_key().
+    :return: The cached GlyphTable, or None on a miss.
+    """
+    if not ENABLED:
+        return None
+    path = _path(key)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)  # Mark as recently used for LRU eviction
+        return GlyphTable.from_bytes(data)
+    except (OSError, ValueError, struct.error, zlib.error):
+        return None
+
+
+def put(key, table):
+    """
+    Store an OCR result and evict old entries if the cache grew beyond MAX_BYTES.
+
+    :param key: A key produced by make_key().
+    :param table: The GlyphTable returned by the OCR module.
+    """
+    if not ENABLED:
+        return
+    path = _path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(table.to_bytes())
+        os.replace(tmp_path, path)  # Atomic, so concurrent readers never see partial files
+        evict()
+    except OSError:
+        pass  # The cache is an optimisation only, never fail an OCR run because of it
+
+
+def evict(max_bytes=None):
+    """
+    Remove least recently used entries until the cache fits into max_bytes.
+
+    :param max_bytes: Size limit in bytes, defaults to MAX_BYTES.
+    """
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    with _lock:
+        entries = []
+        total = 0
+        for root, _, files in os.walk(CACHE_DIR):
+            for name in files:
+                if not name.endswith(".glyphs"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+def clear():
+    """Remove every cached OCR result."""
+    evict(0)
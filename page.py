@@ -0,0 +1,100 @@
+import hashlib
+
+import cv2
+import numpy as np
+
+
+def content_key(img):
+    """
+    Identify a decoded image by its pixels.
+
+    :param img: A decoded image as a NumPy array.
+    :return: A hex digest.
+    """
+    digest = hashlib.sha256()
+    digest.update(str(img.shape).encode())
+    digest.update(str(img.dtype).encode())
+    digest.update(np.ascontiguousarray(img).data)
+    return digest.hexdigest()
+
+
+class Page:
+    """
+    A handwriting sample decoded exactly once.
+
+    The colour view is the array produced by OpenCV, the grayscale view is derived from
+    it on first use. Both are read-only so they can be shared between the OCR and the
+    collage code without defensive copies.
+    """
+
+    def __init__(self, bgr, source=None):
+        bgr.flags.writeable = False
+        self.bgr = bgr
+        self.source = source
+        self._gray = None
+        self._key = None
+
+    @classmethod
+    def from_bytes(cls, data, source=None):
+        """
+        Decode an encoded image (PNG, JPEG, WebP, ...) held in memory.
+
+        :param data: The encoded image bytes, e.g. from a Streamlit upload.
+        :param source: Optional description of where the bytes came from.
+        :return: A Page.
+        """
+        bgr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if bgr is None:
+            raise ValueError(f"Could not decode image{f' {source}' if source else ''}")
+        return cls(bgr, source)
+
+    @classmethod
+    def from_path(cls, path):
+        """
+        Decode an image file.
+
+        :param path: The path to the image file.
+        :return: A Page.
+        """
+        bgr = cv2.imread(str(path))
+        if bgr is None:
+            raise ValueError(f"Could not read image {path}")
+        return cls(bgr, str(path))
+
+    @classmethod
+    def load(cls, image):
+        """
+        Turn whatever the caller holds into a Page.
+
+        :param image: A Page, encoded image bytes or a path to an image file.
+        :return: A Page.
+        """
+        if isinstance(image, cls):
+            return image
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            return cls.from_bytes(bytes(image))
+        return cls.from_path(image)
+
+    @property
+    def gray(self):
+        """Grayscale view of the page, computed once."""
+        if self._gray is None:
+            gray = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY)
+            gray.flags.writeable = False
+            self._gray = gray
+        return self._gray
+
+    @property
+    def key(self):
+        """Content hash of the decoded pixels, computed once."""
+        if self._key is None:
+            self._key = content_key(self.bgr)
+        return self._key
+
+    @property
+    def width(self):
+        return self.bgr.shape[1]
+
+    @property
+    def height(self):
+        return self.bgr.shape[0]
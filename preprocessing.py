@@ -0,0 +1,231 @@
+import os
+
+import cv2
+import numpy as np
+
+from glyph_table import GlyphTable
+
+
+# Identifies the preprocessing algorithm in OCR cache keys; bump when results change
+METHOD = "preprocess-v1"
+
+# Which steps run before OCR. Rescaling is on by default; deskewing and binarising help
+# with phone photos but cost time on clean scans.
+SCALE = os.environ.get("OCR_PREPROCESS_SCALE", "1") != "0"
+DESKEW = os.environ.get("OCR_PREPROCESS_DESKEW", "0") != "0"
+BINARIZE = os.environ.get("OCR_PREPROCESS_BINARIZE", "0") != "0"
+
+# Median height of the ink components (roughly between x-height and cap height) that each
+# engine reads best, as (lowest, target, highest) in pixels. Pages within the range are
+# left alone, other pages are rescaled to the target.
+TEXT_HEIGHT_RANGES = {
+    "tesseract": (20, 30, 40),
+    "easyocr": (24, 40, 64),
+}
+MAX_UPSCALE = 2.0
+
+# Text height is estimated on a copy no larger than this, components smaller than
+# MIN_COMPONENT_HEIGHT pixels there are treated as noise
+ANALYSIS_SIZE = 1600
+MIN_COMPONENT_HEIGHT = 3
+MIN_COMPONENTS = 10
+
+# Skew angles tried by the deskew step, in degrees
+MAX_SKEW = 5.0
+SKEW_STEP = 0.25
+
+
+def settings(engine):
+    """
+    Preprocessing settings that affect the OCR result of an engine, for cache keys.
+
+    :param engine: "tesseract" or "easyocr".
+    :return: A JSON-serialisable dictionary.
+    """
+    return {
+        "method": METHOD,
+        "scale": TEXT_HEIGHT_RANGES[engine] if SCALE else None,
+        "deskew": DESKEW,
+        "binarize": BINARIZE,
+    }
+
+
+def ink_mask(gray):
+    """
+    Binarise a page.
+
+    :param gray: A grayscale page as a uint8 NumPy array.
+    :return: A uint8 array with 1 for ink and 0 for paper.
+    """
+    # Otsu picks the threshold between paper and ink for the whole page
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return ink
+
+
+def _analysis_copy(gray):
+    """Downscaled copy of the page for the estimates, and the factor it was shrunk by."""
+    factor = min(ANALYSIS_SIZE / max(gray.shape), 1.0)
+    if factor == 1.0:
+        return gray, factor
+    size = (max(round(gray.shape[1] * factor), 1), max(round(gray.shape[0] * factor), 1))
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA), factor
+
+
+def estimate_text_height(gray):
+    """
+    Estimate the typical height of the handwriting on a page.
+
+    :param gray: A grayscale page as a NumPy array.
+    :return: The median height of the ink components in pixels of gray, or None if the
+        page has too little ink to tell.
+    """
+    small, factor = _analysis_copy(gray)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(ink_mask(small), connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:, cv2.CC_STAT_WIDTH]
+
+    # Drop specks and ruling lines or page borders
+    keep = (heights >= MIN_COMPONENT_HEIGHT) & (widths < small.shape[1] / 2) & (heights < small.shape[0] / 2)
+    if keep.sum() < MIN_COMPONENTS:
+        return None
+    return float(np.median(heights[keep])) / factor
+
+
+def estimate_skew(gray):
+    """
+    Estimate the angle of the text lines on a page.
+
+    The page is rotated by every candidate angle and the one giving the sharpest
+    horizontal projection profile, i.e. lines and gaps best separated, wins.
+
+    :param gray: A grayscale page as a NumPy array.
+    :return: The angle in degrees, counter-clockwise, that levels the lines.
+    """
+    small, _ = _analysis_copy(gray)
+    ink = ink_mask(small)
+    center = (small.shape[1] / 2, small.shape[0] / 2)
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-MAX_SKEW, MAX_SKEW + SKEW_STEP / 2, SKEW_STEP):
+        matrix = cv2.getRotationMatrix2D(center, float(angle), 1.0)
+        rotated = cv2.warpAffine(ink, matrix, (small.shape[1], small.shape[0]), flags=cv2.INTER_NEAREST)
+        score = float(np.var(rotated.sum(axis=1, dtype=np.float64)))
+        # Prefer the smallest rotation when profiles are equally sharp
+        if score > best_score * (1 + 1e-6):
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+class Preprocessed:
+    """
+    A page prepared for OCR together with the transform that produced it, so that boxes
+    found by the engine can be mapped back onto the original page.
+    """
+
+    def __init__(self, gray, matrix, original_size, text_height=None, angle=0.0):
+        self.gray = gray
+        self.matrix = matrix  # 2x3 affine transform from original to preprocessed pixels
+        self.original_size = original_size  # (width, height) of the original page
+        self.text_height = text_height
+        self.angle = angle
+
+    @property
+    def scale(self):
+        return float(np.hypot(self.matrix[0, 0], self.matrix[1, 0]))
+
+    def to_original(self, table):
+        """
+        Map glyph boxes from preprocessed to original page coordinates.
+
+        Each box becomes the smallest whole-pixel box enclosing its transformed corners, so
+        crops taken from the full-resolution page never cut a glyph.
+
+        :param table: A GlyphTable with boxes in preprocessed coordinates.
+        :return: A new GlyphTable with boxes in original coordinates.
+        """
+        if not len(table) or np.allclose(self.matrix, [[1, 0, 0], [0, 1, 0]]):
+            return table
+        records = table.records.copy()
+        x, y = records["x"].astype(np.float64), records["y"].astype(np.float64)
+        right, bottom = x + records["width"], y + records["height"]
+
+        # Transform the four corners of every box and take their bounding box
+        corners = np.stack([
+            np.stack([x, y], axis=1), np.stack([right, y], axis=1),
+            np.stack([x, bottom], axis=1), np.stack([right, bottom], axis=1),
+        ], axis=1)
+        inverse = cv2.invertAffineTransform(self.matrix)
+        mapped = corners @ inverse[:, :2].T + inverse[:, 2]
+
+        width, height = self.original_size
+        left = np.clip(np.floor(mapped[..., 0].min(axis=1)), 0, width)
+        top = np.clip(np.floor(mapped[..., 1].min(axis=1)), 0, height)
+        records["x"] = left
+        records["y"] = top
+        records["width"] = np.clip(np.ceil(mapped[..., 0].max(axis=1)), 0, width) - left
+        records["height"] = np.clip(np.ceil(mapped[..., 1].max(axis=1)), 0, height) - top
+        return GlyphTable(records, table.text, table.text_field)
+
+
+def _rotate(gray, angle):
+    """
+    Rotate a page around its centre on a canvas large enough to keep the corners.
+
+    :return: A tuple (rotated page, 2x3 transform applied).
+    """
+    height, width = gray.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    new_width, new_height = int(np.ceil(width * cos + height * sin)), int(np.ceil(width * sin + height * cos))
+    matrix[0, 2] += (new_width - width) / 2
+    matrix[1, 2] += (new_height - height) / 2
+    rotated = cv2.warpAffine(gray, matrix, (new_width, new_height), flags=cv2.INTER_LINEAR,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=255)
+    return rotated, matrix
+
+
+def preprocess(gray, engine, scale=None, deskew=None, binarize=None):
+    """
+    Prepare a grayscale page for an OCR engine.
+
+    The page is rescaled so that its text height falls into the engine's preferred range,
+    which for high-resolution photos cuts the number of pixels the engine has to process
+    many times over. Optionally the page is deskewed and binarised.
+
+    :param gray: The grayscale page as a NumPy array.
+    :param engine: "tesseract" or "easyocr".
+    :param scale: Rescale to the preferred text height, defaults to SCALE.
+    :param deskew: Level slanted text lines, defaults to DESKEW.
+    :param binarize: Threshold the page adaptively, defaults to BINARIZE.
+    :return: A Preprocessed page.
+    """
+    scale = SCALE if scale is None else scale
+    deskew = DESKEW if deskew is None else deskew
+    binarize = BINARIZE if binarize is None else binarize
+
+    original_size = (gray.shape[1], gray.shape[0])
+    matrix = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+    text_height = estimate_text_height(gray) if scale else None
+
+    if text_height:
+        lowest, target, highest = TEXT_HEIGHT_RANGES[engine]
+        if not lowest <= text_height <= highest:
+            factor = min(target / text_height, MAX_UPSCALE)
+            size = (max(round(gray.shape[1] * factor), 1), max(round(gray.shape[0] * factor), 1))
+            interpolation = cv2.INTER_AREA if factor < 1 else cv2.INTER_CUBIC
+            gray = cv2.resize(gray, size, interpolation=interpolation)
+            # Use the exact per-axis factors of the rounded size
+            matrix = np.array([[size[0] / original_size[0], 0.0, 0.0], [0.0, size[1] / original_size[1], 0.0]])
+
+    angle = 0.0
+    if deskew:
+        angle = estimate_skew(gray)
+        if angle:
+            gray, rotation = _rotate(gray, angle)
+            matrix = rotation @ np.vstack([matrix, [0.0, 0.0, 1.0]])
+
+    if binarize:
+        # Adaptive thresholding copes with the uneven lighting of phone photos
+        block_size = 2 * int(TEXT_HEIGHT_RANGES[engine][1]) + 1
+        gray = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block_size, 10)
+
+    return Preprocessed(gray, matrix, original_size, text_height, angle)
@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Number of warm readers kept per (languages, gpu) combination, and how long an
+# unused reader may sit in the pool before its weights are released.
+POOL_SIZE = int(os.environ.get("OCR_READER_POOL_SIZE", "2"))
+IDLE_TIMEOUT = float(os.environ.get("OCR_READER_IDLE_SECONDS", "900"))
+
+
+class ReaderPool:
+    """
+    A thread-safe pool of warm easyocr.Reader instances.
+
+    Readers are created lazily on first use and keyed by language list and GPU flag,
+    so that the detection and recognition weights are only loaded from disk once per
+    process. A reader is handed out to one caller at a time, because readtext is not
+    safe to call concurrently on the same instance.
+    """
+
+    def __init__(self, size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT):
+        self.size = max(int(size), 1)
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Condition()
+        self._idle = {}  # key -> list of (reader, last_used)
+        self._created = {}  # key -> number of readers alive for the key
+
+    @staticmethod
+    def _key(lang_list, gpu):
+        return tuple(lang_list), bool(gpu)
+
+    def _create(self, key):
+        import easyocr  # Imported here so that torch is only loaded when a reader is needed
+
+        lang_list, gpu = key
+        return easyocr.Reader(list(lang_list), gpu=gpu)
+
+    def _evict_idle(self, now):
+        """Drop readers that have not been used within the idle timeout. Caller holds the lock."""
+        if self.idle_timeout is None:
+            return
+        for key, idle in self._idle.items():
+            fresh = [(reader, used) for reader, used in idle if now - used < self.idle_timeout]
+            self._created[key] -= len(idle) - len(fresh)
+            self._idle[key] = fresh
+
+    def acquire(self, lang_list=("en",), gpu=True):
+        """
+        Take a reader out of the pool, creating one if the pool for this key is not full.
+
+        :param lang_list: Languages the reader should recognise.
+        :param gpu: Whether the reader should run on the GPU.
+        :return: An easyocr.Reader instance that must be handed back with release().
+        """
+        key = self._key(lang_list, gpu)
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            while True:
+                idle = self._idle.setdefault(key, [])
+                if idle:
+                    reader, _ = idle.pop()
+                    return reader
+                if self._created.get(key, 0) < self.size:
+                    self._created[key] = self._created.get(key, 0) + 1
+                    break
+                self._lock.wait()
+
+        # Build the reader outside the lock so other keys are not blocked by the model load
+        try:
+            return self._create(key)
+        except BaseException:
+            with self._lock:
+                self._created[key] -= 1
+                self._lock.notify()
+            raise
+
+    def release(self, reader, lang_list=("en",), gpu=True):
+        """
+        Return a reader to the pool.
+
+        :param reader: The reader obtained from acquire().
+        :param lang_list: Languages the reader was acquired with.
+        :param gpu: GPU flag the reader was acquired with.
+        """
+        key = self._key(lang_list, gpu)
+        with self._lock:
+            self._idle.setdefault(key, []).append((reader, time.monotonic()))
+            self._lock.notify()
+
+    @contextmanager
+    def reader(self, lang_list=("en",), gpu=True):
+        """Context manager wrapping acquire() and release()."""
+        reader = self.acquire(lang_list, gpu)
+        try:
+            yield reader
+        finally:
+            self.release(reader, lang_list, gpu)
+
+    def warm(self, lang_list=("en",), gpu=True):
+        """Make sure at least one reader for the given settings is loaded."""
+        with self.reader(lang_list, gpu):
+            pass
+
+    def clear(self):
+        """Release every idle reader."""
+        with self._lock:
+            for key, idle in self._idle.items():
+                self._created[key] -= len(idle)
+            self._idle.clear()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the process-wide reader pool, creating it on first use.
+
+    :return: The shared ReaderPool instance.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ReaderPool()
+    return _pool
+
+
+def reader(lang_list=("en",), gpu=True):
+    """
+    Borrow a warm reader from the process-wide pool.
+
+    :param lang_list: Languages the reader should recognise.
+    :param gpu: Whether the reader should run on the GPU.
+    :return: A context manager yielding an easyocr.Reader.
+    """
+    return get_pool().reader(lang_list, gpu)
+
+
+def warm(lang_list=("en",), gpu=True):
+    """
+    Make sure the process-wide pool holds a loaded reader for the given settings.
+
+    :param lang_list: Languages the reader should recognise.
+    :param gpu: Whether the reader should run on the GPU.
+    """
+    get_pool().warm(lang_list, gpu)
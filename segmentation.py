@@ -0,0 +1,118 @@
+import numpy as np
+
+import preprocessing
+from glyph_table import GlyphTable
+
+
+# Identifies the segmentation algorithm in OCR cache keys; bump when results change
+METHOD = "projection-v1"
+
+# A character boundary may move at most this fraction of the average character width
+# away from its equal-width position while looking for the column with the least ink.
+SEARCH_FRACTION = 0.4
+
+
+def ink_prefix_sums(gray):
+    """
+    Binarise a page and sum its ink column-wise from the top.
+
+    :param gray: A grayscale page as a NumPy array.
+    :return: An array of shape (height + 1, width) where row r holds the number of ink
+        pixels above row r in each column.
+    """
+    ink = preprocessing.ink_mask(gray)
+    dtype = np.uint16 if gray.shape[0] < np.iinfo(np.uint16).max else np.int32
+    sums = np.zeros((gray.shape[0] + 1, gray.shape[1]), dtype=dtype)
+    np.cumsum(ink, axis=0, dtype=dtype, out=sums[1:])
+    return sums
+
+
+def column_profiles(words, sums):
+    """
+    Ink per column inside every word box, for all words at once.
+
+    :param words: A GlyphTable of words.
+    :param sums: Prefix sums from ink_prefix_sums().
+    :return: An array of shape (number of words, widest word) with the ink count of each
+        column; columns past the end of a word or outside the page count as blank.
+    """
+    records = words.records
+    img_height, img_width = sums.shape[0] - 1, sums.shape[1]
+    widths = np.maximum(records["width"], 0)
+    max_width = int(widths.max()) if len(widths) else 0
+
+    columns = records["x"][:, None] + np.arange(max_width)[None, :]
+    inside = (columns >= 0) & (columns < img_width) & (np.arange(max_width)[None, :] < widths[:, None])
+    columns = np.clip(columns, 0, img_width - 1)
+    top = np.clip(records["y"], 0, img_height)[:, None]
+    bottom = np.clip(records["y"] + records["height"], 0, img_height)[:, None]
+
+    profiles = sums[bottom, columns].astype(np.int32) - sums[top, columns].astype(np.int32)
+    profiles[~inside] = 0
+    return profiles
+
+
+def segment_characters(words, gray):
+    """
+    Split word boxes into characters at the columns with the least ink.
+
+    Each boundary starts at its equal-width position and moves to the emptiest column of
+    the word's projection profile within a window around it, so narrow letters such as
+    "i" no longer bleed into their neighbours. All words of a page are processed with a
+    handful of array operations.
+
+    :param words: A GlyphTable of words.
+    :param gray: The grayscale page the words were detected on.
+    :return: A GlyphTable of characters, in reading order.
+    """
+    records = words.records
+    if not len(records):
+        return GlyphTable.empty()
+    num_chars = (records["text_end"] - records["text_start"]).astype(np.int64)
+    widths = np.maximum(records["width"], 0).astype(np.int64)
+    profiles = column_profiles(words, ink_prefix_sums(gray))
+
+    # One cut between every pair of neighbouring characters
+    num_cuts = np.maximum(num_chars - 1, 0)
+    cut_word = np.repeat(np.arange(len(records)), num_cuts)
+    cut_index = np.arange(len(cut_word)) - np.repeat(np.cumsum(num_cuts) - num_cuts, num_cuts) + 1
+    char_width = widths[cut_word] / np.maximum(num_chars[cut_word], 1)
+    uniform = np.round(cut_index * char_width).astype(np.int64)
+    radius = np.floor(char_width * SEARCH_FRACTION).astype(np.int64)
+
+    cuts = uniform
+    if len(cut_word):
+        max_radius = int(radius.max())
+        offsets = np.arange(-max_radius, max_radius + 1)
+        candidates = uniform[:, None] + offsets[None, :]
+        valid = (np.abs(offsets)[None, :] <= radius[:, None]) & \
+                (candidates >= 1) & (candidates <= widths[cut_word][:, None] - 1)
+        ink = profiles[cut_word[:, None], np.clip(candidates, 0, max(profiles.shape[1] - 1, 0))] \
+            if profiles.shape[1] else np.zeros(candidates.shape, dtype=np.int32)
+
+        # Least ink wins, ties go to the candidate closest to the equal-width position
+        cost = np.where(valid, ink.astype(np.int64) * len(offsets) + np.abs(offsets)[None, :], np.iinfo(np.int64).max)
+        best = candidates[np.arange(len(candidates)), np.argmin(cost, axis=1)]
+        cuts = np.where(valid.any(axis=1), best, uniform)
+
+    # Boundaries of word i live at slots[i] .. slots[i] + num_chars[i]: 0, the cuts, width
+    slots = np.cumsum(num_chars + 1) - (num_chars + 1)
+    boundaries = np.zeros(int((num_chars + 1).sum()), dtype=np.int64)
+    boundaries[slots + num_chars] = widths
+    boundaries[slots[cut_word] + cut_index] = cuts
+
+    char_word = np.repeat(np.arange(len(records)), num_chars)
+    char_slot = np.arange(len(char_word)) + np.repeat(np.arange(len(records)), num_chars)
+    starts, ends = boundaries[char_slot], boundaries[char_slot + 1]
+    parents = records[char_word]
+
+    text = "".join(words.texts())
+    return GlyphTable.from_packed(
+        text,
+        np.ones(len(text), dtype=np.int32),
+        parents["x"] + starts,
+        parents["y"],
+        ends - starts,
+        parents["height"],
+        parents["conf"],  # Confidence of the whole text element
+    )
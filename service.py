@@ -0,0 +1,529 @@
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import collage_renderer
+import comparison
+import instrumentation
+import reader_pool
+import similarity
+import tiled_ocr
+from page import Page
+
+
+# Where the service listens, where it keeps the inputs and results of its jobs, and how
+# many worker processes run comparisons
+HOST = os.environ.get("OCR_SERVICE_HOST", "127.0.0.1")
+PORT = int(os.environ.get("OCR_SERVICE_PORT", "8765"))
+JOBS_DIR = os.environ.get("OCR_SERVICE_DIR", os.path.join(tempfile.gettempdir(), "ocr_service_jobs"))
+WORKERS = int(os.environ.get("OCR_SERVICE_WORKERS", "2"))
+
+# Jobs beyond MAX_QUEUED waiting ones are refused, and only the MAX_JOBS most recent finished
+# jobs keep their results
+MAX_QUEUED = int(os.environ.get("OCR_SERVICE_MAX_QUEUED", "64"))
+MAX_JOBS = int(os.environ.get("OCR_SERVICE_MAX_JOBS", "256"))
+MAX_REQUEST_BYTES = 256 * 1024 * 1024
+
+# Engines loaded by every worker process before it takes its first job
+WARM_ENGINES = [("pytesseract", "letters"), ("pytesseract", "words")]
+
+ENCODED_FORMATS = ("png", "webp", "jpeg")
+_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class QueueFull(RuntimeError):
+    """Raised when a job is submitted while MAX_QUEUED jobs are already waiting."""
+
+
+class WorkersUnavailable(RuntimeError):
+    """Raised when a job is submitted while the worker processes are being restarted."""
+
+
+def _warm_worker(engines, tile_workers):
+    """Load the OCR modules and models of every engine once, when a worker process starts."""
+    # Large pages are tiled on the worker's share of the CPUs
+    tiled_ocr.set_workers(tile_workers)
+    for engine, mode in engines:
+        comparison.load_engine(engine, mode)
+        if engine == "easyocr":
+            # The letter module reads on the GPU when there is one, the word module on the CPU
+            reader_pool.warm(["en"], gpu=mode == "letters")
+
+
+def run_job(directory, request):
+    """
+    Run one comparison in a worker process and write its results into the job directory.
+
+    Two images give a juxtaposed collage, and in letter mode their similarity scores, more
+    images give one sheet with a column per author.
+
+    :param directory: The job directory, holding the input images.
+    :param request: The validated job request, see JobQueue.submit().
+    :return: The result dictionary, also written to result.json.
+    """
+    try:
+        return _run_job(directory, request)
+    except Exception as e:
+        # Engine exceptions such as pytesseract's TesseractNotFoundError cannot always be
+        # unpickled in the server, which would break the whole pool
+        raise RuntimeError(repr(e)) from None
+
+
+def _run_job(directory, request):
+    # Tells the server the job left the queue
+    open(os.path.join(directory, "started"), "w").close()
+
+    fmt = request["format"]
+    with instrumentation.trace(f"{request['engine']}/{request['mode']} job") as run_trace:
+        module = comparison.load_engine(request["engine"], request["mode"])
+        images = [os.path.join(directory, image["file"]) for image in request["images"]]
+        with instrumentation.span("decode"):
+            pages = [Page.from_path(path) for path in images]
+        pages, ocr_data = comparison.extract_authors(module.extract_text_and_boxes, pages)
+
+        result = {"glyphs": [len(table) for table in ocr_data], "files": {}}
+        options = {"fmt": fmt, "quality": request["quality"], "compress_level": request["compress_level"]}
+        if len(pages) == 2:
+            collage, preview = module.create_juxtaposed_collage(*ocr_data, *pages, output_path=None, **options)
+            # Words are only grouped by their initial, so only letters are scored
+            if request["mode"] == "letters":
+                scores = similarity.compare(pages[0], ocr_data[0], pages[1], ocr_data[1])
+                result["similarity"] = {
+                    "score": scores["score"],
+                    "letters": {letter: {key: value for key, value in letter_scores.items() if key != "distances"}
+                                for letter, letter_scores in scores["letters"].items()},
+                }
+        else:
+            names = [image["name"] for image in request["images"]]
+            collage, preview = comparison.create_sheet(ocr_data, pages, None, names, **options)
+
+    for name, data in ((f"collage.{fmt}", collage), (f"preview.{fmt}", preview)):
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(data)
+        result["files"][name.split(".")[0]] = name
+    with open(os.path.join(directory, "boxes.json"), "w") as f:
+        json.dump([{"name": image["name"], "boxes": table.to_dicts()}
+                   for image, table in zip(request["images"], ocr_data)], f)
+    result["files"]["boxes"] = "boxes.json"
+    result["trace"] = run_trace.to_dict()
+
+    with open(os.path.join(directory, "result.json"), "w") as f:
+        json.dump(result, f)
+    return result
+
+
+def _int_field(request, name, default, low, high):
+    """An integer field of a job request within [low, high], or its default when missing."""
+    value = request.get(name, default)
+    try:
+        if isinstance(value, bool) or int(value) != value:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError(f"\"{name}\" must be an integer from {low} to {high}") from None
+    if not low <= value <= high:
+        raise ValueError(f"\"{name}\" must be an integer from {low} to {high}")
+    return int(value)
+
+
+def _validate(request):
+    """
+    Check a job request and fill in its defaults.
+
+    :param request: The decoded JSON body of a job submission.
+    :return: A tuple (request without image data, list of decoded image bytes).
+    """
+    if not isinstance(request, dict):
+        raise ValueError("The job must be a JSON object")
+    engine, mode = request.get("engine", "pytesseract"), request.get("mode", "letters")
+    if not isinstance(engine, str) or not isinstance(mode, str) or (engine, mode) not in comparison.ENGINE_MODULES:
+        raise ValueError(f"Unknown OCR engine/mode combination: {engine}/{mode}")
+    fmt = request.get("format", "png")
+    if fmt not in ENCODED_FORMATS:
+        raise ValueError(f"Unsupported collage format: {fmt}")
+
+    images = request.get("images")
+    if not isinstance(images, list) or len(images) < 2:
+        raise ValueError("A job needs at least two images")
+    names, data = [], []
+    for i, image in enumerate(images):
+        try:
+            data.append(base64.b64decode(image["data"], validate=True))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Image {i + 1} needs base64 encoded \"data\"") from None
+        names.append(os.path.splitext(os.path.basename(str(image.get("name") or f"author{i + 1}")))[0])
+
+    return {
+        "engine": engine,
+        "mode": mode,
+        "format": fmt,
+        "quality": _int_field(request, "quality", collage_renderer.DEFAULT_QUALITY, 1, 100),
+        "compress_level": _int_field(request, "compress_level", collage_renderer.DEFAULT_COMPRESS_LEVEL, 0, 9),
+        "images": [{"name": name, "file": f"input{i}"} for i, name in enumerate(names)],
+    }, data
+
+
+class JobQueue:
+    """
+    Comparison jobs run by a fixed pool of worker processes.
+
+    Every worker imports the OCR modules and loads the models of WARM_ENGINES once when it
+    starts, so jobs never pay for a cold engine. Inputs and results live in one directory
+    per job; the queue itself only keeps each job's future.
+    """
+
+    def __init__(self, directory=JOBS_DIR, workers=WORKERS, engines=WARM_ENGINES, max_queued=MAX_QUEUED,
+                 max_jobs=MAX_JOBS):
+        self.directory = directory
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()  # Job id -> {"created", "future", ...}, oldest first
+        self._lock = threading.Lock()
+        self.engines = list(engines)
+        os.makedirs(directory, exist_ok=True)
+        self._executor = self._start_executor()
+
+    def _start_executor(self):
+        # Spawned rather than forked workers, the server process runs request threads
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_warm_worker,
+                                       initargs=(self.engines, tiled_ocr.worker_share(self.workers)))
+        # Start the workers now, so they load their engines before the first job arrives
+        for _ in range(self.workers):
+            executor.submit(os.getpid)
+        return executor
+
+    def submit(self, request):
+        """
+        Queue a comparison.
+
+        :param request: A dictionary with "images", a list of at least two {"name", "data"}
+            objects where data is the base64 encoded image file, and optionally "engine",
+            "mode", "format" ("png", "webp" or "jpeg"), "quality" and "compress_level".
+        :return: The job id.
+        """
+        request, images = _validate(request)
+        with self._lock:
+            if self._queued() >= self.max_queued:
+                raise QueueFull(f"{self.max_queued} jobs are already waiting")
+            job_id = uuid.uuid4().hex
+            directory = os.path.join(self.directory, job_id)
+            os.makedirs(directory)
+            for image, data in zip(request["images"], images):
+                with open(os.path.join(directory, image["file"]), "wb") as f:
+                    f.write(data)
+            try:
+                future = self._executor.submit(run_job, directory, request)
+            except BrokenProcessPool:
+                # A worker died, e.g. killed for running out of memory; the jobs it held have
+                # failed, later jobs go to a new pool
+                shutil.rmtree(directory, ignore_errors=True)
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._start_executor()
+                raise WorkersUnavailable("The worker processes are restarting, retry shortly") from None
+            self._jobs[job_id] = {"created": time.time(), "request": request, "future": future}
+            self._evict()
+        return job_id
+
+    def queued(self):
+        """Number of jobs that are waiting for a worker."""
+        with self._lock:
+            return self._queued()
+
+    def _queued(self):
+        # Caller holds the lock
+        return sum(1 for job_id in self._jobs if self._state(job_id) == "queued")
+
+    def _state(self, job_id):
+        future = self._jobs[job_id]["future"]
+        if future.cancelled():
+            return "cancelled"
+        if future.done():
+            return "failed" if future.exception() is not None else "done"
+        if os.path.exists(os.path.join(self.directory, job_id, "started")):
+            return "running"
+        return "queued"
+
+    def status(self, job_id):
+        """
+        Describe a job.
+
+        :param job_id: An id returned by submit().
+        :return: A dictionary with "id", "status" ("queued", "running", "done", "failed" or
+            "cancelled"), "created" and "engine"/"mode"; "position" in the queue while
+            queued, "error" when failed and "result" when done. None for unknown jobs.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            status = {
+                "id": job_id,
+                "status": self._state(job_id),
+                "created": job["created"],
+                "engine": job["request"]["engine"],
+                "mode": job["request"]["mode"],
+            }
+            if status["status"] == "queued":
+                waiting = [other for other in self._jobs if self._state(other) == "queued"]
+                status["position"] = waiting.index(job_id)
+            elif status["status"] == "failed":
+                status["error"] = repr(job["future"].exception())
+            elif status["status"] == "done":
+                status["result"] = job["future"].result()
+            return status
+
+    def file_path(self, job_id, name):
+        """
+        Path of one result file of a finished job.
+
+        :param job_id: An id returned by submit().
+        :param name: A file listed in the job's result, e.g. "collage.png".
+        :return: The path, or None if the job or file does not exist.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or self._state(job_id) != "done" or name not in job["future"].result()["files"].values():
+                return None
+        return os.path.join(self.directory, job_id, name)
+
+    def cancel(self, job_id):
+        """
+        Cancel a job that has not started yet, or remove a finished job and its results.
+
+        :param job_id: An id returned by submit().
+        :return: "cancelled" or "removed", None if the job does not exist or is running.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or self._state(job_id) == "running":
+                return None
+            if job["future"].done():
+                state = "removed"
+            elif job["future"].cancel():
+                state = "cancelled"
+            else:
+                # The executor already handed the job to a worker, it is about to start
+                return None
+            self._remove(job_id)
+            return state
+
+    def _remove(self, job_id):
+        del self._jobs[job_id]
+        shutil.rmtree(os.path.join(self.directory, job_id), ignore_errors=True)
+
+    def _evict(self):
+        # Forget the oldest finished jobs beyond max_jobs, queued and running jobs stay
+        finished = [job_id for job_id, job in self._jobs.items() if job["future"].done()]
+        for job_id in finished[:max(len(finished) - self.max_jobs, 0)]:
+            self._remove(job_id)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    HTTP API of a JobQueue:
+
+    - POST /jobs submits a job (see JobQueue.submit()) and answers 202 with its id
+    - GET /jobs/<id> returns the status of a job (see JobQueue.status())
+    - GET /jobs/<id>/files/<name> downloads a result file
+    - DELETE /jobs/<id> cancels a queued job or removes a finished one
+    - GET /health reports the number of workers and waiting jobs
+    """
+
+    queue = None  # Set by serve()
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if len(parts) >= 2 and parts[0] == "jobs" and not _JOB_ID.match(parts[1]):
+            return ["jobs", None]
+        return parts
+
+    def do_GET(self):
+        parts = self._route()
+        if parts == ["health"]:
+            self._send_json(200, {"workers": self.queue.workers, "queued": self.queue.queued()})
+        elif len(parts) == 2 and parts[0] == "jobs":
+            status = self.queue.status(parts[1])
+            if status is None:
+                self._send_json(404, {"error": "Unknown job"})
+            else:
+                self._send_json(200, status)
+        elif len(parts) == 4 and parts[0] == "jobs" and parts[2] == "files":
+            path = self.queue.file_path(parts[1], parts[3])
+            if path is None:
+                self._send_json(404, {"error": "Unknown job or file"})
+                return
+            with open(path, "rb") as f:
+                data = f.read()
+            extension = os.path.splitext(path)[1][1:]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json" if extension == "json" else f"image/{extension}")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self._route() != ["jobs"]:
+            self._send_json(404, {"error": "Not found"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST_BYTES:
+            self._send_json(413, {"error": "Request too large"})
+            return
+        try:
+            job_id = self.queue.submit(json.loads(self.rfile.read(length)))
+        except (QueueFull, WorkersUnavailable) as e:
+            self._send_json(503, {"error": str(e)})
+        except ValueError as e:  # Includes malformed JSON
+            self._send_json(400, {"error": str(e)})
+        except Exception as e:  # Answer rather than drop the connection
+            self._send_json(500, {"error": repr(e)})
+        else:
+            self._send_json(202, {"id": job_id, "status": "queued"})
+
+    def do_DELETE(self):
+        parts = self._route()
+        state = self.queue.cancel(parts[1]) if len(parts) == 2 and parts[0] == "jobs" else None
+        if state is None:
+            self._send_json(409, {"error": "Unknown or running job"})
+        else:
+            self._send_json(200, {"id": parts[1], "status": state})
+
+
+def serve(host=HOST, port=PORT, queue=None):
+    """
+    Run the HTTP service until interrupted.
+
+    :param host: Interface to listen on; the service has no authentication, keep it local.
+    :param port: Port to listen on.
+    :param queue: The JobQueue, defaults to one with the module settings.
+    """
+    handler = type("Handler", (ServiceHandler,), {"queue": queue or JobQueue()})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Serving comparisons on http://{host}:{server.server_address[1]} "
+          f"with {handler.queue.workers} workers", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        handler.queue.shutdown()
+
+
+class Client:
+    """
+    Minimal client of the service, e.g. for the Streamlit UI.
+
+    :param url: Base URL of the service, e.g. "http://127.0.0.1:8765".
+    """
+
+    def __init__(self, url, timeout=30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, method, path, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method,
+                                         headers={"Content-Type": "application/json"} if data else {})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"{method} {path} failed: {e.code} {e.read().decode('utf-8', 'replace')}") from None
+
+    def submit(self, engine, mode, images, fmt="png", quality=collage_renderer.DEFAULT_QUALITY,
+               compress_level=collage_renderer.DEFAULT_COMPRESS_LEVEL):
+        """
+        Submit a comparison.
+
+        :param images: A list of (name, encoded image bytes) tuples, at least two.
+        :return: The job id.
+        """
+        body = {
+            "engine": engine,
+            "mode": mode,
+            "format": fmt,
+            "quality": quality,
+            "compress_level": compress_level,
+            "images": [{"name": name, "data": base64.b64encode(data).decode("ascii")} for name, data in images],
+        }
+        return json.loads(self._request("POST", "/jobs", body))["id"]
+
+    def status(self, job_id):
+        return json.loads(self._request("GET", f"/jobs/{job_id}"))
+
+    def file(self, job_id, name):
+        return self._request("GET", f"/jobs/{job_id}/files/{name}")
+
+    def wait(self, job_id, poll_interval=0.5, timeout=None, on_status=None):
+        """
+        Poll a job until it is finished.
+
+        :param job_id: An id returned by submit().
+        :param poll_interval: Seconds between polls.
+        :param timeout: Seconds to wait at most, None waits forever.
+        :param on_status: Optional function called with every status, e.g. to show progress.
+        :return: The status of the done job.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            status = self.status(job_id)
+            if on_status:
+                on_status(status)
+            if status["status"] == "done":
+                return status
+            if status["status"] in ("failed", "cancelled"):
+                raise RuntimeError(f"Job {job_id} {status['status']}: {status.get('error', '')}")
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Job {job_id} is still {status['status']}")
+            time.sleep(poll_interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve handwriting comparisons over a local HTTP job queue.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Worker processes with warm engines")
+    parser.add_argument("--jobs-dir", default=JOBS_DIR, help="Directory for job inputs and results")
+    parser.add_argument("--warm", nargs="+", default=[f"{engine}/{mode}" for engine, mode in WARM_ENGINES],
+                        help="engine/mode combinations every worker loads at start, e.g. easyocr/letters")
+    args = parser.parse_args(argv)
+
+    engines = [tuple(name.split("/", 1)) for name in args.warm]
+    for engine, mode in engines:
+        if (engine, mode) not in comparison.ENGINE_MODULES:
+            parser.error(f"Unknown engine/mode combination: {engine}/{mode}")
+    serve(args.host, args.port, JobQueue(args.jobs_dir, args.workers, engines))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import cv2
+import numpy as np
+
+import collage_renderer
+import instrumentation
+import preprocessing
+
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+# Every glyph is reduced to a BITMAP_SIZE x BITMAP_SIZE ink bitmap, described by the ink
+# density of ZONES x ZONES zones, its row and column profiles and its aspect ratio
+BITMAP_SIZE = 32
+ZONES = 8
+
+# Letters with more glyphs than this are compared on their best ranked ones, like the collages
+MAX_GLYPHS_PER_LETTER = 256
+
+# Distance at which the similarity of two glyph sets has dropped to 1/e
+DISTANCE_SCALE = 0.15
+
+
+def normalise_bitmaps(ink, boxes):
+    """
+    Crop glyphs from an ink mask into fixed-size square bitmaps.
+
+    Each crop is centred on a square canvas before resizing, so the bitmaps keep the shape
+    of the glyph rather than stretching it.
+
+    :param ink: An ink mask from preprocessing.ink_mask().
+    :param boxes: An (n, 4) array of x, y, width, height.
+    :return: A float32 array of shape (n, BITMAP_SIZE, BITMAP_SIZE) with ink coverage in [0, 1].
+    """
+    bitmaps = np.zeros((len(boxes), BITMAP_SIZE, BITMAP_SIZE), dtype=np.float32)
+    img_height, img_width = ink.shape
+    for i, (x, y, width, height) in enumerate(np.asarray(boxes, dtype=np.int64)):
+        crop = ink[max(y, 0):min(y + height, img_height), max(x, 0):min(x + width, img_width)]
+        if not crop.size:
+            continue
+        side = max(crop.shape)
+        square = np.zeros((side, side), dtype=np.float32)
+        top, left = (side - crop.shape[0]) // 2, (side - crop.shape[1]) // 2
+        square[top:top + crop.shape[0], left:left + crop.shape[1]] = crop
+        bitmaps[i] = cv2.resize(square, (BITMAP_SIZE, BITMAP_SIZE), interpolation=cv2.INTER_AREA)
+    return bitmaps
+
+
+def describe(bitmaps, boxes):
+    """
+    Shape descriptors of a batch of glyphs.
+
+    Every block of features (zone densities, row profile, column profile, aspect ratio) is
+    scaled to contribute equally to Euclidean distances.
+
+    :param bitmaps: An array of shape (n, BITMAP_SIZE, BITMAP_SIZE) from normalise_bitmaps().
+    :param boxes: The (n, 4) boxes the bitmaps were cropped from.
+    :return: A float32 array of shape (n, number of features).
+    """
+    count = len(bitmaps)
+    zone = BITMAP_SIZE // ZONES
+    zones = bitmaps.reshape(count, ZONES, zone, ZONES, zone).mean(axis=(2, 4)).reshape(count, ZONES * ZONES)
+    rows = bitmaps.mean(axis=2)
+    columns = bitmaps.mean(axis=1)
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    aspect = np.log(np.maximum(boxes[:, 2], 1) / np.maximum(boxes[:, 3], 1))[:, None]
+    blocks = [zones, rows, columns, aspect]
+    return np.concatenate([block / np.sqrt(block.shape[1]) for block in blocks], axis=1).astype(np.float32)
+
+
+def distance_matrix(descriptors1, descriptors2):
+    """
+    Euclidean distances between every pair of glyphs of two authors.
+
+    :param descriptors1: An (n, d) array of author 1's descriptors.
+    :param descriptors2: An (m, d) array of author 2's descriptors.
+    :return: An (n, m) array of distances.
+    """
+    squared = (np.square(descriptors1).sum(axis=1)[:, None] + np.square(descriptors2).sum(axis=1)[None, :]
+               - 2 * descriptors1 @ descriptors2.T)
+    return np.sqrt(np.maximum(squared, 0))
+
+
+def set_distance(distances):
+    """
+    Distance between two sets of glyphs: the mean distance from every glyph to its closest
+    counterpart, averaged over both directions.
+
+    :param distances: An (n, m) distance matrix with n, m > 0.
+    :return: A float.
+    """
+    return float((distances.min(axis=1).mean() + distances.min(axis=0).mean()) / 2)
+
+
+def letter_descriptors(page, table, letters=LETTERS):
+    """
+    Describe the glyphs of a page, grouped by letter.
+
+    :param page: The Page the glyphs were read from.
+    :param table: A GlyphTable of characters.
+    :param letters: Letters to describe.
+    :return: A dictionary mapping letters to arrays of descriptors of at most MAX_GLYPHS_PER_LETTER
+        glyphs, picked by collage_renderer.select_glyphs(), in reading order.
+    """
+    if table.text_field != "letter":
+        # Word boxes grouped by initial are different words, not samples of one letter
+        raise ValueError(f"Similarity is scored on letters, not on {table.text_field}s")
+    ink = preprocessing.ink_mask(page.gray)
+    groups = collage_renderer.select_glyphs(table, letters, MAX_GLYPHS_PER_LETTER)
+    return {letter: describe(normalise_bitmaps(ink, boxes), boxes) for letter, boxes in groups.items()}
+
+
+def compare(page1, table1, page2, table2, letters=LETTERS):
+    """
+    Score how similar the handwriting of two authors is, letter by letter.
+
+    :param page1: Author 1's Page.
+    :param table1: Author 1's GlyphTable from one of the OCR modules.
+    :param page2: Author 2's Page.
+    :param table2: Author 2's GlyphTable.
+    :param letters: Letters to compare.
+    :return: A dictionary with "score", the similarity over all letters weighted by the smaller
+        of the two glyph counts of each letter, and "letters", mapping every letter both authors wrote to
+        {"score", "distance", "count1", "count2", "distances"} where distances is the
+        cross-author distance matrix. Scores range from 0 to 1 (identical shapes).
+    """
+    with instrumentation.span("similarity"):
+        descriptors1 = letter_descriptors(page1, table1, letters)
+        descriptors2 = letter_descriptors(page2, table2, letters)
+
+        results = {}
+        for letter in letters:
+            if letter not in descriptors1 or letter not in descriptors2:
+                continue
+            distances = distance_matrix(descriptors1[letter], descriptors2[letter])
+            distance = set_distance(distances)
+            results[letter] = {
+                "score": float(np.exp(-distance / DISTANCE_SCALE)),
+                "distance": distance,
+                "count1": len(descriptors1[letter]),
+                "count2": len(descriptors2[letter]),
+                "distances": distances,
+            }
+
+        weights = np.array([min(result["count1"], result["count2"]) for result in results.values()], dtype=np.float64)
+        scores = np.array([result["score"] for result in results.values()], dtype=np.float64)
+        score = float((scores * weights).sum() / weights.sum()) if len(weights) else None
+    return {"score": score, "letters": results}
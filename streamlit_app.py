@@ -1,12 +1,421 @@
+import hashlib
 import os
+import tempfile
+import threading
+from collections import OrderedDict
+
 import streamlit as st
-from tempfile import NamedTemporaryFile
-from PIL import Image
 
-import pytesseract_letter
-import pytesseract_word
-import easyocr_letter
-import easyocr_word
+import collage_renderer
+import comparison
+import instrumentation
+import reader_pool
+import service
+import similarity
+import tile_pyramid
+from page import Page
+
+
+IMAGE_EXTENSIONS = ["png", "jpg", "jpeg", "webp"]
+VIEWPORT_SIZE = (1024, 768)  # Size of the tile pyramid viewer in pixels
+OCR_MEMO_ENTRIES = 32  # Pages whose OCR results are kept in memory
+
+# With a job service running (python service.py), comparisons are sent to its warm workers
+# instead of running inside the Streamlit process
+SERVICE_URL = os.environ.get("OCR_SERVICE_URL")
+
+
+@st.cache_resource(show_spinner="Loading OCR engine...")
+def load_engine(engine, mode):
+    """
+    Import the OCR module of an engine on its first selection.
+
+    The module stays resident for all later reruns and sessions, so selecting Pytesseract
+    never pulls in EasyOCR and switching back and forth costs nothing.
+
+    :param engine: "pytesseract" or "easyocr".
+    :param mode: "letters" or "words".
+    :return: The OCR module.
+    """
+    return comparison.load_engine(engine, mode)
+
+
+def upload_images():
+    """
+    Show the upload widgets for the two images.
+
+    :return: A tuple with the two uploaded files, None for an image that was not uploaded yet.
+    """
+    uploads = []
+    for i in (1, 2):
+        uploaded = st.file_uploader(f"Upload image {i}", type=IMAGE_EXTENSIONS)
+        if uploaded:
+            show_image = st.checkbox(f"Show image {i}", key=f"checkbox_{i}")
+            if show_image:
+                st.image(uploaded, use_column_width=True)
+        uploads.append(uploaded)
+    return tuple(uploads)
+
+
+def show_trace(run_trace):
+    """
+    Show the time spent in each pipeline stage of a comparison in the sidebar.
+
+    :param run_trace: The instrumentation.Trace of the comparison.
+    """
+    totals = run_trace.totals()
+    st.sidebar.subheader("Stage timings")
+    st.sidebar.table([
+        {"stage": name, "ms": round(total["seconds"] * 1000, 1), "calls": total["calls"]}
+        for name, total in totals.items()
+    ])
+    st.sidebar.download_button("Download trace (JSON)", run_trace.to_json(indent=2),
+                               file_name="ocr_trace.json", mime="application/json")
+
+
+def upload_digest(upload):
+    """
+    Content hash of an uploaded file, computed once per upload and session.
+
+    Streamlit reruns the script on every widget interaction; the hash is kept in the
+    session state so the upload bytes are not hashed again on each rerun.
+
+    :param upload: A Streamlit UploadedFile.
+    :return: The hex digest of the file contents.
+    """
+    digests = st.session_state.setdefault("upload_digests", {})
+    if upload.file_id not in digests:
+        digests[upload.file_id] = hashlib.sha256(upload.getvalue()).hexdigest()
+    return digests[upload.file_id]
+
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def decode_upload(digest, _data, name):
+    """
+    Decode an uploaded image once for all reruns and sessions.
+
+    Pages are read-only, so the cached object is shared rather than copied.
+
+    :param digest: Content hash of the upload, the cache key.
+    :param _data: The encoded image bytes (not hashed).
+    :param name: File name of the upload.
+    :return: A Page.
+    """
+    return Page.from_bytes(_data, name)
+
+
+class OCRResults:
+    """
+    OCR results of single pages, shared by all sessions and bounded to the most recently
+    used entries.
+
+    Each author's page is a unit of its own, so comparing a reference author against a
+    series of candidates only reads the new candidate's page.
+    """
+
+    def __init__(self, max_entries=OCR_MEMO_ENTRIES):
+        self.max_entries = max_entries
+        self._results = OrderedDict()  # (engine, mode, content hash) -> GlyphTable
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+
+@st.cache_resource
+def ocr_results():
+    return OCRResults()
+
+
+def extract_pages(engine, mode, digests, pages):
+    """
+    Run OCR on the pages that have not been read yet, concurrently.
+
+    :param engine: "pytesseract" or "easyocr".
+    :param mode: "letters" or "words".
+    :param digests: Content hashes of the uploads, the per-page cache keys.
+    :param pages: The decoded Pages.
+    :return: A list with the GlyphTable of each page.
+    """
+    memo = ocr_results()
+    keys = [(engine, mode, digest) for digest in digests]
+    results = [memo.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        module = load_engine(engine, mode)
+        extracted = comparison.extract_all(module.extract_text_and_boxes, [pages[i] for i in missing])
+        for i, result in zip(missing, extracted):
+            memo.put(keys[i], result)
+            results[i] = result
+    return results
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def render_collage(engine, mode, digests, encoding, _ocr_data, _pages):
+    """
+    Render and encode the juxtaposed collage of two pages in memory, memoised on the content
+    hashes of the uploads and the encoding settings.
+
+    :param engine: "pytesseract" or "easyocr".
+    :param mode: "letters" or "words".
+    :param digests: Content hashes of both uploads, the cache key.
+    :param encoding: A tuple (format, quality, compress level), see collage_settings().
+    :param _ocr_data: The GlyphTables of both pages (not hashed).
+    :param _pages: The decoded Pages (not hashed).
+    :return: A tuple with the encoded collage and its downscaled preview, both as bytes.
+    """
+    fmt, quality, compress_level = encoding
+    module = load_engine(engine, mode)
+    return module.create_juxtaposed_collage(*_ocr_data, *_pages, output_path=None, fmt=fmt, quality=quality,
+                                            compress_level=compress_level)
+
+
+def render_pyramid(engine, mode, result_key, quality, ocr_data, pages):
+    """
+    Write the collage as a tile pyramid into a temporary directory owned by the session.
+
+    The directory of the previous pyramid is removed when a new one replaces it, and Python
+    removes the last one when the session is discarded.
+
+    :param engine: "pytesseract" or "easyocr".
+    :param mode: "letters" or "words".
+    :param result_key: Identifies the uploads and settings the pyramid was rendered for.
+    :param quality: JPEG quality of the tiles.
+    :param ocr_data: The GlyphTables of both pages.
+    :param pages: The decoded Pages.
+    :return: The directory of the pyramid.
+    """
+    previous = st.session_state.get("pyramid")
+    if previous is not None:
+        if previous[0] == result_key:
+            return previous[1].name
+        previous[1].cleanup()
+        del st.session_state["pyramid"]
+
+    directory = tempfile.TemporaryDirectory(prefix="ocr_pyramid_")
+    load_engine(engine, mode).create_juxtaposed_collage(*ocr_data, *pages, output_path=directory.name,
+                                                        fmt="tiles", quality=quality)
+    st.session_state["pyramid"] = (result_key, directory)
+    return directory.name
+
+
+def show_pyramid(directory):
+    """
+    Pan and zoom viewer for a tile pyramid.
+
+    Only the tiles inside the viewport are read and sent to the browser, so huge collages
+    cost the same as small ones.
+
+    :param directory: Directory written by tile_pyramid.write_pyramid().
+    """
+    manifest = tile_pyramid.read_manifest(directory)
+    levels = manifest["levels"]
+    viewport_width, viewport_height = VIEWPORT_SIZE
+
+    # Start at the largest level that fits the viewport width
+    fit = max([info["level"] for info in levels if info["width"] <= viewport_width] or [0])
+    level = st.slider("Zoom", 0, len(levels) - 1, fit, key="pyramid_zoom")
+    info = levels[level]
+
+    # Pan positions are fractions so that they stay put when zooming
+    x = st.slider("Pan horizontally", 0.0, 1.0, 0.0, key="pyramid_x")
+    y = st.slider("Pan vertically", 0.0, 1.0, 0.0, key="pyramid_y")
+    left = round(x * max(info["width"] - viewport_width, 0))
+    top = round(y * max(info["height"] - viewport_height, 0))
+
+    view = tile_pyramid.read_viewport(directory, manifest, level, left, top,
+                                      min(viewport_width, info["width"]), min(viewport_height, info["height"]))
+    st.image(view, caption=f"{info['width']} x {info['height']} px at zoom {level}")
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def score_similarity(engine, mode, digests, _ocr_data, _pages):
+    """
+    Score the similarity of both authors' glyphs, memoised on the content hashes of the uploads.
+
+    :param engine: "pytesseract" or "easyocr".
+    :param mode: "letters" or "words".
+    :param digests: Content hashes of both uploads, the cache key.
+    :param _ocr_data: The GlyphTables of both pages (not hashed).
+    :param _pages: The decoded Pages (not hashed).
+    :return: The result of similarity.compare().
+    """
+    return similarity.compare(_pages[0], _ocr_data[0], _pages[1], _ocr_data[1])
+
+
+def show_similarity(scores):
+    """
+    Show the overall and per-letter similarity of the two authors.
+
+    :param scores: The result of similarity.compare(), None in word mode.
+    """
+    if scores is None:
+        return
+    if scores["score"] is None:
+        st.info("The two images have no letters in common to compare.")
+        return
+    st.metric("Handwriting similarity", f"{scores['score']:.0%}")
+    with st.expander("Similarity per letter"):
+        st.table([
+            {"letter": letter.upper(), "similarity": f"{result['score']:.0%}",
+             "glyphs (author 1)": result["count1"], "glyphs (author 2)": result["count2"]}
+            for letter, result in scores["letters"].items()
+        ])
+
+
+@st.cache_resource
+def service_client():
+    return service.Client(SERVICE_URL)
+
+
+def compare_remote(engine, mode, uploads, encoding):
+    """
+    Run a comparison as a job on the service and wait for it, showing its place in the queue.
+
+    :param engine: "pytesseract" or "easyocr".
+    :param mode: "letters" or "words".
+    :param uploads: The two Streamlit UploadedFiles.
+    :param encoding: A tuple (format, quality, compress level), see collage_settings().
+    :return: A tuple (encoded collage and preview, Trace of the job, similarity scores or None).
+    """
+    client = service_client()
+    fmt, quality, compress_level = encoding
+    job_id = client.submit(engine, mode, [(upload.name, upload.getvalue()) for upload in uploads],
+                           fmt, quality, compress_level)
+
+    progress = st.empty()
+
+    def show_status(status):
+        if status["status"] == "queued":
+            progress.info(f"Waiting for a worker, {status['position']} jobs ahead...")
+        else:
+            progress.info("Running OCR and rendering the collage...")
+
+    result = client.wait(job_id, on_status=show_status)["result"]
+    progress.empty()
+    collage = client.file(job_id, result["files"]["collage"]), client.file(job_id, result["files"]["preview"])
+    return collage, instrumentation.Trace.from_dict(result["trace"]), result.get("similarity")
+
+
+def collage_settings():
+    """
+    Show the collage encoding options in the sidebar.
+
+    :return: A tuple (format, quality, compress level).
+    """
+    st.sidebar.header("Collage output")
+    fmt = st.sidebar.selectbox("Format", ["png", "webp", "jpeg", "tiles"],
+                               format_func=lambda name: "zoomable tiles" if name == "tiles" else name,
+                               help="PNG is lossless, WebP and JPEG are much smaller, "
+                                    "zoomable tiles suit very large collages")
+    quality = collage_renderer.DEFAULT_QUALITY
+    compress_level = collage_renderer.DEFAULT_COMPRESS_LEVEL
+    if fmt == "png":
+        compress_level = st.sidebar.slider("PNG compression level", 0, 9, compress_level,
+                                           help="Higher levels are smaller but slower to encode")
+    else:
+        if fmt == "tiles":
+            quality = tile_pyramid.TILE_QUALITY
+        quality = st.sidebar.slider("Quality", 1, 100, quality)
+    return fmt, quality, compress_level
+
+
+def compare_local(engine, mode, uploads, digests, encoding, result_key, warm=None):
+    """
+    Run a comparison in the Streamlit process.
+
+    :param engine: "pytesseract" or "easyocr".
+    :param mode: "letters" or "words".
+    :param uploads: The two Streamlit UploadedFiles.
+    :param digests: Content hashes of the uploads.
+    :param encoding: A tuple (format, quality, compress level), see collage_settings().
+    :param result_key: Identifies the uploads and settings, for the tile pyramid.
+    :param warm: Optional function that loads the OCR models before the comparison.
+    :return: A tuple (collage, Trace of the comparison, similarity scores or None), where collage is the
+        encoded collage and preview or the directory of the tile pyramid.
+    """
+    if warm:
+        with st.spinner("Loading OCR models..."):
+            warm()
+
+    with instrumentation.trace(f"{engine}/{mode} {uploads[0].name} vs {uploads[1].name}") as run_trace:
+        # Decode each upload once in memory, the pages are shared by OCR and collage
+        with instrumentation.span("decode"):
+            pages = [decode_upload(digest, upload.getvalue(), upload.name)
+                     for digest, upload in zip(digests, uploads)]
+
+        with st.spinner("Running OCR..."):
+            ocr_data = extract_pages(engine, mode, digests, pages)
+        # Words are only grouped by their initial, so only letters are scored
+        scores = score_similarity(engine, mode, digests, ocr_data, pages) if mode == "letters" else None
+        with st.spinner("Rendering collage..."):
+            if encoding[0] == "tiles":
+                collage = render_pyramid(engine, mode, result_key, encoding[1], ocr_data, pages)
+            else:
+                collage = render_collage(engine, mode, digests, encoding, ocr_data, pages)
+    return collage, run_trace, scores
+
+
+def compare(engine, mode, kind, warm=None):
+    """
+    Upload two images and create a juxtaposed collage with one of the OCR modules.
+
+    Decoded pages, OCR results and collages are cached against the content of the uploads,
+    so reruns and repeated clicks with the same images do not redo any work, and replacing
+    one image only reads and renders that author's side again.
+
+    :param engine: "pytesseract" or "easyocr".
+    :param mode: "letters" or "words".
+    :param kind: "letter" or "word", used for labels and the download file name.
+    :param warm: Optional function that loads the OCR models before the comparison.
+    """
+    if not SERVICE_URL:
+        load_engine(engine, mode)
+    encoding = collage_settings()
+    upload_1, upload_2 = upload_images()
+
+    if upload_1 and upload_2:
+        st.write("")
+        digests = (upload_digest(upload_1), upload_digest(upload_2))
+        result_key = (engine, mode) + digests + encoding
+
+        if st.button(f"Create juxtaposed {kind} collage"):
+            # Tile pyramids are viewed from local files, so they are always rendered here
+            if SERVICE_URL and encoding[0] != "tiles":
+                collage, run_trace, scores = compare_remote(engine, mode, (upload_1, upload_2), encoding)
+            else:
+                collage, run_trace, scores = compare_local(engine, mode, (upload_1, upload_2), digests, encoding,
+                                                           result_key, warm)
+            st.session_state["collage"] = (result_key, collage, run_trace, scores)
+            st.success(f"Juxtaposed {kind} collage created successfully!")
+
+        # Keep showing the last collage across reruns as long as the uploads are unchanged
+        result = st.session_state.get("collage")
+        if result is not None and result[0] == result_key:
+            _, collage, run_trace, scores = result
+            show_trace(run_trace)
+            show_similarity(scores)
+            if encoding[0] == "tiles":
+                show_pyramid(collage)
+                return
+
+            # The browser only gets the downscaled preview, the full collage is a download
+            collage, preview = collage
+            st.image(preview, use_column_width=True)
+            fmt = encoding[0]
+            st.download_button(f"Download full collage ({len(collage) / 1024 / 1024:.1f} MB)", collage,
+                               file_name=f"juxtaposed_{kind}_collage.{fmt}", mime=f"image/{fmt}")
 
 
 def main():
@@ -27,84 +436,10 @@ def main():
                         ["letters", "words"])
 
         if mode == "letters":
-
-            image_extensions = ["png", "jpg", "jpeg", "webp"]
-
-            image_path_1 = st.file_uploader("Upload image 1", type=image_extensions)
-            if image_path_1:
-                show_image = st.checkbox("Show image 1", key="checkbox_1")
-                if show_image:
-                    st.image(image_path_1, use_column_width=True)
-                with NamedTemporaryFile(delete=False) as temp_file_1:
-                    temp_file_1.write(image_path_1.getvalue())
-                    file_path_1 = temp_file_1.name
-
-            image_path_2 = st.file_uploader("Upload image 2", type=image_extensions)
-            if image_path_2:
-                show_image = st.checkbox("Show image 2", key="checkbox_2")
-                if show_image:
-                    st.image(image_path_2, use_column_width=True)
-                with NamedTemporaryFile(delete=False) as temp_file_2:
-                    temp_file_2.write(image_path_2.getvalue())
-                    file_path_2 = temp_file_2.name
-
-            if image_path_1 and image_path_2:
-                st.write("")
-                if st.button("Create juxtaposed letter collage"):
-                    image_data_1 = pytesseract_letter.extract_text_and_boxes(file_path_1)
-                    image_data_2 = pytesseract_letter.extract_text_and_boxes(file_path_2)
-                    pytesseract_letter.create_juxtaposed_collage(
-                        image_data_1, image_data_2, file_path_1, file_path_2)
-                    st.success("Juxtaposed letter collage created successfully!")
-
-                    # Show juxtaposed collage image
-                    collage_image = "juxtaposed_letter_collage_final.png"
-                    if collage_image:
-                        st.image(collage_image, use_column_width=True)
-
-                    # Delete temporary files after we're done with them! (very necessary)
-                    os.unlink(file_path_1)
-                    os.unlink(file_path_2)
+            compare("pytesseract", "letters", "letter")
 
         if mode == "words":
-
-            image_extensions = ["png", "jpg", "jpeg", "webp"]
-
-            image_path_1 = st.file_uploader("Upload image 1", type=image_extensions)
-            if image_path_1:
-                show_image = st.checkbox("Show image 1", key="checkbox_1")
-                if show_image:
-                    st.image(image_path_1, use_column_width=True)
-                with NamedTemporaryFile(delete=False) as temp_file_1:
-                    temp_file_1.write(image_path_1.getvalue())
-                    file_path_1 = temp_file_1.name
-
-            image_path_2 = st.file_uploader("Upload image 2", type=image_extensions)
-            if image_path_2:
-                show_image = st.checkbox("Show image 2", key="checkbox_2")
-                if show_image:
-                    st.image(image_path_2, use_column_width=True)
-                with NamedTemporaryFile(delete=False) as temp_file_2:
-                    temp_file_2.write(image_path_2.getvalue())
-                    file_path_2 = temp_file_2.name
-
-            if image_path_1 and image_path_2:
-                st.write("")
-                if st.button("Create juxtaposed word collage"):
-                    image_data_1 = pytesseract_word.extract_text_and_boxes(file_path_1)
-                    image_data_2 = pytesseract_word.extract_text_and_boxes(file_path_2)
-                    pytesseract_word.create_juxtaposed_collage(
-                        image_data_1, image_data_2, file_path_1, file_path_2)
-                    st.success("Juxtaposed word collage created successfully!")
-
-                    # Show juxtaposed collage image
-                    collage_image = "juxtaposed_word_collage_final.png"
-                    if collage_image:
-                        st.image(collage_image, use_column_width=True)
-
-                    # Delete temporary files after we're done with them! (very necessary)
-                    os.unlink(file_path_1)
-                    os.unlink(file_path_2)
+            compare("pytesseract", "words", "word")
 
     if options == "EasyOCR":
         st.header("EasyOCR Algorithm")
@@ -113,84 +448,10 @@ def main():
                         ["letters", "words"])
 
         if mode == "letters":
-
-            image_extensions = ["png", "jpg", "jpeg", "webp"]
-
-            image_path_1 = st.file_uploader("Upload image 1", type=image_extensions)
-            if image_path_1:
-                show_image = st.checkbox("Show image 1", key="checkbox_1")
-                if show_image:
-                    st.image(image_path_1, use_column_width=True)
-                with NamedTemporaryFile(delete=False) as temp_file_1:
-                    temp_file_1.write(image_path_1.getvalue())
-                    file_path_1 = temp_file_1.name
-
-            image_path_2 = st.file_uploader("Upload image 2", type=image_extensions)
-            if image_path_2:
-                show_image = st.checkbox("Show image 2", key="checkbox_2")
-                if show_image:
-                    st.image(image_path_2, use_column_width=True)
-                with NamedTemporaryFile(delete=False) as temp_file_2:
-                    temp_file_2.write(image_path_2.getvalue())
-                    file_path_2 = temp_file_2.name
-
-            if image_path_1 and image_path_2:
-                st.write("")
-                if st.button("Create juxtaposed letter collage"):
-                    image_data_1 = easyocr_letter.extract_text_and_boxes(file_path_1)
-                    image_data_2 = easyocr_letter.extract_text_and_boxes(file_path_2)
-                    easyocr_letter.create_juxtaposed_collage(
-                        image_data_1, image_data_2, file_path_1, file_path_2)
-                    st.success("Juxtaposed letter collage created successfully!")
-
-                    # Show juxtaposed collage image
-                    collage_image = "juxtaposed_letter_collage_final.png"
-                    if collage_image:
-                        st.image(collage_image, use_column_width=True)
-
-                    # Delete temporary files after we're done with them! (very necessary)
-                    os.unlink(file_path_1)
-                    os.unlink(file_path_2)
+            compare("easyocr", "letters", "letter", warm=lambda: reader_pool.warm(['en']))
 
         if mode == "words":
-
-            image_extensions = ["png", "jpg", "jpeg", "webp"]
-
-            image_path_1 = st.file_uploader("Upload image 1", type=image_extensions)
-            if image_path_1:
-                show_image = st.checkbox("Show image 1", key="checkbox_1")
-                if show_image:
-                    st.image(image_path_1, use_column_width=True)
-                with NamedTemporaryFile(delete=False) as temp_file_1:
-                    temp_file_1.write(image_path_1.getvalue())
-                    file_path_1 = temp_file_1.name
-
-            image_path_2 = st.file_uploader("Upload image 2", type=image_extensions)
-            if image_path_2:
-                show_image = st.checkbox("Show image 2", key="checkbox_2")
-                if show_image:
-                    st.image(image_path_2, use_column_width=True)
-                with NamedTemporaryFile(delete=False) as temp_file_2:
-                    temp_file_2.write(image_path_2.getvalue())
-                    file_path_2 = temp_file_2.name
-
-            if image_path_1 and image_path_2:
-                st.write("")
-                if st.button("Create juxtaposed word collage"):
-                    image_data_1 = easyocr_word.extract_text_and_boxes(file_path_1)
-                    image_data_2 = easyocr_word.extract_text_and_boxes(file_path_2)
-                    easyocr_word.create_juxtaposed_collage(
-                        image_data_1, image_data_2, file_path_1, file_path_2)
-                    st.success("Juxtaposed word collage created successfully!")
-
-                    # Show juxtaposed collage image
-                    collage_image = "juxtaposed_word_collage_final.png"
-                    if collage_image:
-                        st.image(collage_image, use_column_width=True)
-
-                    # Delete temporary files after we're done with them! (very necessary)
-                    os.unlink(file_path_1)
-                    os.unlink(file_path_2)
+            compare("easyocr", "words", "word", warm=lambda: reader_pool.warm(['en'], gpu=False))
 
 
 if __name__ == "__main__":
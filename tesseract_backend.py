@@ -0,0 +1,125 @@
+import os
+import sys
+import threading
+import warnings
+
+
+# Backend selection: "tesserocr" keeps an initialised engine resident in-process,
+# "pytesseract" runs the tesseract binary once per page, "auto" prefers tesserocr
+# when it is installed.
+BACKEND = os.environ.get("TESSERACT_BACKEND", "auto").lower()
+LANG = os.environ.get("TESSERACT_LANG", "eng")
+TESSDATA_PREFIX = os.environ.get("TESSDATA_PREFIX")
+
+_WINDOWS_DEFAULT_CMD = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+
+_local = threading.local()
+_backend = None
+
+
+def _tesseract_cmd():
+    """Tesseract binary used by the subprocess backend, or None to rely on PATH."""
+    cmd = os.environ.get("TESSERACT_CMD")
+    if cmd:
+        return cmd
+    if sys.platform == "win32" and os.path.exists(_WINDOWS_DEFAULT_CMD):
+        return _WINDOWS_DEFAULT_CMD
+    return None
+
+
+def _resolve_backend():
+    if BACKEND == "auto":
+        try:
+            import tesserocr  # noqa: F401
+        except ImportError:
+            warnings.warn("tesserocr is not installed, falling back to one tesseract process per page; "
+                          "install tesserocr or set TESSERACT_BACKEND=pytesseract", RuntimeWarning, stacklevel=3)
+            return "pytesseract"
+        return "tesserocr"
+    if BACKEND not in ("tesserocr", "pytesseract"):
+        raise ValueError(f"Unknown TESSERACT_BACKEND: {BACKEND}")
+    return BACKEND
+
+
+def backend_name():
+    """
+    Name of the backend used for recognition.
+
+    :return: "tesserocr" or "pytesseract".
+    """
+    global _backend
+    if _backend is None:
+        _backend = _resolve_backend()
+    return _backend
+
+
+def settings():
+    """
+    Settings that influence the OCR result, for use in cache keys.
+
+    :return: A JSON-serialisable dictionary.
+    """
+    return {"backend": backend_name(), "lang": LANG}
+
+
+def _tesserocr_api():
+    """Return this thread's resident tesserocr API, initialising it on first use."""
+    api = getattr(_local, "api", None)
+    if api is None:
+        import tesserocr
+
+        kwargs = {"lang": LANG}
+        if TESSDATA_PREFIX:
+            kwargs["path"] = TESSDATA_PREFIX
+        api = _local.api = tesserocr.PyTessBaseAPI(**kwargs)
+    return api
+
+
+def _image_to_data_tesserocr(gray):
+    import tesserocr
+
+    api = _tesserocr_api()
+    height, width = gray.shape[:2]
+    api.SetImageBytes(gray.tobytes(), width, height, 1, gray.strides[0])
+    api.Recognize()
+
+    data = {"text": [], "left": [], "top": [], "width": [], "height": [], "conf": []}
+    level = tesserocr.RIL.WORD
+    iterator = api.GetIterator()
+    if iterator is None:
+        return data
+    for word in tesserocr.iterate_level(iterator, level):
+        box = word.BoundingBox(level)
+        if box is None:
+            continue
+        x1, y1, x2, y2 = box
+        data["text"].append(word.GetUTF8Text(level) or "")
+        data["left"].append(x1)
+        data["top"].append(y1)
+        data["width"].append(x2 - x1)
+        data["height"].append(y2 - y1)
+        data["conf"].append(word.Confidence(level))
+    api.Clear()
+    return data
+
+
+def _image_to_data_pytesseract(gray):
+    import pytesseract
+
+    cmd = _tesseract_cmd()
+    if cmd:
+        pytesseract.pytesseract.tesseract_cmd = cmd
+    return pytesseract.image_to_data(gray, lang=LANG, output_type=pytesseract.Output.DICT)
+
+
+def image_to_data(gray):
+    """
+    Recognise words in a grayscale image.
+
+    :param gray: A grayscale image as a contiguous uint8 NumPy array.
+    :return: A dictionary of columns (text, left, top, width, height, conf) in the same
+        layout as pytesseract.image_to_data with Output.DICT.
+    """
+    if backend_name() == "tesserocr":
+        return _image_to_data_tesserocr(gray)
+    return _image_to_data_pytesseract(gray)
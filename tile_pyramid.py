@@ -0,0 +1,227 @@
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+import instrumentation
+
+
+# Deep-zoom layout: level 0 fits into a single tile and every following level doubles the
+# resolution up to the full-size collage at the last level
+TILE_SIZE = 256
+TILE_FORMAT = "jpeg"
+TILE_QUALITY = 85
+MANIFEST_NAME = "manifest.json"
+
+_TILE_FORMATS = {"jpeg": ("JPEG", "jpg"), "png": ("PNG", "png"), "webp": ("WEBP", "webp")}
+
+
+def level_sizes(width, height, tile_size=TILE_SIZE):
+    """
+    Image size of every pyramid level.
+
+    :param width: Width of the full-size image.
+    :param height: Height of the full-size image.
+    :param tile_size: Width and height of a tile.
+    :return: A list of (width, height) tuples from the smallest level to the full size.
+    """
+    sizes = [(width, height)]
+    while sizes[-1][0] > tile_size or sizes[-1][1] > tile_size:
+        level_width, level_height = sizes[-1]
+        sizes.append(((level_width + 1) // 2, (level_height + 1) // 2))
+    return sizes[::-1]
+
+
+def tile_path(directory, level, column, row, extension):
+    return os.path.join(directory, str(level), f"{column}_{row}.{extension}")
+
+
+def _halve(rows):
+    """
+    Downscale RGB rows by two in both directions by averaging 2x2 blocks.
+
+    :param rows: A uint8 array of shape (n, width, 3); a single row is averaged with itself.
+    :return: A uint8 array of shape (ceil(n / 2), ceil(width / 2), 3).
+    """
+    if rows.shape[0] % 2:
+        rows = np.concatenate([rows, rows[-1:]])
+    if rows.shape[1] % 2:
+        rows = np.concatenate([rows, rows[:, -1:]], axis=1)
+    blocks = rows.reshape(rows.shape[0] // 2, 2, rows.shape[1] // 2, 2, 3).astype(np.uint16)
+    return ((blocks.sum(axis=(1, 3)) + 2) // 4).astype(np.uint8)
+
+
+class _LevelWriter:
+    """
+    Cuts the rows of one pyramid level into tiles and feeds the halved rows to the next
+    smaller level, so that only one band of tile_size rows per level is kept in memory.
+    """
+
+    def __init__(self, directory, level, width, tile_size, save, smaller=None):
+        self.directory = directory
+        self.level = level
+        self.width = width
+        self.tile_size = tile_size
+        self.save = save
+        self.smaller = smaller
+        self.band = np.empty((tile_size, width, 3), dtype=np.uint8)
+        self.filled = 0
+        self.tile_row = 0
+        self.carry = None  # Last row of an odd-sized push, waiting for its partner
+
+    def push(self, rows):
+        offset = 0
+        while offset < rows.shape[0]:
+            count = min(self.tile_size - self.filled, rows.shape[0] - offset)
+            self.band[self.filled:self.filled + count] = rows[offset:offset + count]
+            self.filled += count
+            offset += count
+            if self.filled == self.tile_size:
+                self._write_band()
+
+        if self.smaller is not None:
+            if self.carry is not None:
+                rows = np.concatenate([self.carry, rows])
+                self.carry = None
+            if rows.shape[0] % 2:
+                self.carry = rows[-1:].copy()
+                rows = rows[:-1]
+            if rows.shape[0]:
+                self.smaller.push(_halve(rows))
+
+    def finish(self):
+        if self.filled:
+            self._write_band()
+        if self.smaller is not None:
+            if self.carry is not None:
+                self.smaller.push(_halve(self.carry))
+            self.smaller.finish()
+
+    def _write_band(self):
+        band = self.band[:self.filled]
+        with instrumentation.span("encode", level=self.level):
+            for column, left in enumerate(range(0, self.width, self.tile_size)):
+                self.save(self.level, column, self.tile_row, band[:, left:left + self.tile_size])
+        self.tile_row += 1
+        self.filled = 0
+
+
+def _rows(strips, width, height, chunk=TILE_SIZE):
+    """Yield the RGB rows of the strips, cut at height and padded with white up to it."""
+    rows_read = 0
+    for strip in strips:
+        if rows_read >= height:
+            break
+        rows = np.asarray(strip.convert("RGB"))[:height - rows_read]
+        rows_read += rows.shape[0]
+        yield rows
+    while rows_read < height:
+        rows = np.full((min(chunk, height - rows_read), width, 3), 255, dtype=np.uint8)
+        rows_read += rows.shape[0]
+        yield rows
+
+
+def write_pyramid(directory, strips, width, height, tile_size=TILE_SIZE, tile_format=TILE_FORMAT,
+                  quality=TILE_QUALITY):
+    """
+    Write an image as a deep-zoom tile pyramid without holding the whole image in memory.
+
+    Strips are consumed top to bottom. Every level keeps a single band of tile_size rows,
+    so memory is proportional to the image width, not its height.
+
+    :param directory: Directory the tiles and the manifest are written to.
+    :param strips: An iterable of PIL RGB images of the given width, top to bottom.
+    :param width: Width of the full-size image.
+    :param height: Height of the full-size image.
+    :param tile_size: Width and height of a tile.
+    :param tile_format: "jpeg", "png" or "webp".
+    :param quality: Quality of JPEG and WebP tiles, 1-100.
+    :return: The manifest dictionary, also written to MANIFEST_NAME in directory.
+    """
+    try:
+        pil_format, extension = _TILE_FORMATS[tile_format]
+    except KeyError:
+        raise ValueError(f"Unsupported tile format: {tile_format}") from None
+    options = {"format": pil_format}
+    if pil_format != "PNG":
+        options["quality"] = quality
+
+    sizes = level_sizes(width, height, tile_size)
+    for level in range(len(sizes)):
+        os.makedirs(os.path.join(directory, str(level)), exist_ok=True)
+
+    def save(level, column, row, tile):
+        Image.fromarray(tile).save(tile_path(directory, level, column, row, extension), **options)
+
+    # Chain the levels from the smallest up, the full-size level receives the strips
+    writer = None
+    for level, (level_width, _) in enumerate(sizes):
+        writer = _LevelWriter(directory, level, level_width, tile_size, save, writer)
+    for rows in _rows(strips, width, height, tile_size):
+        writer.push(rows)
+    writer.finish()
+
+    manifest = {
+        "width": width,
+        "height": height,
+        "tile_size": tile_size,
+        "format": tile_format,
+        "extension": extension,
+        "levels": [
+            {
+                "level": level,
+                "width": level_width,
+                "height": level_height,
+                "columns": -(-level_width // tile_size),
+                "rows": -(-level_height // tile_size),
+            }
+            for level, (level_width, level_height) in enumerate(sizes)
+        ],
+    }
+    with open(os.path.join(directory, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def read_viewport(directory, manifest, level, left, top, width, height):
+    """
+    Assemble the part of one pyramid level that is visible in a viewport.
+
+    Only the tiles overlapping the viewport are read, so the cost does not depend on the
+    size of the whole image.
+
+    :param directory: Directory written by write_pyramid().
+    :param manifest: The manifest of the pyramid.
+    :param level: Pyramid level, 0 is the smallest.
+    :param left: Left edge of the viewport in pixels of that level.
+    :param top: Top edge of the viewport in pixels of that level.
+    :param width: Width of the viewport.
+    :param height: Height of the viewport.
+    :return: An RGB array of shape (height, width, 3); areas outside the image are white.
+    """
+    tile_size = manifest["tile_size"]
+    info = manifest["levels"][level]
+    view = np.full((height, width, 3), 255, dtype=np.uint8)
+
+    first_column, last_column = max(left // tile_size, 0), min((left + width - 1) // tile_size, info["columns"] - 1)
+    first_row, last_row = max(top // tile_size, 0), min((top + height - 1) // tile_size, info["rows"] - 1)
+    for row in range(first_row, last_row + 1):
+        for column in range(first_column, last_column + 1):
+            with Image.open(tile_path(directory, level, column, row, manifest["extension"])) as tile:
+                tile = np.asarray(tile.convert("RGB"))
+            tile_left, tile_top = column * tile_size, row * tile_size
+
+            # Intersection of the tile and the viewport, in level coordinates
+            x0, y0 = max(tile_left, left), max(tile_top, top)
+            x1 = min(tile_left + tile.shape[1], left + width)
+            y1 = min(tile_top + tile.shape[0], top + height)
+            if x1 > x0 and y1 > y0:
+                view[y0 - top:y1 - top, x0 - left:x1 - left] = \
+                    tile[y0 - tile_top:y1 - tile_top, x0 - tile_left:x1 - tile_left]
+    return view
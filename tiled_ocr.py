@@ -0,0 +1,130 @@
+import contextvars
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import instrumentation
+from glyph_table import GlyphTable
+
+
+# Pages larger than TILE_SIZE in either direction are read in tiles of that size on a
+# shared pool of WORKERS threads. Neighbouring tiles overlap by TILE_OVERLAP pixels, which
+# should exceed the longest word on the (preprocessed) page so every word lies completely
+# inside the tile that keeps it. TILE_SIZE=0 disables tiling.
+TILE_SIZE = int(os.environ.get("OCR_TILE_SIZE", "1280"))
+TILE_OVERLAP = int(os.environ.get("OCR_TILE_OVERLAP", "320"))
+WORKERS = int(os.environ.get("OCR_TILE_WORKERS", str(os.cpu_count() or 1)))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def settings():
+    """Tiling settings that affect the OCR result, for cache keys."""
+    return {"tile_size": TILE_SIZE, "overlap": TILE_OVERLAP}
+
+
+def worker_share(processes):
+    """
+    Tile threads each of several OCR processes should run, so that together they use about
+    one thread per CPU.
+
+    :param processes: Number of processes reading pages at the same time.
+    :return: OCR_TILE_WORKERS when it is set, otherwise the CPU count divided among the
+        processes, at least 1.
+    """
+    if "OCR_TILE_WORKERS" in os.environ:
+        return WORKERS
+    return max((os.cpu_count() or 1) // max(processes, 1), 1)
+
+
+def set_workers(workers):
+    """
+    Resize the tile pool of this process, e.g. in the initializer of a worker process.
+
+    :param workers: Number of tile threads, see worker_share().
+    """
+    global WORKERS, _executor
+    with _executor_lock:
+        WORKERS = max(int(workers), 1)
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(WORKERS, 1), thread_name_prefix="ocr-tile")
+        return _executor
+
+
+def axis_tiles(length, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """
+    Split one page axis into overlapping tiles.
+
+    Each tile owns the part of the axis closer to it than to its neighbours, i.e. seams are
+    placed in the middle of the overlaps. Together the owned parts cover the axis exactly once.
+
+    :param length: Width or height of the page.
+    :param tile_size: Length of a tile.
+    :param overlap: Length shared by neighbouring tiles.
+    :return: A list of (start, end, owned start, owned end) tuples.
+    """
+    if length <= tile_size:
+        return [(0, length, -np.inf, np.inf)]
+    step = max(tile_size - overlap, 1)
+    starts = list(range(0, length - tile_size, step)) + [length - tile_size]  # Last tile ends at the edge
+    seams = [(next_start + start + tile_size) / 2 for start, next_start in zip(starts, starts[1:])]
+    owned = zip([-np.inf] + seams, seams + [np.inf])
+    return [(start, start + tile_size, low, high) for start, (low, high) in zip(starts, owned)]
+
+
+def read_words(gray, read_tile, tile_size=None, overlap=None):
+    """
+    Read the words of a page, in overlapping tiles on the worker pool when it is large.
+
+    Every tile is read independently and its boxes are moved into page coordinates. A word
+    is kept only by the tile that owns the centre of its box, which removes the copies of
+    words in the overlaps and the pieces of words cut by a tile edge.
+
+    :param gray: The grayscale page as a NumPy array.
+    :param read_tile: A function taking a contiguous grayscale tile and returning a GlyphTable
+        of the words in it, in tile coordinates. It is called from several threads at once.
+    :param tile_size: Tile size, defaults to TILE_SIZE.
+    :param overlap: Overlap of neighbouring tiles, defaults to TILE_OVERLAP.
+    :return: A GlyphTable of the words on the page.
+    """
+    tile_size = TILE_SIZE if tile_size is None else tile_size
+    overlap = TILE_OVERLAP if overlap is None else overlap
+    height, width = gray.shape[:2]
+    if not tile_size or (height <= tile_size and width <= tile_size):
+        return read_tile(np.ascontiguousarray(gray))
+
+    def read(tile):
+        (x0, x1, own_x0, own_x1), (y0, y1, own_y0, own_y1) = tile
+        with instrumentation.span("ocr_tile", x=x0, y=y0):
+            words = read_tile(np.ascontiguousarray(gray[y0:y1, x0:x1]))
+        if not len(words):
+            return words
+
+        records = words.records.copy()
+        records["x"] += x0
+        records["y"] += y0
+        center_x = records["x"] + records["width"] / 2
+        center_y = records["y"] + records["height"] / 2
+        owned = (center_x >= own_x0) & (center_x < own_x1) & (center_y >= own_y0) & (center_y < own_y1)
+        return GlyphTable(records[owned], words.text, words.text_field)
+
+    # Tiles in reading order: rows of tiles from top to bottom, each from left to right
+    tiles = [(x_tile, y_tile) for y_tile, x_tile in itertools.product(
+        axis_tiles(height, tile_size, overlap), axis_tiles(width, tile_size, overlap))]
+    executor = _get_executor()
+    # Run every tile in a copy of the caller's context so its spans reach the caller's trace
+    futures = [executor.submit(contextvars.copy_context().run, read, tile) for tile in tiles]
+    results = [future.result() for future in futures]
+    return GlyphTable.concat(results, text_field=results[0].text_field)